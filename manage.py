@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import json
+import os
 
 from flask.ext.script import Manager
 
@@ -12,27 +13,489 @@ manager.add_option('-m', '--mode', dest='mode', default='dev',
                    required=False)
 
 
-@manager.command
-def export_results(*args, **kwargs):
+def write_json_list(path, key, jsonables):
+    """Write `{key: [...]}` compactly to `path` as `jsonables` are iterated,
+    and return the number of items written."""
+
+    n_items = 0
+    with open(path, 'w') as f:
+        f.write('{' + json.dumps(key) + ':[')
+        for item in jsonables:
+            if n_items > 0:
+                f.write(',')
+            f.write(json.dumps(item, separators=(',', ':')))
+            n_items += 1
+        f.write(']}')
+    return n_items
+
+
+def result_partitions(partition, n_partitions, query):
+    """Split the results matching `query` into `(name, query)` partitions,
+    by `exp_id` or into `n_partitions` ranges of `created_at` of equal
+    duration."""
+    from yelandur.models import Result
+
+    raw_query = Result.objects(**query)._query
+    collection = Result._get_collection()
+    if partition == 'exp':
+        return [(exp_id, dict(query, exp_id=exp_id))
+                for exp_id in sorted(collection.find(raw_query)
+                                     .distinct('exp_id'))]
+
+    # Bounds of the created_at ranges are found on its index
+    ends = []
+    for direction in [1, -1]:
+        son = next(collection.find(raw_query, {'created_at': True})
+                   .sort('created_at', direction).limit(1), None)
+        if son is None:
+            return []
+        ends.append(Result._fields['created_at'].to_python(son['created_at']))
+    first, last = ends
+    step = (last - first) / n_partitions
+
+    # Stored dates don't pad microseconds to a fixed width, so bounds are
+    # rounded to the second to compare them in order. The first and last
+    # ranges are only bounded by `query`, to include results created
+    # during the export.
+    bounds = [(first + i * step).replace(microsecond=0)
+              for i in range(1, n_partitions)]
+    partitions = []
+    for i in range(n_partitions):
+        partition_query = dict(query)
+        if i > 0:
+            partition_query['created_at__gte'] = bounds[i - 1]
+        if i < n_partitions - 1:
+            partition_query['created_at__lt'] = bounds[i]
+        partitions.append((str(i), partition_query))
+    return partitions
+
+
+def write_table(path, jsonables):
+    """Write results to a CSV file at `path`, and to a '.npz' file next to
+    it if numpy is installed. Return the table and the '.npz' path.
+
+    Results are spooled to a temporary file while their schema is
+    inferred, then read back from it to write the rows, so only the CSV
+    file is written in constant memory: the '.npz' arrays are built in
+    memory."""
+    import csv
+    import tempfile
+
+    from yelandur.analysis import ResultTable
+
+    table = ResultTable()
+    with tempfile.TemporaryFile() as spool:
+        for jsonable in jsonables:
+            table.add(jsonable)
+            spool.write(json.dumps(jsonable, separators=(',', ':')) + '\n')
+
+        def spooled():
+            spool.seek(0)
+            return (json.loads(line) for line in spool)
+
+        with open(path, 'wb') as f:
+            csv.writer(f).writerows(table.iter_csv_rows(spooled()))
+
+        try:
+            arrays = table.to_arrays(spooled())
+        except ImportError:
+            return table, None
+    import numpy
+    npz_path = os.path.splitext(path)[0] + '.npz'
+    numpy.savez_compressed(npz_path, **arrays)
+    return table, npz_path
+
+
+def export_partition(args):
+    """Export the results matching `query` to `path` (as JSON, or as a
+    table if `output_format` is 'table'), and return the partition's
+    manifest entry. Run in the export worker processes."""
+    import time
+
+    from yelandur.helpers import iso8601
+    from yelandur.models import Result
+
+    path, query, batch_size, output_format = args
+    start = time.time()
+    # Sorted like the created_at indexes, so partitions are read from them
+    jsonables = (Result.objects(**query).order_by('-created_at')
+                 .batch_size(batch_size).iter_jsonable_private())
+    entry = {'file': path,
+             'query': dict((k, v.strftime(iso8601)
+                            if k.startswith('created_at') else v)
+                           for k, v in query.iteritems())}
+    if output_format == 'table':
+        table, npz_path = write_table(path, jsonables)
+        entry['n_results'] = table.n_rows
+        entry['columns'] = [{'name': name, 'type': tipe}
+                            for name, tipe in table.schema()]
+        if npz_path is not None:
+            entry['npz'] = npz_path
+    else:
+        entry['n_results'] = write_json_list(path, 'results', jsonables)
+    entry['duration'] = time.time() - start
+    return entry
+
+
+def read_export_state(path):
+    if not os.path.exists(path):
+        return {'checkpoint': None}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_export_state(path, state):
+    """Replace the state file at `path` atomically, so that a crash leaves
+    either the previous or the new state."""
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, separators=(',', ': '))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+@manager.option('-p', '--page-size', dest='page_size', type=int,
+                default=1000, help='Number of results per file')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='Number of documents per database fetch')
+@manager.option('--partition', dest='partition', default=None,
+                choices=['exp', 'created_at'],
+                help=('Export results to one file per exp or per range of '
+                      'creation dates, listed in manifest.json'))
+@manager.option('-n', '--partitions', dest='n_partitions', type=int,
+                default=16, help='Number of created_at partitions')
+@manager.option('-j', '--processes', dest='processes', type=int, default=1,
+                help='Number of processes exporting partitions')
+@manager.option('-f', '--format', dest='output_format', default='json',
+                choices=['json', 'table'],
+                help=('Export results as JSON, or as typed columns in CSV '
+                      'and .npz files (one per exp; .npz files are built '
+                      'in memory, about the size of the exp\'s results)'))
+@manager.option('-s', '--since', dest='state_path', default=None,
+                help=('State file with the checkpoint of the last export: '
+                      'only export what changed since, and move the '
+                      'checkpoint forward'))
+@manager.option('--margin', dest='margin', type=int, default=60,
+                help=('Seconds before now to end an incremental export '
+                      'at, leaving time for results being saved'))
+def export_results(page_size, batch_size, partition, n_partitions,
+                   processes, output_format, state_path, margin):
+    """Export profiles to 'profiles.json' and results to 'results-<i>.json'
+    files, reading each collection with a single cursor.
+
+    With `--partition`, results are exported to one 'results-<partition>.json'
+    file per partition instead, by `--processes` processes in parallel.
+
+    With `--format table`, results are exported to typed columns in
+    'results-<exp_id>.csv' and '.npz' files, with their schema in the
+    manifest.
+
+    With `--since`, only the results created and the profiles changed since
+    the last checkpoint are exported."""
+    import time
+    from datetime import datetime, timedelta
+    from itertools import chain, islice, imap
+    from multiprocessing import Pool
+
+    from yelandur.helpers import iso8601_seconds
     from yelandur.models import Profile, Result
+    from yelandur.analysis import numpy
+
+    # Tables are by exp, since each exp has its own result data schema
+    if output_format == 'table':
+        if partition not in [None, 'exp']:
+            print 'Tables can only be partitioned by exp'
+            return
+        partition = 'exp'
+        if numpy is None:
+            print 'numpy is not installed, only exporting CSV files'
+
+    # An incremental export covers [checkpoint, now - margin). The window
+    # is saved before exporting, so that an interrupted export is resumed
+    # with the same window (and files) instead of skipping part of it.
+    profiles = Profile.objects()
+    results_query = {}
+    if state_path is not None:
+        state = read_export_state(state_path)
+        window = state.get('pending')
+        if window is None:
+            until = datetime.utcnow() - timedelta(seconds=margin)
+            window = {'since': state['checkpoint'],
+                      'until': until.strftime(iso8601_seconds)}
+            write_export_state(state_path, dict(state, pending=window))
+        else:
+            print 'Resuming interrupted export'
+        print 'Exporting changes from {} to {}'.format(
+            window['since'] or 'the beginning', window['until'])
+
+        until = datetime.strptime(window['until'], iso8601_seconds)
+        since = None
+        results_query['created_at__lt'] = until
+        if window['since'] is not None:
+            since = datetime.strptime(window['since'], iso8601_seconds)
+            results_query['created_at__gte'] = since
+        profiles = Profile.updated_between(since, until)
 
     print "Exporting profiles to 'profiles.json'"
-    with open('profiles.json', 'w') as p:
-        json.dump({'profiles': Profile.objects.to_jsonable_private()},
-                  p, indent=2, separators=(',', ': '))
-
-    page_size = 1000
-    results = Result.objects
-    n_results = results.count()
-    pages_indices = range(1 + n_results / page_size)
-    print "Exporting results to 'results-{{{}}}.json'".format(
-        ', '.join(map(lambda i: str(i), pages_indices)))
-    print '({} results per file)'.format(page_size)
-    for i in pages_indices:
-        results_range = results[i*page_size:(i+1)*page_size]
-        with open('results-{}.json'.format(i), 'w') as r:
-            json.dump({'results': results_range.to_jsonable_private()},
-                      r, indent=2, separators=(',', ': '))
+    start = time.time()
+    # Changed profiles are read from the updated_at index, all profiles in
+    # an order that doesn't change during the export
+    profiles = profiles.order_by(
+        'updated_at' if state_path is not None else 'id')
+    n_profiles = write_json_list(
+        'profiles.json', 'profiles',
+        profiles.batch_size(batch_size).iter_jsonable_private())
+    duration = time.time() - start
+    print '{} profiles in {:.1f}s ({:.0f} profiles/s)'.format(
+        n_profiles, duration, n_profiles / max(duration, 1e-6))
+
+    if partition is not None:
+        partitions = result_partitions(partition, n_partitions,
+                                       results_query)
+        extension = 'csv' if output_format == 'table' else 'json'
+        print ("Exporting results to 'results-<partition>.{}' "
+               "({} partitions by {}, {} processes)").format(
+                   extension, len(partitions), partition, processes)
+        start = time.time()
+        tasks = [('results-{}.{}'.format(name, extension), query, batch_size,
+                  output_format)
+                 for name, query in partitions]
+        # Worker processes are forked, and pymongo reconnects in them
+        pool = Pool(processes) if processes > 1 else None
+        entries = []
+        n_results = 0
+        for entry in (pool.imap_unordered(export_partition, tasks)
+                      if pool is not None else imap(export_partition, tasks)):
+            entries.append(entry)
+            n_results += entry['n_results']
+            duration = time.time() - start
+            print '{} results in {} files, {:.1f}s ({:.0f} results/s)'.format(
+                n_results, len(entries), duration,
+                n_results / max(duration, 1e-6))
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        files = [task[0] for task in tasks]
+        entries.sort(key=lambda entry: files.index(entry['file']))
+        manifest = {'partition': partition,
+                    'format': output_format,
+                    'profiles': {'file': 'profiles.json',
+                                 'n_profiles': n_profiles},
+                    'results': entries}
+        if state_path is not None:
+            manifest.update(window)
+        with open('manifest.json', 'w') as m:
+            json.dump(manifest, m, indent=2, separators=(',', ': '))
+        print "Manifest written to 'manifest.json'"
+
+    else:
+        print "Exporting results to 'results-<i>.json'"
+        print '({} results per file)'.format(page_size)
+        start = time.time()
+        jsonables = (Result.objects(**results_query)
+                     .order_by('-created_at' if state_path is not None
+                               else 'id')
+                     .batch_size(batch_size).iter_jsonable_private())
+        n_results = 0
+        i = 0
+        for first in jsonables:
+            page = chain([first], islice(jsonables, page_size - 1))
+            n_results += write_json_list('results-{}.json'.format(i),
+                                         'results', page)
+            i += 1
+            duration = time.time() - start
+            print ('{} results in {} files, {:.1f}s '
+                   '({:.0f} results/s)').format(
+                       n_results, i, duration,
+                       n_results / max(duration, 1e-6))
+
+    if state_path is not None:
+        write_export_state(state_path, {'checkpoint': window['until']})
+        print "Checkpoint moved to {} in '{}'".format(window['until'],
+                                                     state_path)
+
+
+def recount_results():
+    """Yield `(name, collection, doc, n_results)` for each exp, profile and
+    user, with `n_results` counted from the results collection.
+
+    Results are found through their exp_id and profile_id, and counted one
+    document at a time on those indexes, which a $group over the whole
+    collection can't do within the 16MB aggregation result limit."""
+    from yelandur.models import User, Exp, Profile, Result
+
+    results = Result._get_collection()
+
+    exp_counts = {}
+    exps = Exp._get_collection()
+    for e in exps.find({}, {'exp_id': True, 'n_results': True}):
+        exp_counts[e['exp_id']] = results.find(
+            {'exp_id': e['exp_id']}).count()
+        yield 'exps', exps, e, exp_counts[e['exp_id']]
+
+    profiles = Profile._get_collection()
+    for p in profiles.find({}, {'profile_id': True, 'n_results': True}):
+        yield 'profiles', profiles, p, results.find(
+            {'profile_id': p['profile_id']}).count()
+
+    users = User._get_collection()
+    for u in users.find({}, {'exp_ids': True, 'n_results': True}):
+        yield 'users', users, u, sum(exp_counts.get(exp_id, 0)
+                                     for exp_id in u.get('exp_ids', []))
+
+
+@manager.option('-d', '--drop-lists', dest='drop_lists', action='store_true',
+                default=False, help=('Drop the result_ids lists once the '
+                                     'recounted n_results are checked'))
+@manager.option('-f', '--force', dest='force', action='store_true',
+                default=False, help=('Drop the result_ids lists even if '
+                                     'n_results disagree with the results'))
+def migrate_result_ids(drop_lists, force):
+    """Recount n_results from the results, then, as a separate step with
+    `--drop-lists`, drop the result_ids lists.
+
+    Uploads must be stopped while recounting: counts are set from the
+    results present when each document is counted, and would overwrite
+    increments made by concurrent uploads."""
+    from yelandur.models import User, Exp, Profile
+
+    if drop_lists:
+        # The lists are only dropped if n_results agrees with the results
+        # (uploads since the recount have updated both, but no longer the
+        # lists, so those can't be checked against)
+        n_mismatches = 0
+        for name, collection, doc, n_results in recount_results():
+            if doc.get('n_results') != n_results:
+                n_mismatches += 1
+                print '{} {}: {} results but n_results is {}'.format(
+                    name, doc['_id'], n_results, doc.get('n_results'))
+        if n_mismatches > 0 and not force:
+            print ('{} documents disagree, not dropping the lists '
+                   '(recount again, or use --force to drop them '
+                   'anyway)').format(n_mismatches)
+            return
+
+        for collection in [Exp._get_collection(), Profile._get_collection(),
+                           User._get_collection()]:
+            print 'Dropping result_ids from {}'.format(collection.name)
+            collection.update({'result_ids': {'$exists': True}},
+                              {'$unset': {'result_ids': ''}}, multi=True)
+        return
+
+    print 'Recounting results for exps, profiles and users'
+    for name, collection, doc, n_results in recount_results():
+        collection.update({'_id': doc['_id']},
+                          {'$set': {'n_results': n_results}})
+
+    print ('Check the counts, then drop the result_ids lists with '
+           '--drop-lists')
+
+
+@manager.option('-s', '--sleep', dest='sleep', type=float, default=1.0,
+                help='Seconds to wait when the queue is empty')
+@manager.option('-r', '--requeue-after', dest='requeue_after', type=int,
+                default=600, help=('Seconds after which a running job is '
+                                   'considered abandoned and queued again'))
+@manager.option('-o', '--once', dest='once', action='store_true',
+                default=False, help='Exit once the queue is empty')
+def process_results(sleep, requeue_after, once):
+    """Create the results of uploads queued with `async=true`."""
+    import time
+    from datetime import datetime, timedelta
+
+    from flask import current_app
+
+    from yelandur.models import ResultJob
+    from yelandur.results import run_result_job
+
+    while True:
+        ResultJob.requeue_stale(datetime.utcnow() -
+                                timedelta(seconds=requeue_after))
+        job = ResultJob.claim_next()
+        if job is None:
+            if once:
+                return
+            time.sleep(sleep)
+            continue
+
+        run_result_job(job)
+        current_app.logger.info('Result job {} {} ({} items)'.format(
+            job.job_id, job.status, job.n_items))
+
+
+@manager.option('-n', '--number', dest='number', type=int, default=500,
+                help='Number of verifications per verifier')
+def bench_verify(number):
+    """Compare the verifications per second of the signature verifiers."""
+    import time
+
+    import ecdsa
+
+    from yelandur.helpers import available_verifiers, b64url_dec, APITestCase
+
+    sk = ecdsa.SigningKey.generate(curve=ecdsa.curves.NIST256p)
+    sdata = APITestCase._sign({'result': {'result_data': {'trials': 1}}},
+                              sk, True)
+    jpayload = b64url_dec(sdata['payload'])
+    jheader = b64url_dec(sdata['signatures'][0]['protected'])
+    sig_der = b64url_dec(sdata['signatures'][0]['signature'])
+
+    for verifier in available_verifiers():
+        vk = verifier.load_key(sk.verifying_key.to_pem())
+        start = time.time()
+        for i in xrange(number):
+            verifier.verify(vk, jheader, jpayload, sig_der)
+        duration = time.time() - start
+        print '{}: {:.0f} verifications/s ({} in {:.3f}s)'.format(
+            verifier.name, number / duration, number, duration)
+
+
+@manager.option('-n', '--number', dest='number', type=int, default=1000,
+                help='Number of results in the response')
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=10,
+                help='Number of renderings per format')
+def bench_json(number, repeat):
+    """Compare the size and rendering time of the JSON response formats on
+    a `/results?access=private` response."""
+    import time
+    from datetime import datetime
+
+    from flask import current_app
+
+    from yelandur.helpers import jsonify, random_sha256hex
+    from yelandur.models import Data, Result
+
+    trials = [{'stimulus': 'word-{}'.format(i), 'rt': 412.5 + i,
+               'correct': i % 3 != 0, 'choices': [1, 2, 3]}
+              for i in xrange(20)]
+    results = [Result(result_id=random_sha256hex(),
+                      profile_id=random_sha256hex(),
+                      exp_id=random_sha256hex(),
+                      created_at=datetime.utcnow(),
+                      data=Data(trials=trials, condition='b'))
+               for i in xrange(number)]
+    response = {'results': [r.to_jsonable_private() for r in results]}
+
+    formats = [('pretty, sorted keys', False, True),
+               ('compact, sorted keys', True, True),
+               ('compact', True, False)]
+    config = current_app.config
+    saved = config['JSONIFY_COMPACT'], config['JSON_SORT_KEYS']
+    try:
+        for name, compact, sort_keys in formats:
+            config['JSONIFY_COMPACT'] = compact
+            config['JSON_SORT_KEYS'] = sort_keys
+            start = time.time()
+            for i in xrange(repeat):
+                size = len(jsonify(response).data)
+            duration = (time.time() - start) / repeat
+            print '{}: {} bytes in {:.1f}ms'.format(name, size,
+                                                    1000 * duration)
+    finally:
+        config['JSONIFY_COMPACT'], config['JSON_SORT_KEYS'] = saved
 
 
 if __name__ == "__main__":
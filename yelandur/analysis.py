@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+import json
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .helpers import (ParsingError, mongo_encode_string, iso8601,
+                      iso8601_seconds)
+
+
+def percentile(sorted_values, p):
+    """Linear interpolation between the closest ranks of `sorted_values`."""
+
+    rank = (len(sorted_values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return (sorted_values[low] +
+            (sorted_values[high] - sorted_values[low]) * (rank - low))
+
+
+class ResultStats(object):
+    """Count, min, max, mean and percentiles of numeric `result_data` fields,
+    and their counts and means by time bucket.
+
+    Counts, extremes and sums are grouped by the database, per bucket.
+    Percentiles need the values themselves, which are read one field at a
+    time, into a numpy array if numpy is installed."""
+
+    # Length and format of the `created_at` prefix identifying a bucket
+    # (dates are stored as 'YYYY,MM,DD,HH,MM,SS,ffffff')
+    buckets = {'day': (10, '%Y,%m,%d'),
+               'hour': (13, '%Y,%m,%d,%H')}
+    percentiles = [5, 25, 50, 75, 95]
+    # BSON types of doubles, 32-bit and 64-bit integers
+    number_types = [1, 16, 18]
+    nan = float('nan')
+
+    def __init__(self, fields, bucket='day'):
+        if bucket not in self.buckets:
+            raise ParsingError("Unknown bucket '{}'".format(bucket))
+        self.prefix_length, self.bucket_format = self.buckets[bucket]
+        # Keys of result_data are stored encoded
+        self.fields = [(f, mongo_encode_string(f)) for f in fields]
+        self.n_results = 0
+        self.field_stats = dict((f, None) for f in fields)
+        self.histogram = {}
+
+    def bucket_key(self):
+        return {'$substr': ['$created_at', 0, self.prefix_length]}
+
+    def pipeline(self, query):
+        return [{'$match': query},
+                {'$group': {'_id': self.bucket_key(),
+                            'count': {'$sum': 1}}}]
+
+    @classmethod
+    def number_query(cls, key):
+        # Booleans and NaNs aren't measures, and arrays (which match the type
+        # of any of their elements) aren't single values
+        return {'$or': [{key: {'$type': t}} for t in cls.number_types],
+                key: {'$ne': cls.nan},
+                key + '.0': {'$exists': False}}
+
+    def field_query(self, query, db_f):
+        return {'$and': [query, self.number_query('data.' + db_f)]}
+
+    def field_pipeline(self, query, db_f):
+        path = '$data.' + db_f
+        return [{'$match': self.field_query(query, db_f)},
+                {'$group': {'_id': self.bucket_key(),
+                            'count': {'$sum': 1},
+                            'total': {'$sum': path},
+                            'min': {'$min': path},
+                            'max': {'$max': path}}}]
+
+    def _get_bucket(self, key):
+        try:
+            return self.histogram[key]
+        except KeyError:
+            bucket = self.histogram[key] = {
+                'n_results': 0,
+                'fields': dict((f, [0, 0]) for f, db_f in self.fields)}
+            return bucket
+
+    def add_buckets(self, groups):
+        """Add the result counts grouped by `pipeline()`."""
+        for group in groups:
+            self.n_results += group['count']
+            self._get_bucket(group['_id'])['n_results'] += group['count']
+
+    def add_field(self, f, groups, values):
+        """Add the stats of field `f`, grouped by `field_pipeline()`, and
+        its `values` for the percentiles."""
+
+        count, total = 0, 0
+        mins, maxs = [], []
+        for group in groups:
+            count += group['count']
+            total += group['total']
+            mins.append(group['min'])
+            maxs.append(group['max'])
+            self._get_bucket(group['_id'])['fields'][f] = [group['count'],
+                                                           group['total']]
+        if count == 0:
+            return
+
+        self.field_stats[f] = {'count': count,
+                               'min': min(mins),
+                               'max': max(maxs),
+                               'mean': float(total) / count,
+                               'percentiles': self.field_percentiles(values)}
+
+    def field_percentiles(self, values):
+        if numpy is not None:
+            values = numpy.fromiter(values, float)
+            return dict((str(p), float(v)) for p, v in
+                        zip(self.percentiles,
+                            numpy.percentile(values, self.percentiles)))
+        values = sorted(values)
+        return dict((str(p), percentile(values, p))
+                    for p in self.percentiles)
+
+    def field_to_jsonable(self, f):
+        if self.field_stats[f] is None:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None,
+                    'percentiles': None}
+        return self.field_stats[f]
+
+    def to_jsonable(self):
+        histogram = []
+        for key in sorted(self.histogram):
+            bucket = self.histogram[key]
+            start = datetime.strptime(key, self.bucket_format)
+            histogram.append({
+                'start': start.strftime(iso8601_seconds),
+                'n_results': bucket['n_results'],
+                'fields': dict((f, {'count': count,
+                                    'mean': (float(total) / count
+                                             if count != 0 else None)})
+                               for f, (count, total)
+                               in bucket['fields'].iteritems())})
+
+        return {'n_results': self.n_results,
+                'fields': dict((f, self.field_to_jsonable(f))
+                               for f in self.field_stats),
+                'histogram': histogram}
+
+    @classmethod
+    def compute(cls, rresults, fields, bucket='day'):
+        """Stats over the results in the `rresults` queryset."""
+
+        stats = cls(fields, bucket)
+        collection = rresults._collection
+        query = rresults._query
+        stats.add_buckets(collection.aggregate(stats.pipeline(query),
+                                               cursor={}))
+        for f, db_f in stats.fields:
+            groups = collection.aggregate(stats.field_pipeline(query, db_f),
+                                          cursor={})
+            values = (son['data'][db_f] for son in collection.find(
+                stats.field_query(query, db_f),
+                {'_id': False, 'data.' + db_f: True}))
+            stats.add_field(f, groups, values)
+        return stats.to_jsonable()
+
+
+class ResultTable(object):
+    """Results of an experiment as typed columns, for analysis tools.
+
+    Results are serialized by `to_jsonable_private()`. Nested dicts in
+    `result_data` are flattened to 'result_data.<key>.<key>' columns, with
+    '.' and '&' in keys encoded as in the database ('&dot;' and '&and;'),
+    so that different keys can't share a column. Each column gets a type,
+    inferred from its non-null values: 'bool', 'int', 'float' (mixed ints
+    and floats), 'str', or 'json' if values are lists or of mixed types.
+    Results that don't have a column's key (or have it null) are missing
+    in that column.
+
+    Tables are built in two passes over the results: `add()` each of them
+    to infer the schema, of which only the column types are kept, then
+    iterate over them again with `iter_csv_rows()` or `to_arrays()`."""
+
+    base_columns = [('id', 'str'), ('profile_id', 'str'), ('exp_id', 'str'),
+                    ('created_at', 'datetime')]
+    data_key = 'result_data'
+    # Range of values numpy stores as int64
+    int_bounds = (-2 ** 63, 2 ** 63)
+
+    def __init__(self):
+        self.n_rows = 0
+        # Types of the non-null values of each data column
+        self.types = {}
+
+    @classmethod
+    def flatten(cls, data, prefix):
+        for key, value in data.iteritems():
+            key = mongo_encode_string(key)
+            if isinstance(value, dict):
+                for item in cls.flatten(value, prefix + key + '.'):
+                    yield item
+            else:
+                yield prefix + key, value
+
+    @classmethod
+    def row(cls, jsonable):
+        row = dict((name, jsonable[name])
+                   for name, tipe in cls.base_columns)
+        row.update(cls.flatten(jsonable.get(cls.data_key) or {},
+                               cls.data_key + '.'))
+        return row
+
+    def add(self, jsonable):
+        data = self.flatten(jsonable.get(self.data_key) or {},
+                            self.data_key + '.')
+        for name, value in data:
+            types = self.types.setdefault(name, set())
+            if value is not None:
+                types.add(self.value_type(value))
+        self.n_rows += 1
+
+    @classmethod
+    def value_type(cls, value):
+        if isinstance(value, bool):
+            return 'bool'
+        if isinstance(value, (int, long)):
+            low, high = cls.int_bounds
+            return 'int' if low <= value < high else 'float'
+        if isinstance(value, float):
+            return 'float'
+        if isinstance(value, basestring):
+            return 'str'
+        return 'json'
+
+    @classmethod
+    def column_type(cls, types):
+        if types == set(['int', 'float']):
+            return 'float'
+        if len(types) == 1:
+            return iter(types).next()
+        # Columns that are always missing are empty strings
+        return 'str' if len(types) == 0 else 'json'
+
+    def schema(self):
+        """List of `(name, type)` columns, the data columns sorted after
+        the result's own."""
+
+        return self.base_columns + [
+            (name, self.column_type(self.types[name]))
+            for name in sorted(self.types)]
+
+    @classmethod
+    def csv_cell(cls, value, tipe):
+        # Missing values are empty cells
+        if value is None:
+            return ''
+        if tipe == 'json':
+            return json.dumps(value, separators=(',', ':'))
+        if tipe == 'bool':
+            return 'true' if value else 'false'
+        if tipe == 'float':
+            return repr(float(value))
+        if tipe == 'int':
+            return str(value)
+        return value.encode('utf-8')
+
+    def iter_csv_rows(self, jsonables):
+        """Rows of utf-8 cells for `csv.writer`, starting with the column
+        names, one per result of `jsonables` (the results that were
+        added)."""
+
+        schema = self.schema()
+        yield [name.encode('utf-8') for name, tipe in schema]
+        for jsonable in jsonables:
+            row = self.row(jsonable)
+            yield [self.csv_cell(row.get(name), tipe)
+                   for name, tipe in schema]
+
+    def to_arrays(self, jsonables):
+        """Dict of numpy arrays by column name, for the results of
+        `jsonables` (the results that were added). Missing values are
+        filled with False, 0, NaN or '' depending on the column type, and
+        flagged by a '<name>:missing' boolean array if the column has any.
+
+        Unlike CSV rows, the arrays hold the whole table in memory."""
+
+        if numpy is None:
+            raise ImportError('ResultTable.to_arrays() needs numpy')
+
+        schema = self.schema()
+        columns = dict((name, []) for name, tipe in schema)
+        for jsonable in jsonables:
+            row = self.row(jsonable)
+            for name, column in columns.iteritems():
+                column.append(row.get(name))
+
+        arrays = {}
+        for name, tipe in schema:
+            values = columns.pop(name)
+            if tipe == 'datetime':
+                # Parsed as naive UTC
+                arrays[name] = numpy.array(
+                    [datetime.strptime(v, iso8601) for v in values],
+                    dtype='datetime64[us]')
+                continue
+
+            missing = [v is None for v in values]
+            if tipe == 'bool':
+                array = numpy.array([bool(v) for v in values], dtype=bool)
+            elif tipe == 'int':
+                array = numpy.array([v or 0 for v in values],
+                                    dtype=numpy.int64)
+            elif tipe == 'float':
+                array = numpy.array([float('nan') if v is None else v
+                                     for v in values], dtype=numpy.float64)
+            elif tipe == 'json':
+                array = numpy.array([u'' if v is None else
+                                     json.dumps(v, separators=(',', ':'))
+                                     for v in values], dtype=unicode)
+            else:
+                array = numpy.array([v or u'' for v in values],
+                                    dtype=unicode)
+            arrays[name] = array
+            if any(missing):
+                arrays[name + ':missing'] = numpy.array(missing, dtype=bool)
+        return arrays
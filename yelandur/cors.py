@@ -62,6 +62,8 @@ def cors(origin_getter=get_client_origin, methods=None, headers=None,
             h['Access-Control-Allow-Methods'] = get_methods()
             h['Access-Control-Allow-Credentials'] = 'true'
             h['Access-Control-Max-Age'] = str(max_age)
+            # Let clients read the next page links of list responses
+            h['Access-Control-Expose-Headers'] = 'Link'
             if headers is not None:
                 h['Access-Control-Allow-Headers'] = headers
             else:
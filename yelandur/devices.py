@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, request
 from flask.views import MethodView
 from mongoengine import NotUniqueError
 from mongoengine.queryset import DoesNotExist
 
 from .cors import cors
+from .helpers import (QueryTooDeepException, UnknownOperator, NonQueriableType,
+                      NonOrderableType, BadQueryType, ParsingError,
+                      jsonify, jsonify_list, get_page_args)
 from .models import Device
 
 
@@ -26,10 +29,16 @@ class DevicesView(MethodView):
         else:
             rdevices = Device.objects()
 
+        limit, after = get_page_args()
+        orders = Device.objects.translate_order_to_jsonable(request.args)
         filtered_query = Device.objects.translate_to_jsonable(request.args)
         rdevices = rdevices(**filtered_query)
+        if request.args.get('count', None) == 'only':
+            return jsonify({'count': rdevices.count()})
 
-        return jsonify({'devices': rdevices.to_jsonable()})
+        rdevices, after = rdevices.order_by(*orders).paginate(limit, after)
+
+        return jsonify_list('devices', rdevices.iter_jsonable(), after)
 
     @cors()
     def post(self):
@@ -56,7 +65,7 @@ class DeviceView(MethodView):
 
     @cors()
     def get(self, device_id):
-        d = Device.objects.get(device_id=device_id)
+        d = Device.objects.only_jsonable().get(device_id=device_id)
         return jsonify({'device': d.to_jsonable()})
 
     @cors()
@@ -94,3 +103,59 @@ def does_not_exist(error):
         {'error': {'status_code': 404,
                    'type': 'DoesNotExist',
                    'message': 'Item does not exist'}}), 404
+
+
+@devices.errorhandler(UnknownOperator)
+@cors()
+def unknown_operator(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'UnknownOperator',
+                   'message': 'Found an unknown query '
+                              'operator on a valid field'}}), 400
+
+
+@devices.errorhandler(NonQueriableType)
+@cors()
+def non_queriable_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'NonQueriableType',
+                   'message': 'Field cannot be queried'}}), 400
+
+
+@devices.errorhandler(NonOrderableType)
+@cors()
+def non_orderable_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'NonOrderableType',
+                   'message': 'Field cannot be ordered'}}), 400
+
+
+@devices.errorhandler(BadQueryType)
+@cors()
+def bad_query_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'BadQueryType',
+                   'message': 'Field, operator, or query value '
+                              'not compatible together'}}), 400
+
+
+@devices.errorhandler(ParsingError)
+@cors()
+def parsing(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'ParsingError',
+                   'message': 'Could not parse query value'}}), 400
+
+
+@devices.errorhandler(QueryTooDeepException)
+@cors()
+def query_too_deep(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'QueryTooDeep',
+                   'message': 'Query parameter is too deep'}}), 400
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, jsonify, abort, request
+from itertools import chain
+
+from flask import (Blueprint, abort, request, current_app,
+                   stream_with_context)
 from flask.views import MethodView
 from flask.ext.login import current_user
 from mongoengine import NotUniqueError, ValidationError
@@ -8,8 +11,12 @@ from mongoengine.queryset import DoesNotExist
 
 from .cors import cors
 from .helpers import (QueryTooDeepException, UnknownOperator, NonQueriableType,
-                      NonOrderableType, BadQueryType, ParsingError)
-from .models import User, Exp, OwnerInCollaboratorsError
+                      NonOrderableType, BadQueryType, ParsingError,
+                      MalformedSignatureError, BadSignatureError,
+                      jsonify, jsonify_list, get_page_args, stream_ndjson)
+from .models import User, Exp, Profile, Result, OwnerInCollaboratorsError
+from .results import ProfileNotFoundError, get_private_authed
+from .analysis import ResultStats
 
 
 # Create the actual blueprint
@@ -50,17 +57,16 @@ class ExpsView(MethodView):
         else:
             rexps = Exp.objects()
 
-        limit = request.args.get('limit')
-        try:
-            limit = int(limit) if limit is not None else None
-        except ValueError:
-            raise ParsingError
+        limit, after = get_page_args()
         orders = Exp.objects.translate_order_to_jsonable(request.args)
         filtered_query = Exp.objects.translate_to_jsonable(request.args)
-        rexps = rexps(**filtered_query).order_by(*orders)
-        rexps = rexps.limit(limit) if limit is not None else rexps
+        rexps = rexps(**filtered_query)
+        if request.args.get('count', None) == 'only':
+            return jsonify({'count': rexps.count()})
+
+        rexps, after = rexps.order_by(*orders).paginate(limit, after)
 
-        return jsonify({'exps': rexps.to_jsonable()})
+        return jsonify_list('exps', rexps.iter_jsonable(), after)
 
     @cors()
     def post(self):
@@ -112,7 +118,7 @@ class ExpView(MethodView):
 
     @cors()
     def get(self, exp_id):
-        e = Exp.objects.get(exp_id=exp_id)
+        e = Exp.objects.only_jsonable().get(exp_id=exp_id)
         return jsonify({'exp': e.to_jsonable()})
 
     @cors()
@@ -123,6 +129,110 @@ class ExpView(MethodView):
 exps.add_url_rule('/<exp_id>', view_func=ExpView.as_view('exp'))
 
 
+class ExpResultsStatsView(MethodView):
+
+    @cors()
+    def get(self, exp_id):
+        # Same access as `/results?access=private`: users get the stats of
+        # their exps, profiles those of their own results. Authentication
+        # comes first, so that anonymous requests can't probe for exp ids.
+        authed = get_private_authed()
+        e = Exp.objects.only('exp_id').get(exp_id=exp_id)
+        if isinstance(authed, Profile):
+            if authed.exp_id != e.exp_id:
+                abort(403)
+        elif e.exp_id not in authed.exp_ids:
+            abort(403)
+
+        fields = request.args.getlist('fields[]')
+        bucket = request.args.get('bucket', 'day')
+        filtered_query = Result.objects.translate_to_jsonable_private(
+            request.args)
+        rresults = authed.accessible_results()(exp_id=e.exp_id)(
+            **filtered_query)
+
+        return jsonify({'stats': ResultStats.compute(rresults, fields,
+                                                     bucket)})
+
+    @cors()
+    def options(self, exp_id):
+        pass
+
+
+exps.add_url_rule('/<exp_id>/results/stats',
+                  view_func=ExpResultsStatsView.as_view('exp_results_stats'))
+
+
+class ExpResultsExportView(MethodView):
+
+    @cors()
+    def get(self, exp_id):
+        # Same access as `/results?access=private`: users get the results of
+        # their exps, profiles their own results (which are in their exp).
+        # Authentication comes first, so that anonymous requests can't probe
+        # for exp ids.
+        authed = get_private_authed()
+        e = Exp.objects.only('exp_id').get(exp_id=exp_id)
+        if isinstance(authed, Profile):
+            if authed.exp_id != e.exp_id:
+                abort(403)
+        elif e.exp_id not in authed.exp_ids:
+            abort(403)
+
+        filtered_query = Result.objects.translate_to_jsonable_private(
+            request.args)
+        rresults = authed.accessible_results()(exp_id=e.exp_id)(
+            **filtered_query)
+
+        # Resume after a result already received. Results created at the
+        # same time as it come again, since they have no order among them.
+        after_id = request.args.get('after_id', None)
+        if after_id is not None:
+            after = rresults._collection.find_one(
+                dict(rresults._query, result_id=after_id),
+                {'created_at': True})
+            if after is None:
+                raise ParsingError
+            rresults = rresults(__raw__={'$and': [
+                {'created_at': {'$gte': after['created_at']}},
+                {'_id': {'$ne': after['_id']}}]})
+
+        # Read from the created_at indexes, oldest first so that resuming
+        # continues with newer results
+        jsonables = (rresults.order_by('created_at')
+                     .batch_size(current_app.config['EXPORT_BATCH_SIZE'])
+                     .iter_jsonable_private())
+        # Query errors are raised before the response starts
+        try:
+            jsonables = chain([next(jsonables)], jsonables)
+        except StopIteration:
+            jsonables = []
+
+        # Clients can refuse gzip explicitly, with a quality of 0
+        compress = request.accept_encodings['gzip'] > 0
+        resp = current_app.response_class(
+            stream_with_context(stream_ndjson(jsonables, compress)),
+            mimetype='application/x-ndjson')
+        if compress:
+            resp.headers['Content-Encoding'] = 'gzip'
+        resp.headers['Vary'] = 'Accept-Encoding'
+        # Resuming is done with `after_id`, since the bytes sent depend on
+        # the results present when the request is made
+        resp.headers['Accept-Ranges'] = 'none'
+        resp.headers['Content-Disposition'] = (
+            'attachment; filename=results-{}.ndjson'.format(e.exp_id))
+        return resp
+
+    @cors()
+    def options(self, exp_id):
+        pass
+
+
+exps.add_url_rule(
+    '/<exp_id>/results/export',
+    view_func=ExpResultsExportView.as_view('exp_results_export'))
+
+
 @exps.errorhandler(CollaboratorNotFoundError)
 @cors()
 def collaborator_not_found(error):
@@ -265,6 +375,33 @@ def query_too_deep(error):
                    'message': 'Query parameter is too deep'}}), 400
 
 
+@exps.errorhandler(MalformedSignatureError)
+@cors()
+def malformed_signature(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'Malformed',
+                   'message': 'Request body is malformed'}}), 400
+
+
+@exps.errorhandler(ProfileNotFoundError)
+@cors()
+def profile_does_not_exist(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'ProfileNotFound',
+                   'message': 'The requested profile was not found'}}), 400
+
+
+@exps.errorhandler(BadSignatureError)
+@cors()
+def bad_signature(error):
+    return jsonify(
+        {'error': {'status_code': 403,
+                   'type': 'BadSignature',
+                   'message': 'The signature is invalid'}}), 403
+
+
 @exps.errorhandler(401)
 @cors()
 def unauthenticated(error):
@@ -274,6 +411,16 @@ def unauthenticated(error):
                    'message': 'Request requires authentication'}}), 401
 
 
+@exps.errorhandler(403)
+@cors()
+def unauthorized(error):
+    return jsonify(
+        {'error': {'status_code': 403,
+                   'type': 'Unauthorized',
+                   'message': ('You do not have access '
+                               'to this resource')}}), 403
+
+
 @exps.errorhandler(DoesNotExist)
 @cors()
 def does_not_exist(error):
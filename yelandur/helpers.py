@@ -1,33 +1,61 @@
 # -*- coding: utf-8 -*-
 
 import re
-from collections import MutableSet
+import os
+import atexit
+from collections import MutableSet, OrderedDict
+from multiprocessing import Pool
 from functools import partial
 from datetime import datetime
 from hashlib import md5, sha256
 import random
 import time
 import json
+import zlib
 from contextlib import contextmanager
 import unittest
 
-from flask import Flask, current_app
+from flask import Flask, current_app, request, stream_with_context
+from flask.json import dumps as json_dumps
+from werkzeug.urls import url_encode
+from bson import json_util
+from pymongo import ASCENDING
 from mongoengine.queryset import QuerySet
 from mongoengine import (IntField, StringField, ListField, FloatField,
-                         EmailField, ComplexDateTimeField, DateTimeField)
+                         EmailField, ComplexDateTimeField, DateTimeField,
+                         BooleanField, EmbeddedDocumentField,
+                         NotUniqueError, OperationError)
 import jws
 from jws.utils import base64url_decode, base64url_encode
 from ecdsa.util import (sigdecode_der, sigencode_der,
                         sigdecode_string, sigencode_string)
 from ecdsa import VerifyingKey
+from ecdsa.der import UnexpectedDER
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import (
+        load_pem_public_key)
+except ImportError:
+    load_pem_public_key = None
 
 
 hexregex = r'^[0-9a-f]*$'
 nameregex = r'^[a-zA-Z]([a-zA-Z0-9_.-]?[a-zA-Z0-9]+)*$'
 iso8601 = r'%Y-%m-%dT%H:%M:%S.%fZ'
 iso8601_seconds = r'%Y-%m-%dT%H:%M:%SZ'
+# Signature algorithms of the ECDSA keys of profiles and devices
+jose_algs = ['ES256', 'ES384', 'ES512']
 dot_code = '&dot;'
 and_code = '&and;'
+# Number of parsed verifying keys kept in memory
+VK_CACHE_SIZE = 4096
+# Number of translated query shapes kept in memory
+TRANSLATION_CACHE_SIZE = 1024
+# Number of items sent in each fragment of a streamed JSON list
+STREAM_FRAGMENT_SIZE = 100
 
 
 def md5hex(s):
@@ -175,25 +203,145 @@ class BadSignatureError(Exception):
     pass
 
 
-# TODO: test
-def is_jose_sig_valid(b64_jpayload, jose_sig, vk_pem):
-    jpayload = b64url_dec(b64_jpayload, MalformedSignatureError)
+class EcdsaVerifier(object):
+
+    """Pure-python signature verification with python-jws and python-ecdsa."""
+
+    name = 'ecdsa'
+
+    def load_key(self, vk_pem):
+        return VerifyingKey.from_pem(vk_pem)
+
+    def verify(self, vk, jheader, jpayload, sig_der):
+        vk_order = vk.curve.order
+        b64_sig_string = base64url_encode(sig_der_to_string(sig_der,
+                                                            vk_order))
+        try:
+            jws.verify(jheader, jpayload, b64_sig_string, vk, is_json=True)
+            return True
+        except jws.SignatureError:
+            return False
+
+
+class OpenSSLVerifier(object):
+
+    """Signature verification through OpenSSL, with `cryptography`."""
+
+    name = 'openssl'
+
+    def __init__(self):
+        if load_pem_public_key is None:
+            raise ImportError('OpenSSLVerifier needs the cryptography package')
+        self.backend = default_backend()
+        self.alg_hashes = {'ES256': hashes.SHA256,
+                           'ES384': hashes.SHA384,
+                           'ES512': hashes.SHA512}
+
+    def load_key(self, vk_pem):
+        return load_pem_public_key(str(vk_pem), self.backend)
+
+    def verify(self, vk, jheader, jpayload, sig_der):
+        alg = json.loads(jheader).get('alg')
+        if alg not in self.alg_hashes:
+            raise jws.AlgorithmNotImplemented(
+                '"{}" not implemented.'.format(alg))
+
+        # Same signing input as python-jws
+        signing_input = '{}.{}'.format(base64url_encode(jheader),
+                                       base64url_encode(jpayload))
+        try:
+            vk.verify(sig_der, signing_input,
+                      ec.ECDSA(self.alg_hashes[alg]()))
+            return True
+        except InvalidSignature:
+            return False
+
+
+def available_verifiers():
+    verifiers = [EcdsaVerifier()]
+    if load_pem_public_key is not None:
+        verifiers.insert(0, OpenSSLVerifier())
+    return verifiers
+
+
+class VerifyingKeyCache(object):
+
+    """LRU cache of parsed verifying keys, indexed by their PEM.
+
+    Profile and device ids are hashes of their PEM, so the PEM itself
+    identifies a key just as well without hashing it again.
+
+    """
+
+    def __init__(self, maxsize, loader=VerifyingKey.from_pem):
+        self.maxsize = maxsize
+        self.loader = loader
+        self.clear()
 
+    def clear(self):
+        self._keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, vk_pem):
+        try:
+            vk = self._keys.pop(vk_pem)
+            self.hits += 1
+        except KeyError:
+            vk = self.loader(vk_pem)
+            self.misses += 1
+            if len(self._keys) >= self.maxsize:
+                self._keys.popitem(last=False)
+        # (Re-)insert as most recently used
+        self._keys[vk_pem] = vk
+        return vk
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._keys),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+# The fastest available verifier, and its parsed keys
+verifier = available_verifiers()[0]
+vk_cache = VerifyingKeyCache(VK_CACHE_SIZE, verifier.load_key)
+
+
+def set_verifier(new_verifier):
+    global verifier, vk_cache
+    verifier = new_verifier
+    vk_cache = VerifyingKeyCache(VK_CACHE_SIZE, verifier.load_key)
+
+
+def parse_jose_sig(jose_sig):
     b64_jheader = dget(jose_sig, 'protected', MalformedSignatureError)
     jheader = b64url_dec(b64_jheader, MalformedSignatureError)
+    try:
+        header = json.loads(jheader)
+    except ValueError:
+        raise MalformedSignatureError
+    if not isinstance(header, dict) or header.get('alg') not in jose_algs:
+        raise MalformedSignatureError
 
     b64_sig = dget(jose_sig, 'signature', MalformedSignatureError)
     sig_der = b64url_dec(b64_sig, MalformedSignatureError)
+    try:
+        sigdecode_der(sig_der, None)
+    except Exception:
+        # python-ecdsa's DER parser fails with all sorts of exceptions
+        raise MalformedSignatureError
 
-    vk = VerifyingKey.from_pem(vk_pem)
-    vk_order = vk.curve.order
-    b64_sig_string = base64url_encode(sig_der_to_string(sig_der, vk_order))
+    return jheader, sig_der
 
-    try:
-        jws.verify(jheader, jpayload, b64_sig_string, vk, is_json=True)
-        return True
-    except jws.SignatureError:
-        return False
+
+# TODO: test
+def is_jose_sig_valid(b64_jpayload, jose_sig, vk_pem):
+    jpayload = b64url_dec(b64_jpayload, MalformedSignatureError)
+    jheader, sig_der = parse_jose_sig(jose_sig)
+    return verifier.verify(vk_cache.get(vk_pem), jheader, jpayload, sig_der)
 
 
 # TODO: test
@@ -208,15 +356,65 @@ def is_jws_sig_valid(b64_jws_sig, vk_pem):
     jbody = b64url_dec(jbody_b64)
     sig_der = b64url_dec(sig_der_b64)
 
-    vk = VerifyingKey.from_pem(vk_pem)
-    vk_order = vk.curve.order
-    sig_string_b64 = base64url_encode(sig_der_to_string(sig_der, vk_order))
+    return verifier.verify(vk_cache.get(vk_pem), jheader, jbody, sig_der)
+
 
+# What verifiers raise on signatures they can't parse
+verify_errors = (MalformedSignatureError, ValueError, UnexpectedDER,
+                 jws.AlgorithmNotImplemented)
+
+
+def _check_jose_sig(sig_check):
+    # Also run in pool workers, where an exception would fail all the
+    # verifications of the map
     try:
-        jws.verify(jheader, jbody, sig_string_b64, vk, is_json=True)
-        return True
-    except jws.SignatureError:
-        return False
+        return is_jose_sig_valid(*sig_check)
+    except verify_errors:
+        return None
+
+
+# Process pool for independent signature verifications, created lazily in
+# each (possibly forked) process that needs it
+_verify_pools = {}
+
+
+def get_verify_pool():
+    processes = current_app.config.get('SIGNATURE_VERIFY_PROCESSES', 0)
+    if processes < 2:
+        return None
+
+    pid = os.getpid()
+    if pid not in _verify_pools:
+        _verify_pools.clear()
+        _verify_pools[pid] = Pool(processes)
+    return _verify_pools[pid]
+
+
+@atexit.register
+def close_verify_pool():
+    """Stop the verification pool of this process, if it has one. Pools
+    inherited from a parent process are only forgotten."""
+
+    pool = _verify_pools.pop(os.getpid(), None)
+    _verify_pools.clear()
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+def are_jose_sigs_valid(sig_checks):
+    """Verify a list of independent `(b64_jpayload, jose_sig, vk_pem)`.
+
+    Returns True or False for each signature, or None if it is malformed.
+    Verifications are spread over a process pool when the app sets
+    `SIGNATURE_VERIFY_PROCESSES`, and run in turn otherwise.
+
+    """
+
+    pool = get_verify_pool() if len(sig_checks) > 1 else None
+    if pool is None:
+        return [_check_jose_sig(sig_check) for sig_check in sig_checks]
+    return pool.map(_check_jose_sig, sig_checks)
 
 
 def wipe_test_database(*collections):
@@ -228,7 +426,7 @@ def wipe_test_database(*collections):
         raise ValueError("MONGODB_SETTINGS['db'] does not end with '_test'."
                          " I won't risk wiping a production database.")
 
-    from .models import User, Exp, Device, Profile, Result
+    from .models import User, Exp, Device, Profile, Result, ResultJob
     User.drop_collection()
     User.ensure_indexes()
     Exp.drop_collection()
@@ -239,6 +437,8 @@ def wipe_test_database(*collections):
     Profile.ensure_indexes()
     Result.drop_collection()
     Result.ensure_indexes()
+    ResultJob.drop_collection()
+    ResultJob.ensure_indexes()
 
     for collection in collections:
         collection.drop_collection()
@@ -407,6 +607,15 @@ class APITestCase(unittest.TestCase):
                          load_json_resp=load_json_resp)
 
 
+def build_bulk_write_exception(write_error):
+    # Same translation as the one done by mongoengine's Document.save()
+    if write_error['code'] in (11000, 11001):
+        return NotUniqueError(u'Tried to save duplicate unique keys '
+                              '({})'.format(write_error['errmsg']))
+    return OperationError(u'Could not save document '
+                          '({})'.format(write_error['errmsg']))
+
+
 class ComputedSaveMixin(object):
 
     def save(self, *args, **kwargs):
@@ -518,14 +727,18 @@ class JSONIterableMixin(TypeStringParserMixin):
                         'startswith', 'istartswith', 'endswith', 'iendswith']
     queriable_types = [int, float, str, datetime, list]
     orderable_types = [int, float, str, datetime]
+    # Translated queries and orders, see _get_translation()
+    _translations = {}
 
     def _to_jsonable(self, pre_type_string):
-        res = []
+        return list(self._iter_jsonable(pre_type_string))
 
+    def _iter_jsonable(self, pre_type_string):
         for item in self.__iter__():
-            res.append(item._to_jsonable(pre_type_string))
+            yield item._to_jsonable(pre_type_string)
 
-        return res
+    def _project(self, pre_type_string):
+        return self
 
     def _parse_query_parts(self, pre_type_string, query_dict):
         type_string = self._find_type_string(pre_type_string, self._document)
@@ -550,6 +763,11 @@ class JSONIterableMixin(TypeStringParserMixin):
 
     @classmethod
     def _validate_query_item(self, key, value, attr_type, list_attr_type=None):
+        self._validate_query_key(key, attr_type, list_attr_type)
+        return self._parse_query_value(value, attr_type, list_attr_type)
+
+    @classmethod
+    def _validate_query_key(self, key, attr_type, list_attr_type=None):
         # Query depth
         parts = key.split('__')
         if len(parts) > 2:
@@ -577,42 +795,32 @@ class JSONIterableMixin(TypeStringParserMixin):
                       (list_attr_type == str or list_attr_type is None)))):
                 raise BadQueryType
 
+    @classmethod
+    def _parse_query_value(self, value, attr_type, list_attr_type=None):
+        if attr_type == list:
+            attr_type = list_attr_type
+
         # Un-parsable int or float
-        for number in [int, float]:
-            if attr_type == number or (attr_type == list and
-                                       list_attr_type == number):
-                try:
-                    number(value)
-                except ValueError, msg:
-                    raise ParsingError(msg)
-
-        # Un-parsable datetime
-        if attr_type == datetime or (attr_type == list and
-                                     list_attr_type == datetime):
-            parsed = False
+        if attr_type in (int, float):
             try:
-                int(value)
-                parsed = True
-            except ValueError:
-                pass
-            try:
-                float(value)
-                parsed = True
-            except ValueError:
-                pass
-            try:
-                datetime.strptime(value, iso8601)
-                parsed = True
-            except ValueError:
-                pass
+                return attr_type(value)
+            except ValueError, msg:
+                raise ParsingError(msg)
+
+        # Un-parsable datetime, given as a timestamp or an ISO-8601 string
+        if attr_type == datetime:
             try:
-                datetime.strptime(value, iso8601_seconds)
-                parsed = True
-            except ValueError:
+                return datetime.utcfromtimestamp(float(value))
+            except (ValueError, OverflowError):
                 pass
+            for date_format in (iso8601, iso8601_seconds):
+                try:
+                    return datetime.strptime(value, date_format)
+                except ValueError:
+                    pass
+            raise ParsingError("Couldn't parse timestamp")
 
-            if not parsed:
-                raise ParsingError("Couldn't parse timestamp")
+        return value
 
     def _validate_query(self, includes, query_parts):
         for preinc in includes:
@@ -652,6 +860,73 @@ class JSONIterableMixin(TypeStringParserMixin):
 
         return translated_query
 
+    def _get_translation(self, key, compile_translation):
+        # Translations are cached by document, type string and query shape
+        key = (self._document,) + key
+        try:
+            return self._translations[key]
+        except KeyError:
+            pass
+
+        translation = compile_translation()
+        if len(self._translations) >= TRANSLATION_CACHE_SIZE:
+            self._translations.clear()
+        self._translations[key] = translation
+        return translation
+
+    def _compile_query_translation(self, pre_type_string, keys):
+        # Same as _validate_query() and _translate_to() but without the
+        # values: the steps to translate any query with these keys, and the
+        # error the key raises if any
+        includes, query_parts = self._parse_query_parts(
+            pre_type_string, dict.fromkeys(keys))
+
+        steps = []
+        for preinc in includes:
+            inc = self._parse_preinc(preinc)
+            # Don't take queries on regexps
+            if self._is_regex(inc[0]):
+                continue
+            if inc[1] in query_parts:
+                for subquery, value in query_parts[inc[1]]:
+                    field = self._document._fields[inc[0]]
+                    tipe = self.mongo_py_type_map.get(type(field),
+                                                      NonQueriableType)
+                    if tipe == list:
+                        list_tipe = self.mongo_py_type_map.get(
+                            type(field.field), NonQueriableType)
+                    else:
+                        list_tipe = None
+                    try:
+                        self._validate_query_key(inc[1] + subquery, tipe,
+                                                 list_tipe)
+                        error = None
+                    except ValueError, e:
+                        error = e
+                    steps.append((inc[1] + subquery, inc[0] + subquery,
+                                  tipe, list_tipe, error))
+        return steps
+
+    def _translate_query(self, pre_type_string, query_dict):
+        keys = tuple(sorted(query_dict.keys()))
+        steps = self._get_translation(
+            ('query', pre_type_string, keys),
+            partial(self._compile_query_translation, pre_type_string, keys))
+
+        translated_query = {}
+        for key, mongo_key, tipe, list_tipe, error in steps:
+            if error is not None:
+                raise error
+            translated_query[mongo_key] = self._parse_query_value(
+                query_dict[key], tipe, list_tipe)
+        return translated_query
+
+    def _compile_order_translation(self, pre_type_string, query_multi_dict):
+        incmap, order_parts = self._parse_order_parts(pre_type_string,
+                                                      query_multi_dict)
+        self._validate_order(incmap, order_parts)
+        return self._translate_order_to(incmap, order_parts)
+
     def _parse_order_parts(self, pre_type_string, query_multi_dict):
         type_string = self._find_type_string(pre_type_string, self._document)
         includes = self._get_includes(type_string, self._document)
@@ -722,13 +997,22 @@ class JSONIterableMixin(TypeStringParserMixin):
         # Return bound method
         return to_jsonable.__get__(self, JSONIterableMixin)
 
+    def _build_iter_jsonable(self, pre_type_string):
+        def iter_jsonable(self):
+            return self._iter_jsonable(pre_type_string)
+        # Return bound method
+        return iter_jsonable.__get__(self, JSONIterableMixin)
+
+    def _build_only(self, pre_type_string):
+        def only(self):
+            return self._project(pre_type_string)
+        # Return bound method
+        return only.__get__(self, JSONIterableMixin)
+
     def _build_translate_to(self, pre_type_string):
         def translate_to(self, query_dict):
             try:
-                includes, query_parts = self._parse_query_parts(
-                    pre_type_string, query_dict)
-                self._validate_query(includes, query_parts)
-                return self._translate_to(includes, query_parts)
+                return self._translate_query(pre_type_string, query_dict)
             except EmptyJsonableException:
                 return None
         # Return bound method
@@ -736,21 +1020,28 @@ class JSONIterableMixin(TypeStringParserMixin):
 
     def _build_translate_order_to(self, pre_type_string):
         def translate_order_to(self, query_dict):
+            orders = tuple(query_dict.getlist('order'))
             try:
-                incmap, order_parts = self._parse_order_parts(
-                    pre_type_string, query_dict)
-                self._validate_order(incmap, order_parts)
-                return self._translate_order_to(incmap, order_parts)
+                return list(self._get_translation(
+                    ('order', pre_type_string, orders),
+                    partial(self._compile_order_translation,
+                            pre_type_string, query_dict)))
             except EmptyJsonableException:
                 return None
         # Return bound method
         return translate_order_to.__get__(self, JSONDocumentMixin)
 
     def __getattribute__(self, name):
-        # Catch 'to_*' and 'translate_to_*' calls
+        # Catch 'to_*', 'iter_*', 'only_*' and 'translate_to_*' calls
         if name != 'to_mongo' and len(name) >= 4:
             if name[:3] == 'to_' and name[2:] in self._document.__dict__:
                 return self._build_to_jsonable(name[2:])
+            elif (name[:5] == 'iter_'
+                  and name[4:] in self._document.__dict__):
+                return self._build_iter_jsonable(name[4:])
+            elif (name[:5] == 'only_'
+                  and name[4:] in self._document.__dict__):
+                return self._build_only(name[4:])
             elif (name[:13] == 'translate_to_'
                   and name[12:] in self._document.__dict__):
                 return self._build_translate_to(name[12:])
@@ -760,10 +1051,466 @@ class JSONIterableMixin(TypeStringParserMixin):
         return object.__getattribute__(self, name)
 
 
-class JSONQuerySet(JSONIterableMixin, QuerySet):
+class RawFallback(Exception):
     pass
 
 
+def _raw_check_no_cls(value):
+    # Hydration turns any dict with a '_cls' into a document
+    if isinstance(value, dict):
+        if '_cls' in value:
+            raise RawFallback
+        for item in value.itervalues():
+            _raw_check_no_cls(item)
+    elif isinstance(value, list):
+        for item in value:
+            _raw_check_no_cls(item)
+
+
+def _raw_hydrate():
+    raise RawFallback
+
+
+def _raw_jsonablize(value):
+    # Same as JSONDocumentMixin._jsonablize_value() on a dynamic value
+    if isinstance(value, list):
+        return [_raw_jsonablize(item) for item in value]
+    elif isinstance(value, dict):
+        _raw_check_no_cls(value)
+        return value
+    elif isinstance(value, datetime):
+        return value.strftime(iso8601)
+    else:
+        return value
+
+
+class JSONQuerySet(JSONIterableMixin, QuerySet):
+
+    # Plans to serialize raw pymongo documents, by (document class,
+    # pre_type_string). None if the documents must be hydrated.
+    _raw_plans = {}
+    raw_field_types = (StringField, IntField, FloatField, BooleanField)
+    # Fields to load to serialize documents, by (document class,
+    # pre_type_string). None if all the fields must be loaded.
+    _projections = {}
+    # Number of documents per batch fetched by the cursor, None for the
+    # server default
+    _batch_size = None
+
+    def batch_size(self, size):
+        """Fetch documents from the server by batches of `size`."""
+        queryset = self.clone()
+        queryset._batch_size = size
+        return queryset
+
+    def clone_into(self, cls):
+        queryset = super(JSONQuerySet, self).clone_into(cls)
+        queryset._batch_size = self._batch_size
+        return queryset
+
+    @property
+    def _cursor(self):
+        if self._cursor_obj is None:
+            cursor = super(JSONQuerySet, self)._cursor
+            if self._batch_size is not None:
+                cursor.batch_size(self._batch_size)
+        return super(JSONQuerySet, self)._cursor
+
+    def _iter_jsonable(self, pre_type_string):
+        key = (self._document, pre_type_string)
+        if key not in self._raw_plans:
+            self._raw_plans[key] = self._compile_raw_plan(pre_type_string)
+        plan = self._raw_plans[key]
+
+        # Querysets restricted with .only() or .exclude() are hydrated to
+        # get the usual defaults for the fields left out
+        if plan is None or self._loaded_fields:
+            hydrated = self._project(pre_type_string).clone()
+            # Iterating the queryset itself would cache all the documents
+            while True:
+                try:
+                    doc = hydrated.next()
+                except StopIteration:
+                    return
+                yield doc._to_jsonable(pre_type_string)
+        if self._none or self._limit == 0:
+            return
+
+        steps, field_names = plan
+        for son in self.only(*field_names)._cursor:
+            try:
+                yield self._raw_to_jsonable(steps, son)
+            except RawFallback:
+                doc = self._document._from_son(son)
+                yield doc._to_jsonable(pre_type_string)
+
+    def _project(self, pre_type_string):
+        # Restrict to the fields serialized by `pre_type_string`, unless
+        # the queryset is already restricted
+        key = (self._document, pre_type_string)
+        if key not in self._projections:
+            self._projections[key] = self._compile_projection(
+                pre_type_string)
+        field_names = self._projections[key]
+
+        if not field_names or self._loaded_fields:
+            return self
+        return self.only(*field_names)
+
+    def _compile_projection(self, pre_type_string):
+        # Regexes can match any attribute, and attributes that aren't
+        # fields (properties and the like) can read any field
+        try:
+            type_string = self._find_type_string(pre_type_string,
+                                                 self._document)
+        except AttributeError:
+            return None
+
+        field_names = []
+        for preinc in self._get_includes(type_string, self._document):
+            inc = self._parse_preinc(preinc)
+            if self._is_regex(inc[0]):
+                return None
+            name = self._parse_deep_attr_name(inc[0])[0]
+            if name not in self._document._fields:
+                return None
+            if name not in field_names:
+                field_names.append(name)
+        return field_names
+
+    def paginate(self, limit, after=None):
+        """Restrict to the `limit` documents following the `after` cursor,
+        in the order of the queryset with ties broken by `_id`.
+
+        Returns the restricted queryset, and the cursor to its last document
+        if more documents follow (None otherwise)."""
+
+        if self._none:
+            return self, None
+
+        sort = self._page_sort()
+        queryset = self.clone()
+        queryset._ordering = sort
+        if after is not None:
+            values = self._decode_cursor(sort, after)
+            queryset = queryset.filter(
+                __raw__=self._keyset_query(sort, values))
+
+        # Only the sort keys are read to find the page, one more document
+        # telling if there is a next page
+        projection = dict((key, True) for key, direction in sort)
+        sons = list(queryset._collection.find(queryset._query, projection)
+                    .sort(sort).limit(limit + 1))
+        page = queryset.filter(id__in=[son['_id'] for son in sons[:limit]])
+
+        if len(sons) <= limit:
+            return page, None
+        return page, self._encode_cursor(sort, sons[limit - 1])
+
+    def _page_sort(self):
+        # Models index their orderings followed by `_id`, so pages are read
+        # from an index without sorting in memory
+        sort = list(self._ordering or
+                    self._get_order_by(self._document._meta['ordering']))
+        if '_id' not in [key for key, direction in sort]:
+            sort.append(('_id', ASCENDING))
+        return sort
+
+    @classmethod
+    def _encode_cursor(cls, sort, son):
+        keyset = [[key, son.get(key)] for key, direction in sort]
+        return base64url_encode(json_util.dumps(keyset))
+
+    @classmethod
+    def _decode_cursor(cls, sort, after):
+        try:
+            keyset = json_util.loads(b64url_dec(after))
+            keys = [key for key, value in keyset]
+        except (TypeError, ValueError, UnicodeError):
+            raise ParsingError
+        # Cursors only work with the order they were made for, and only
+        # hold plain values (no query operators)
+        if keys != [key for key, direction in sort]:
+            raise ParsingError
+        values = [value for key, value in keyset]
+        if any(isinstance(value, (dict, list)) for value in values):
+            raise ParsingError
+        return values
+
+    @classmethod
+    def _keyset_query(cls, sort, values):
+        # Documents coming after `values` in `sort` order. Nulls (and
+        # missing fields) come first in ascending order.
+        clauses = []
+        for i, (key, direction) in enumerate(sort):
+            clause = dict((k, v) for (k, d), v in zip(sort[:i], values[:i]))
+            value = values[i]
+            if direction == ASCENDING:
+                if value is None:
+                    clause[key] = {'$ne': None}
+                else:
+                    clause[key] = {'$gt': value}
+            elif value is None:
+                # Nothing comes after nulls in descending order
+                continue
+            else:
+                clause['$or'] = [{key: {'$lt': value}}, {key: None}]
+            clauses.append(clause)
+        return {'$or': clauses}
+
+    def _raw_to_jsonable(self, steps, son):
+        if len(steps) == 0:
+            raise EmptyJsonableException
+
+        res = {}
+        for db_field, key, convert, default in steps:
+            value = son.get(db_field)
+            if value is None:
+                res[key] = default()
+                continue
+            try:
+                res[key] = convert(value)
+            except EmptyJsonableException:
+                pass
+        return res
+
+    def _compile_raw_plan(self, pre_type_string):
+        # Documents qualify if they only include fields by name, of types
+        # that _raw_converter() knows to serialize like hydration does
+        try:
+            type_string = self._find_type_string(pre_type_string,
+                                                 self._document)
+        except AttributeError:
+            return None
+
+        steps = []
+        field_names = []
+        for preinc in self._get_includes(type_string, self._document):
+            inc = self._parse_preinc(preinc)
+            if self._is_regex(inc[0]) or '__' in inc[0]:
+                return None
+            field = self._document._fields.get(inc[0])
+            if field is None:
+                return None
+            convert = self._raw_converter(field, type_string)
+            if convert is None:
+                return None
+            steps.append((field.db_field, inc[1], convert,
+                          self._raw_default(field)))
+            field_names.append(inc[0])
+        return steps, field_names
+
+    def _raw_default(self, field):
+        # Hydration replaces missing and null values with the field default
+        if field.default is None:
+            if isinstance(field, ComplexDateTimeField):
+                # Which complex datetimes turn into the current time
+                return _raw_hydrate
+            return lambda: None
+
+        def default():
+            value = field.default
+            if callable(value):
+                value = value()
+            if isinstance(value, JSONDocumentMixin):
+                raise RawFallback
+            return _raw_jsonablize(value)
+        return default
+
+    def _raw_converter(self, field, type_string):
+        if isinstance(field, (ComplexDateTimeField, DateTimeField)):
+            return lambda value: field.to_python(value).strftime(iso8601)
+        elif isinstance(field, self.raw_field_types):
+            return field.to_python
+        elif isinstance(field, ListField) and field.field is not None:
+            convert = self._raw_converter(field.field, type_string)
+            if convert is None:
+                return None
+            return lambda value: [convert(item) for item in value]
+        elif isinstance(field, EmbeddedDocumentField):
+            plan = self._compile_raw_dynamic_plan(field.document_type,
+                                                  type_string)
+            if plan is None:
+                return None
+            return partial(self._raw_dynamic_to_jsonable, plan)
+        else:
+            return None
+
+    def _compile_raw_dynamic_plan(self, document, pre_type_string):
+        # Embedded documents qualify if they are dynamic and only include
+        # their attributes through regexes that don't match the attributes
+        # mongoengine sets on its instances
+        if not document._dynamic:
+            return None
+        try:
+            type_string = self._find_type_string(pre_type_string, document)
+        except AttributeError:
+            return None
+
+        proto = document()
+        regexes = []
+        for preinc in self._get_includes(type_string, document):
+            inc = self._parse_preinc(preinc)
+            if not self._is_regex(inc[0]):
+                return None
+            regex = re.compile(self._get_regex_string(inc[0]))
+            if any(regex.search(name) for name in proto.__dict__):
+                return None
+            regexes.append((regex, inc[1]))
+
+        postprocess = getattr(proto, 'json_postprocess', lambda x, s: x)
+        return type_string, regexes, set(dir(document)), postprocess
+
+    def _raw_dynamic_to_jsonable(self, plan, value):
+        type_string, regexes, class_names, postprocess = plan
+        if len(regexes) == 0:
+            raise EmptyJsonableException
+        if '_cls' in value:
+            raise RawFallback
+
+        # Deep attribute names and names shadowing the class are left to
+        # hydration
+        for name in value:
+            if '__' in name or name in class_names:
+                raise RawFallback
+
+        res = {}
+        for regex, key_template in regexes:
+            for name, item in value.iteritems():
+                r = regex.search(name)
+                if r:
+                    res[r.expand(key_template)] = _raw_jsonablize(item)
+        return postprocess(res, type_string)
+
+
+def json_format():
+    """Formatting arguments for the JSON in responses: compact if
+    JSONIFY_COMPACT is set, pretty-printed like `flask.jsonify()` otherwise."""
+
+    if current_app.config['JSONIFY_COMPACT']:
+        return {'separators': (',', ':')}
+    if (current_app.config['JSONIFY_PRETTYPRINT_REGULAR']
+            and not request.is_xhr):
+        return {'indent': 2}
+    return {}
+
+
+def jsonify(*args, **kwargs):
+    """Same as `flask.jsonify()`, formatted by `json_format()`."""
+    return current_app.response_class(
+        json_dumps(dict(*args, **kwargs), **json_format()),
+        mimetype='application/json')
+
+
+def get_page_args():
+    """Parse the `limit` and `after` URL parameters of a list request,
+    `limit` defaulting to and being capped at MAX_PAGE_SIZE."""
+
+    max_page_size = current_app.config['MAX_PAGE_SIZE']
+    limit = request.args.get('limit')
+    try:
+        limit = int(limit) if limit is not None else max_page_size
+    except ValueError:
+        raise ParsingError
+    if limit < 1:
+        raise ParsingError
+    return min(limit, max_page_size), request.args.get('after')
+
+
+def jsonify_list(key, jsonables, after=None):
+    """Like `jsonify({key: list(jsonables)})`, but streams the list as it
+    is iterated if STREAM_JSON_LISTS is set. If there is a next page, its
+    URL (with the `after` cursor) is given in a `Link` header.
+
+    The first item is serialized before answering so that a failing query
+    still gets its usual error response. Like `to_*` calls, a type string
+    with nothing to include gives a null list."""
+
+    resp = _jsonify_list(key, jsonables)
+    if after is not None:
+        args = request.args.copy()
+        args['after'] = after
+        resp.headers['Link'] = '<{}?{}>; rel="next"'.format(
+            request.base_url, url_encode(args))
+    return resp
+
+
+def _jsonify_list(key, jsonables):
+    jsonables = iter(jsonables)
+    if not current_app.config['STREAM_JSON_LISTS']:
+        try:
+            return jsonify({key: list(jsonables)})
+        except EmptyJsonableException:
+            return jsonify({key: None})
+
+    try:
+        first = next(jsonables)
+    except StopIteration:
+        return jsonify({key: []})
+    except EmptyJsonableException:
+        return jsonify({key: None})
+
+    fragments = _stream_list(key, first, jsonables, json_format())
+    return current_app.response_class(stream_with_context(fragments),
+                                      mimetype='application/json')
+
+
+def _stream_list(key, first, jsonables, fmt):
+    # json.dumps() keeps its default separators when indenting
+    item_sep, key_sep = fmt.get('separators', (', ', ': '))
+    indent = fmt.get('indent')
+    if indent is None:
+        pad = ''
+        head = '{' + json_dumps(key) + key_sep + '['
+        sep = item_sep
+        tail = ']}'
+    else:
+        pad = ' ' * (2 * indent)
+        head = '{\n' + pad[indent:] + json_dumps(key) + key_sep + '[\n' + pad
+        sep = item_sep + '\n' + pad
+        tail = '\n' + pad[indent:] + ']\n}'
+
+    def dump(item):
+        # Newlines only come from the indentation, strings escape theirs
+        return json_dumps(item, **fmt).replace('\n', '\n' + pad)
+
+    fragment = [head, dump(first)]
+    for item in jsonables:
+        fragment.extend([sep, dump(item)])
+        if len(fragment) >= 2 * STREAM_FRAGMENT_SIZE:
+            yield ''.join(fragment)
+            fragment = []
+    fragment.append(tail)
+    yield ''.join(fragment)
+
+
+def stream_ndjson(jsonables, compress=False):
+    """Serialize `jsonables` as newline-delimited JSON, in fragments of
+    STREAM_FRAGMENT_SIZE items, gzipped if `compress` is set.
+
+    Compressed fragments are flushed as they are sent, so a client can
+    decompress everything it received if the stream is cut."""
+
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    lines = []
+    for item in jsonables:
+        lines.append(json_dumps(item, separators=(',', ':')))
+        lines.append('\n')
+        if len(lines) >= 2 * STREAM_FRAGMENT_SIZE:
+            fragment = ''.join(lines)
+            lines = []
+            if compress:
+                fragment = (compressor.compress(fragment) +
+                            compressor.flush(zlib.Z_SYNC_FLUSH))
+            yield fragment
+
+    fragment = ''.join(lines)
+    if compress:
+        fragment = compressor.compress(fragment) + compressor.flush()
+    yield fragment
+
+
 # FIXME: unused now, can be deleted
 class JSONSet(JSONIterableMixin, MutableSet):
 
@@ -796,39 +1543,82 @@ class JSONDocumentMixin(TypeStringParserMixin):
 
     meta = {'queryset_class': JSONQuerySet}
 
+    # Serialization plans compiled by _compile_serialization_plan(), by
+    # (document class, pre_type_string)
+    _serialization_plans = {}
+
     def _insert_jsonable(self, type_string, res, inc):
+        has_default = (len(inc) == 3)
+        default = inc[2] if has_default else None
+        self._insert_parts(type_string, res,
+                           self._parse_deep_attr_name(inc[0]), inc[1],
+                           has_default, default)
+
+    def _insert_parts(self, type_string, res, parts, key, has_default,
+                      default):
         try:
-            has_default = (len(inc) == 3)
-            default = inc[2] if has_default else None
-            res[inc[1]] = self._jsonablize(type_string, inc[0],
-                                           has_default=has_default,
-                                           default=default)
+            res[key] = self._jsonablize_parts(type_string, parts,
+                                              has_default, default)
         except EmptyJsonableException:
             pass
 
     def _insert_regex(self, type_string, res, inc):
-        regex = self._get_regex_string(inc[0])
+        regex = re.compile(self._get_regex_string(inc[0]))
+        self._insert_compiled_regex(type_string, res, regex, inc[1])
 
+    def _insert_compiled_regex(self, type_string, res, regex, key_template):
         for attr_name in self.__dict__.iterkeys():
-            r = re.search(regex, attr_name)
+            r = regex.search(attr_name)
             if r:
-                self._insert_jsonable(type_string, res,
-                                      (attr_name, r.expand(inc[1])))
+                self._insert_parts(type_string, res,
+                                   self._parse_deep_attr_name(attr_name),
+                                   r.expand(key_template), False, None)
+
+    def _compile_serialization_plan(self, pre_type_string):
+        # Resolve the type_string and parse its includes once, into steps
+        # of (is_regex, attribute parts or compiled regex, output key,
+        # has_default, default)
+        type_string = self._find_type_string(pre_type_string)
+        steps = []
+        for preinc in self._get_includes(type_string):
+            inc = self._parse_preinc(preinc)
+            if self._is_regex(inc[0]):
+                steps.append((True, re.compile(self._get_regex_string(inc[0])),
+                              inc[1], False, None))
+            else:
+                has_default = (len(inc) == 3)
+                steps.append((False, self._parse_deep_attr_name(inc[0]),
+                              inc[1], has_default,
+                              inc[2] if has_default else None))
+        return type_string, steps
+
+    def _get_serialization_plan(self, pre_type_string):
+        key = (self.__class__, pre_type_string)
+        plan = self._serialization_plans.get(key)
+        if plan is None:
+            plan = self._compile_serialization_plan(pre_type_string)
+
+            # Includes set on the instance itself and not its class can't
+            # be shared with the other instances
+            parts = pre_type_string.split('_')
+            if not any('_'.join(parts[:i]) in self.__dict__
+                       for i in xrange(2, len(parts) + 1)):
+                self._serialization_plans[key] = plan
+        return plan
 
     def _to_jsonable(self, pre_type_string):
         res = {}
-        type_string = self._find_type_string(pre_type_string)
-        includes = self._get_includes(type_string)
+        type_string, steps = self._get_serialization_plan(pre_type_string)
 
-        if len(includes) == 0:
+        if len(steps) == 0:
             raise EmptyJsonableException
 
-        for preinc in includes:
-            inc = self._parse_preinc(preinc)
-            if self._is_regex(inc[0]):
-                self._insert_regex(type_string, res, inc)
+        for is_regex, target, key, has_default, default in steps:
+            if is_regex:
+                self._insert_compiled_regex(type_string, res, target, key)
             else:
-                self._insert_jsonable(type_string, res, inc)
+                self._insert_parts(type_string, res, target, key,
+                                   has_default, default)
 
         # TODO: test postprocess
         postprocess = getattr(self, 'json_postprocess', lambda x, s: x)
@@ -840,65 +1630,69 @@ class JSONDocumentMixin(TypeStringParserMixin):
     def _jsonablize(self, type_string, attr_or_name, is_attr_name=True,
                     has_default=False, default=None):
         if is_attr_name:
-            parts = self._parse_deep_attr_name(attr_or_name)
+            return self._jsonablize_parts(
+                type_string, self._parse_deep_attr_name(attr_or_name),
+                has_default, default)
+        else:
+            return self._jsonablize_value(type_string, attr_or_name)
 
-            # Default-filling block
-            try:
-                attr = self.__getattribute__(parts[0])
-            except AttributeError, msg:
-                if has_default:
-                    if default is None:
-                        raise EmptyJsonableException
-                    else:
-                        attr = default
+    def _jsonablize_parts(self, type_string, parts, has_default=False,
+                          default=None):
+        # Default-filling block
+        try:
+            attr = self.__getattribute__(parts[0])
+        except AttributeError, msg:
+            if has_default:
+                if default is None:
+                    raise EmptyJsonableException
                 else:
-                    raise AttributeError(msg)
+                    attr = default
+            else:
+                raise AttributeError(msg)
 
-            if len(parts) == 2:
-                if isinstance(attr, list):
-                    if parts[1] == 'count':
-                        return len(attr)
-                    else:
-                        out = []
-                        for item in attr:
-                            # New default-filling block
-                            try:
-                                sub_attr = item.__getattribute__(parts[1])
-                                out.append(
-                                    self._jsonablize(type_string,
-                                                     sub_attr,
-                                                     is_attr_name=False))
-                            except AttributeError, msg:
-                                if has_default:
-                                    if default is None:
-                                        continue
-                                    else:
-                                        out.append(default)
-                                else:
-                                    raise AttributeError(msg)
-                        return out
+        if len(parts) == 2:
+            if isinstance(attr, list):
+                if parts[1] == 'count':
+                    return len(attr)
                 else:
-                    # Another default-filling block
-                    try:
-                        sub_attr = attr.__getattribute__(parts[1])
-                        return self._jsonablize(type_string, sub_attr,
-                                                is_attr_name=False)
-                    except AttributeError, msg:
-                        if has_default:
-                            if default is None:
-                                raise EmptyJsonableException
+                    out = []
+                    for item in attr:
+                        # New default-filling block
+                        try:
+                            sub_attr = item.__getattribute__(parts[1])
+                            out.append(
+                                self._jsonablize_value(type_string,
+                                                       sub_attr))
+                        except AttributeError, msg:
+                            if has_default:
+                                if default is None:
+                                    continue
+                                else:
+                                    out.append(default)
                             else:
-                                return default
+                                raise AttributeError(msg)
+                    return out
+            else:
+                # Another default-filling block
+                try:
+                    sub_attr = attr.__getattribute__(parts[1])
+                    return self._jsonablize_value(type_string, sub_attr)
+                except AttributeError, msg:
+                    if has_default:
+                        if default is None:
+                            raise EmptyJsonableException
                         else:
-                            raise AttributeError(msg)
+                            return default
+                    else:
+                        raise AttributeError(msg)
 
-        else:
-            attr = attr_or_name
+        return self._jsonablize_value(type_string, attr)
 
+    def _jsonablize_value(self, type_string, attr):
         if isinstance(attr, JSONDocumentMixin):
             return attr._to_jsonable(type_string)
         elif isinstance(attr, list):
-            return [self._jsonablize(type_string, item, is_attr_name=False)
+            return [self._jsonablize_value(type_string, item)
                     for item in attr]
         elif isinstance(attr, datetime):
             return attr.strftime(iso8601)
@@ -906,9 +1700,10 @@ class JSONDocumentMixin(TypeStringParserMixin):
             return attr
 
     def __getattribute__(self, name):
-        # Catch 'to_*' calls
-        if (name != 'to_mongo' and len(name) >= 4 and name[:3] == 'to_'
-                and name[2:] in self.__class__.__dict__):
+        # Catch 'to_*' calls. This runs for every attribute access on
+        # documents, so the cheapest test comes first.
+        if (name[:3] == 'to_' and name != 'to_mongo' and len(name) >= 4
+                and name[2:] in type(self).__dict__):
             return self._build_to_jsonable(name[2:])
         else:
             return object.__getattribute__(self, name)
@@ -4,12 +4,15 @@ from datetime import datetime
 import json
 
 import mongoengine as mge
+from bson import ObjectId
 from mongoengine.queryset import DoesNotExist
+from pymongo.errors import BulkWriteError
 
 from .auth import BrowserIDUserMixin
 from .helpers import (build_gravatar_id, JSONDocumentMixin, sha256hex,
                       random_md5hex, hexregex, nameregex, iso8601,
-                      ComputedSaveMixin, mongo_encode, mongo_decode)
+                      ComputedSaveMixin, mongo_encode, mongo_decode,
+                      build_bulk_write_exception)
 
 
 # Often, before modifying a model, you will encounter a model.reload()
@@ -46,11 +49,15 @@ class UserIdReservedError(ValueError):
     pass
 
 
+class BulkAbortedError(Exception):
+    pass
+
+
 class User(ComputedSaveMixin, mge.Document,
            BrowserIDUserMixin, JSONDocumentMixin):
 
     meta = {'ordering': ['+user_id'],
-            'indexes': ['user_id',
+            'indexes': [('user_id', '_id'),
                         'n_exps',
                         'n_profiles',
                         'n_devices',
@@ -58,8 +65,7 @@ class User(ComputedSaveMixin, mge.Document,
 
     computed_lengths = [('profile_ids', 'n_profiles'),
                         ('device_ids', 'n_devices'),
-                        ('exp_ids', 'n_exps'),
-                        ('result_ids', 'n_results')]
+                        ('exp_ids', 'n_exps')]
     reserved_user_ids = ['new', 'settings']
 
     _jsonable = [('user_id', 'id'),
@@ -83,8 +89,9 @@ class User(ComputedSaveMixin, mge.Document,
     n_devices = mge.IntField(required=True)
     exp_ids = mge.ListField(mge.StringField(regex=hexregex))
     n_exps = mge.IntField(required=True)
-    result_ids = mge.ListField(mge.StringField(regex=hexregex))
-    n_results = mge.IntField(required=True)
+    # Results are not listed on users (the lists grow without bounds), they
+    # are found through the exps in `exp_ids`
+    n_results = mge.IntField(required=True, default=0)
     persona_email = mge.EmailField(unique=True, min_length=3, max_length=50)
 
     def set_user_id(self, user_id):
@@ -98,6 +105,19 @@ class User(ComputedSaveMixin, mge.Document,
         self.user_id_is_set = True
         self.save()
 
+    def can_access_result(self, result):
+        return result.exp_id in self.exp_ids
+
+    def accessible_results(self):
+        # `exp_ids` lists both owned and collaborated exps
+        return Result.objects(exp_id__in=self.exp_ids)
+
+    def can_access_profile(self, profile):
+        return profile.exp_id in self.exp_ids
+
+    def accessible_profiles(self):
+        return Profile.objects(exp_id__in=self.exp_ids)
+
     @classmethod
     def get(cls, user_id):
         try:
@@ -143,6 +163,7 @@ class Exp(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
     meta = {'ordering': ['+owner_id', '+name'],
             'indexes': ['exp_id',
                         'name',
+                        ('owner_id', 'name', '_id'),
                         'n_collaborators',
                         'n_devices',
                         'n_profiles',
@@ -150,7 +171,6 @@ class Exp(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
 
     computed_lengths = [('profile_ids', 'n_profiles'),
                         ('device_ids', 'n_devices'),
-                        ('result_ids', 'n_results'),
                         ('collaborator_ids', 'n_collaborators')]
 
     _jsonable = [('exp_id', 'id'),
@@ -176,8 +196,19 @@ class Exp(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
     n_devices = mge.IntField(required=True)
     profile_ids = mge.ListField(mge.StringField(regex=hexregex))
     n_profiles = mge.IntField(required=True)
-    result_ids = mge.ListField(mge.StringField(regex=hexregex))
-    n_results = mge.IntField(required=True)
+    n_results = mge.IntField(required=True, default=0)
+
+    def member_ids(self):
+        return [self.owner_id] + list(self.collaborator_ids)
+
+    def add_device_id(self, device_id):
+        # Only push to documents that don't have the device yet, so that
+        # the lists and their counts stay in sync without reading anything
+        Exp.objects(exp_id=self.exp_id, device_ids__ne=device_id).update_one(
+            push__device_ids=device_id, inc__n_devices=1)
+        User.objects(user_id__in=self.member_ids(),
+                     device_ids__ne=device_id).update(
+            push__device_ids=device_id, inc__n_devices=1)
 
     @classmethod
     def build_exp_id(cls, name, owner):
@@ -222,7 +253,7 @@ class Exp(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
 class Device(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
 
     meta = {'ordering': ['device_id'],
-            'indexes': ['device_id']}
+            'indexes': [('device_id', '_id')]}
 
     _jsonable = [('device_id', 'id'), 'vk_pem']
     _jsonable_private = []
@@ -264,9 +295,9 @@ class Profile(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
 
     meta = {'ordering': ['n_results'],
             'indexes': ['profile_id',
-                        'n_results']}
-
-    computed_lengths = [('result_ids', 'n_results')]
+                        ('n_results', '_id'),
+                        ('exp_id', 'n_results', '_id'),
+                        'updated_at']}
 
     _jsonable = [('profile_id', 'id'), 'vk_pem']
     _jsonable_private = ['exp_id',
@@ -279,8 +310,25 @@ class Profile(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
     exp_id = mge.StringField(required=True, regex=hexregex)
     data = mge.EmbeddedDocumentField('Data', default=Data)
     device_id = mge.StringField(regex=hexregex)
-    result_ids = mge.ListField(mge.StringField(regex=hexregex))
-    n_results = mge.IntField(required=True)
+    n_results = mge.IntField(required=True, default=0)
+    # Last time any of the above changed, for incremental exports. Unset
+    # on profiles that haven't changed since it was introduced.
+    updated_at = mge.DateTimeField()
+
+    def can_access_result(self, result):
+        return result.profile_id == self.profile_id
+
+    def accessible_results(self):
+        return Result.objects(profile_id=self.profile_id)
+
+    @classmethod
+    def updated_between(cls, since, until):
+        # Profiles created before updated_at existed don't have it, and
+        # haven't changed since then, so they only belong to the first window
+        if since is None:
+            return cls.objects(mge.Q(updated_at__lt=until) |
+                               mge.Q(updated_at=None))
+        return cls.objects(updated_at__gte=since, updated_at__lt=until)
 
     def set_device(self, device):
         try:
@@ -290,26 +338,19 @@ class Profile(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
             pass
 
         self.device_id = device.device_id
+        self.updated_at = datetime.utcnow()
         self.save()
 
-        exp = Exp.objects.get(exp_id=self.exp_id)
-        if device.device_id not in exp.device_ids:
-            exp.device_ids.append(device.device_id)
-            exp.save()
-        owner = User.objects.get(user_id=exp.owner_id)
-        if device.device_id not in owner.device_ids:
-            owner.device_ids.append(device.device_id)
-            owner.save()
-        for c in User.objects(user_id__in=exp.collaborator_ids):
-            if device.device_id not in c.device_ids:
-                c.device_ids.append(device.device_id)
-                c.save()
+        exp = Exp.objects.only('exp_id', 'owner_id',
+                               'collaborator_ids').get(exp_id=self.exp_id)
+        exp.add_device_id(device.device_id)
 
     def set_data(self, data_dict):
         if not isinstance(data_dict, dict):
             raise DataValueError('Can only initialize with a dict')
         # TODO: test encoding stuff
         self.data = Data(**mongo_encode(data_dict))
+        self.updated_at = datetime.utcnow()
         self.save()
 
     @classmethod
@@ -325,26 +366,16 @@ class Profile(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
         # TODO: test encoding stuff
         d = Data(**mongo_encode(data_dict or {}))
         p = cls(profile_id=profile_id, vk_pem=vk_pem, exp_id=exp.exp_id,
-                data=d, device_id=device.device_id if device else None)
+                data=d, device_id=device.device_id if device else None,
+                updated_at=datetime.utcnow())
         p.save()
 
-        exp.reload()
-        exp.profile_ids.append(profile_id)
-        if device and (device.device_id not in exp.device_ids):
-            exp.device_ids.append(device.device_id)
-        exp.save()
-
-        owner = User.objects.get(user_id=exp.owner_id)
-        owner.profile_ids.append(profile_id)
-        if device and (device.device_id not in owner.device_ids):
-            owner.device_ids.append(device.device_id)
-        owner.save()
-
-        for c in User.objects(user_id__in=exp.collaborator_ids):
-            c.profile_ids.append(profile_id)
-            if device and (device.device_id not in c.device_ids):
-                c.device_ids.append(device.device_id)
-            c.save()
+        Exp.objects(exp_id=exp.exp_id).update_one(
+            push__profile_ids=profile_id, inc__n_profiles=1)
+        User.objects(user_id__in=exp.member_ids()).update(
+            push__profile_ids=profile_id, inc__n_profiles=1)
+        if device:
+            exp.add_device_id(device.device_id)
 
         return p
 
@@ -355,7 +386,10 @@ class Result(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
             'indexes': ['result_id',
                         'profile_id',
                         'exp_id',
-                        '-created_at']}
+                        ('-created_at', '_id'),
+                        ('exp_id', '-created_at', '_id'),
+                        ('profile_id', '-created_at', '_id'),
+                        ('profile_id', 'batch_id')]}
 
     _jsonable = [('result_id', 'id')]
     _jsonable_private = ['profile_id',
@@ -368,6 +402,11 @@ class Result(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
     exp_id = mge.StringField(regex=hexregex, required=True)
     created_at = mge.ComplexDateTimeField(required=True)
     data = mge.EmbeddedDocumentField('Data', required=True)
+    # Set when the result was posted in a batch identified by the client
+    batch_id = mge.StringField(max_length=128)
+    batch_index = mge.IntField(min_value=0)
+    # False until a batch item has been added to the n_results counts
+    counted = mge.BooleanField()
 
     @classmethod
     def build_result_id(cls, profile, created_at, data_dict):
@@ -377,13 +416,28 @@ class Result(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
                          created_at.strftime(iso8601) + '/' +
                          json.dumps(data_dict, separators=(',', ':')))
 
+    @classmethod
+    def _get_fan_out_exp(cls, profile):
+        return Exp.objects.only('exp_id', 'owner_id',
+                                'collaborator_ids').get(exp_id=profile.exp_id)
+
+    @classmethod
+    def _fan_out(cls, exp, profile, n_results):
+        # Atomic server-side updates: nothing is loaded, and concurrent
+        # uploads to the same exp can't overwrite each other's counts
+        Exp.objects(exp_id=exp.exp_id).update_one(inc__n_results=n_results)
+        Profile.objects(profile_id=profile.profile_id).update_one(
+            inc__n_results=n_results, set__updated_at=datetime.utcnow())
+        User.objects(user_id__in=exp.member_ids()).update(
+            inc__n_results=n_results)
+
     @classmethod
     def create(cls, profile, data_dict):
         if not isinstance(data_dict, dict):
             raise DataValueError('Can only initialize with a dict')
 
         created_at = datetime.utcnow()
-        exp = Exp.objects.get(exp_id=profile.exp_id)
+        exp = cls._get_fan_out_exp(profile)
         result_id = cls.build_result_id(profile, created_at, data_dict)
         # TODO: test encoding stuff
         d = Data(**mongo_encode(data_dict))
@@ -391,52 +445,221 @@ class Result(ComputedSaveMixin, mge.Document, JSONDocumentMixin):
                 exp_id=exp.exp_id, created_at=created_at, data=d)
         r.save()
 
-        exp.result_ids.append(result_id)
-        exp.save()
-        profile.result_ids.append(result_id)
-        profile.save()
-        owner = User.objects.get(user_id=exp.owner_id)
-        owner.result_ids.append(result_id)
-        owner.save()
-        for c in User.objects(user_id__in=exp.collaborator_ids):
-            c.result_ids.append(result_id)
-            c.save()
+        cls._fan_out(exp, profile, 1)
 
         return r
 
-    # TODO: test
     @classmethod
-    def create_bulk(cls, profile, data_dicts):
+    def build_batch_result_id(cls, profile, batch_id, batch_index):
+        # Items of a client-identified batch get the same ids every time the
+        # batch is posted, so replays can't create duplicates. batch_id
+        # comes from JSON, so hash it as UTF-8.
+        key = u'{}#{}/{}'.format(profile.profile_id, batch_id, batch_index)
+        return sha256hex(key.encode('utf-8'))
+
+    @classmethod
+    def get_batch(cls, profile, batch_id):
+        stored = cls.objects(profile_id=profile.profile_id,
+                             batch_id=batch_id)
+        return dict((r.batch_index, r) for r in stored)
+
+    @classmethod
+    def _count_batch(cls, profile, batch_id, exp=None):
+        # Batch items are stored uncounted and claimed here before being
+        # counted, so a replay counts the items of an upload that died
+        # between storing and counting them, and concurrent replays can't
+        # count an item twice
+        n_results = cls.objects(profile_id=profile.profile_id,
+                                batch_id=batch_id,
+                                counted=False).update(set__counted=True)
+        if n_results > 0:
+            cls._fan_out(exp or cls._get_fan_out_exp(profile), profile,
+                         n_results)
+
+    @classmethod
+    def create_bulk(cls, profile, data_dicts, ordered=False, batch_id=None):
         if not isinstance(data_dicts, list):
             raise DataValueError('Can only initialize with a list of dicts')
-
-        exp = Exp.objects.get(exp_id=profile.exp_id)
-        results = []
-        result_ids = []
         for data_dict in data_dicts:
             if not isinstance(data_dict, dict):
                 raise DataValueError('Can only initialize with '
                                      'a list of dicts')
+
+        # A replayed batch is answered from the stored results, and only
+        # the items missing from an interrupted upload are created
+        stored = {}
+        if batch_id is not None:
+            stored = cls.get_batch(profile, batch_id)
+            if all(i in stored for i in range(len(data_dicts))):
+                cls._count_batch(profile, batch_id)
+                results = [stored[i] for i in range(len(data_dicts))]
+                return results, [r.result_id for r in results], []
+
+        exp = cls._get_fan_out_exp(profile)
+        indices = []
+        prepared = []
+        for i, data_dict in enumerate(data_dicts):
+            if i in stored:
+                continue
             created_at = datetime.utcnow()
-            result_id = cls.build_result_id(profile, created_at, data_dict)
+            if batch_id is None:
+                result_id = cls.build_result_id(profile, created_at,
+                                                data_dict)
+            else:
+                result_id = cls.build_batch_result_id(profile, batch_id, i)
             # TODO: test encoding stuff
             d = Data(**mongo_encode(data_dict))
             r = cls(result_id=result_id, profile_id=profile.profile_id,
                     exp_id=exp.exp_id, created_at=created_at, data=d)
-            r.save()
-            results.append(r)
-            result_ids.append(result_id)
-
-        exp.result_ids.extend(result_ids)
-        exp.save()
-        profile.result_ids.extend(result_ids)
-        profile.save()
-        owner = User.objects.get(user_id=exp.owner_id)
-        owner.result_ids.extend(result_ids)
-        owner.save()
+            if batch_id is not None:
+                r.batch_id = batch_id
+                r.batch_index = i
+                r.counted = False
+            r.validate()
+            indices.append(i)
+            prepared.append(r)
+
+        # Insert everything in a single round trip. An unordered batch goes
+        # on after a failed item, an ordered one stops at the first failure.
+        collection = cls._get_collection()
+        if ordered:
+            bulk = collection.initialize_ordered_bulk_op()
+        else:
+            bulk = collection.initialize_unordered_bulk_op()
+        sons = [r.to_mongo() for r in prepared]
+        for son in sons:
+            bulk.insert(son)
+
+        failures = {}
+        try:
+            if len(sons) > 0:
+                bulk.execute()
+        except BulkWriteError, e:
+            for error in e.details['writeErrors']:
+                failures[error['index']] = build_bulk_write_exception(error)
+            if ordered and len(failures) > 0:
+                for i in range(min(failures) + 1, len(prepared)):
+                    failures[i] = BulkAbortedError('Not inserted after an '
+                                                   'earlier failure')
+
+        created = {}
+        for i, (r, son) in enumerate(zip(prepared, sons)):
+            if i in failures:
+                continue
+            r.id = son['_id']
+            r._clear_changed_fields()
+            r._created = False
+            created[indices[i]] = r
+
+        if batch_id is not None:
+            cls._count_batch(profile, batch_id, exp)
+        elif len(created) > 0:
+            cls._fan_out(exp, profile, len(created))
+
+        # Failures are reported with their index in data_dicts
+        failures = dict((indices[i], e) for i, e in failures.iteritems())
+        if batch_id is not None and len(failures) > 0:
+            # Items that a concurrent replay inserted first are not failures
+            stored.update(cls.get_batch(profile, batch_id))
+            for i in failures.keys():
+                if i in stored:
+                    del failures[i]
+
+        stored.update(created)
+        results = [stored[i] for i in range(len(data_dicts)) if i in stored]
+        result_ids = [r.result_id for r in results]
+
+        return results, result_ids, sorted(failures.iteritems())
+
+
+class ResultJob(mge.Document, JSONDocumentMixin):
+
+    meta = {'ordering': ['created_at'],
+            'indexes': ['job_id',
+                        ('status', 'created_at'),
+                        ('profile_id', 'batch_id')]}
+
+    statuses = ['queued', 'running', 'done', 'failed']
+
+    _jsonable = [('job_id', 'id'),
+                 'status',
+                 'profile_id',
+                 'n_items',
+                 'created_at',
+                 'started_at',
+                 'finished_at',
+                 'result_ids',
+                 'failures',
+                 'error']
+    _jsonable_private = []
 
-        for c in User.objects(user_id__in=exp.collaborator_ids):
-            c.result_ids.extend(result_ids)
-            c.save()
+    job_id = mge.StringField(unique=True, regex=hexregex)
+    profile_id = mge.StringField(regex=hexregex, required=True)
+    is_bulk = mge.BooleanField(required=True, default=True)
+    batch_id = mge.StringField(max_length=128)
+    # The posted data dicts, kept as JSON so that any key can be queued
+    jdata_dicts = mge.StringField(required=True)
+    n_items = mge.IntField(required=True)
+    status = mge.StringField(required=True, default='queued',
+                             choices=statuses)
+    created_at = mge.DateTimeField(required=True)
+    started_at = mge.DateTimeField()
+    finished_at = mge.DateTimeField()
+    result_ids = mge.ListField(mge.StringField(regex=hexregex))
+    failures = mge.ListField(mge.DictField())
+    error = mge.DictField()
 
-        return results, result_ids
+    def data_dicts(self):
+        return json.loads(self.jdata_dicts)
+
+    def finish(self, result_ids, failures):
+        self.status = 'done'
+        self.finished_at = datetime.utcnow()
+        self.result_ids = result_ids
+        self.failures = failures
+        self.save()
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.finished_at = datetime.utcnow()
+        self.error = error
+        self.save()
+
+    @classmethod
+    def enqueue(cls, profile, data_dicts, is_bulk=True, batch_id=None):
+        if (not isinstance(data_dicts, list) or
+                not all(isinstance(d, dict) for d in data_dicts)):
+            raise DataValueError('Can only initialize with a list of dicts')
+
+        # A replayed batch gets the job that was queued for it first
+        if batch_id is not None:
+            job = cls.objects(profile_id=profile.profile_id,
+                              batch_id=batch_id).first()
+            if job is not None:
+                return job
+
+        job = cls(job_id=str(ObjectId()), profile_id=profile.profile_id,
+                  is_bulk=is_bulk, batch_id=batch_id,
+                  jdata_dicts=json.dumps(data_dicts),
+                  n_items=len(data_dicts), created_at=datetime.utcnow())
+        job.save()
+        return job
+
+    @classmethod
+    def claim_next(cls):
+        # Several workers can drain the queue: a job is only theirs if they
+        # are the ones who switched it from 'queued' to 'running'
+        while True:
+            job = cls.objects(status='queued').only('job_id').first()
+            if job is None:
+                return None
+            if cls.objects(job_id=job.job_id, status='queued').update_one(
+                    set__status='running', set__started_at=datetime.utcnow()):
+                return cls.objects.get(job_id=job.job_id)
+
+    @classmethod
+    def requeue_stale(cls, started_before):
+        # Jobs left running by a worker that died are given to another one
+        return cls.objects(status='running',
+                           started_at__lt=started_before).update(
+            set__status='queued', unset__started_at=True)
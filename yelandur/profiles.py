@@ -2,7 +2,7 @@
 
 import json
 
-from flask import Blueprint, jsonify, abort, request
+from flask import Blueprint, abort, request
 from flask.views import MethodView
 from flask.ext.login import current_user
 from mongoengine import NotUniqueError
@@ -11,7 +11,11 @@ from mongoengine.queryset import DoesNotExist
 from .cors import cors
 from .models import Exp, Device, Profile, DeviceSetError, DataValueError
 from .helpers import (dget, jsonb64_load, MalformedSignatureError,
-                      BadSignatureError, is_jose_sig_valid)
+                      BadSignatureError, is_jose_sig_valid, parse_jose_sig,
+                      jsonify, jsonify_list, get_page_args,
+                      QueryTooDeepException, UnknownOperator,
+                      NonQueriableType, NonOrderableType, BadQueryType,
+                      ParsingError)
 
 
 # Create the actual blueprint
@@ -77,15 +81,26 @@ def validate_data_signature(sdata, profile=None):
         except DoesNotExist:
             raise DeviceNotFoundError(pprofile)
 
-        # Make sure we have exactly one and only one valid signature per model
-        # type (device, profile)
-        profile_sig_valid = False
-        device_sig_valid = False
+        # Report malformed signatures before verifying any of them
         for sig in sigs:
-            if is_jose_sig_valid(b64_jpayload, sig, profile_vk_pem):
-                profile_sig_valid = True
-            elif is_jose_sig_valid(b64_jpayload, sig, device_vk_pem):
-                device_sig_valid = True
+            parse_jose_sig(sig)
+
+        # Make sure we have exactly one and only one valid signature per model
+        # type (device, profile). Clients sign with the profile first, so
+        # start with that pairing: if the profile key accepts the first
+        # signature, the second one can only be the device's. Each signature
+        # is then checked against a single key, except when they come in
+        # the other order.
+        if is_jose_sig_valid(b64_jpayload, sigs[0], profile_vk_pem):
+            profile_sig_valid = True
+            device_sig_valid = is_jose_sig_valid(b64_jpayload, sigs[1],
+                                                 device_vk_pem)
+        else:
+            device_sig_valid = is_jose_sig_valid(b64_jpayload, sigs[0],
+                                                 device_vk_pem)
+            profile_sig_valid = (device_sig_valid and
+                                 is_jose_sig_valid(b64_jpayload, sigs[1],
+                                                   profile_vk_pem))
 
         return (pprofile, (profile, device),
                 profile_sig_valid and device_sig_valid)
@@ -103,18 +118,26 @@ class ProfilesView(MethodView):
             if 'ids[]' in request.args:
                 ids = request.args.getlist('ids[]')
                 rprofiles = Profile.objects(profile_id__in=ids)
-                for p in rprofiles:
-                    if p.profile_id not in current_user.profile_ids:
+                for p in rprofiles.only('exp_id'):
+                    if not current_user.can_access_profile(p):
                         abort(403)
             else:
-                rprofiles = Profile.objects(
-                    profile_id__in=current_user.profile_ids)
+                rprofiles = current_user.accessible_profiles()
 
+            limit, after = get_page_args()
+            orders = Profile.objects.translate_order_to_jsonable_private(
+                request.args)
             filtered_query = Profile.objects.translate_to_jsonable_private(
                 request.args)
             rprofiles = rprofiles(**filtered_query)
+            if request.args.get('count', None) == 'only':
+                return jsonify({'count': rprofiles.count()})
 
-            return jsonify({'profiles': rprofiles.to_jsonable_private()})
+            rprofiles, after = rprofiles.order_by(*orders).paginate(
+                limit, after)
+
+            return jsonify_list('profiles',
+                                rprofiles.iter_jsonable_private(), after)
 
         # Public access
         if 'ids[]' in request.args:
@@ -123,10 +146,16 @@ class ProfilesView(MethodView):
         else:
             rprofiles = Profile.objects()
 
+        limit, after = get_page_args()
+        orders = Profile.objects.translate_order_to_jsonable(request.args)
         filtered_query = Profile.objects.translate_to_jsonable(request.args)
         rprofiles = rprofiles(**filtered_query)
+        if request.args.get('count', None) == 'only':
+            return jsonify({'count': rprofiles.count()})
+
+        rprofiles, after = rprofiles.order_by(*orders).paginate(limit, after)
 
-        return jsonify({'profiles': rprofiles.to_jsonable()})
+        return jsonify_list('profiles', rprofiles.iter_jsonable(), after)
 
     @cors()
     def post(self):
@@ -181,17 +210,19 @@ class ProfileView(MethodView):
 
     @cors()
     def get(self, profile_id):
-        p = Profile.objects.get(profile_id=profile_id)
-
         if request.args.get('access', None) == 'private':
+            p = Profile.objects.only_jsonable_private().get(
+                profile_id=profile_id)
+
             if not current_user.is_authenticated():
                 abort(401)
 
-            if p.profile_id in current_user.profile_ids:
+            if current_user.can_access_profile(p):
                 return jsonify({'profile': p.to_jsonable_private()})
             else:
                 abort(403)
         else:
+            p = Profile.objects.only_jsonable().get(profile_id=profile_id)
             return jsonify({'profile': p.to_jsonable()})
 
     @cors()
@@ -319,6 +350,62 @@ def device_already_set(error):
                    'message': 'Device is already set'}}), 403
 
 
+@profiles.errorhandler(UnknownOperator)
+@cors()
+def unknown_operator(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'UnknownOperator',
+                   'message': 'Found an unknown query '
+                              'operator on a valid field'}}), 400
+
+
+@profiles.errorhandler(NonQueriableType)
+@cors()
+def non_queriable_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'NonQueriableType',
+                   'message': 'Field cannot be queried'}}), 400
+
+
+@profiles.errorhandler(NonOrderableType)
+@cors()
+def non_orderable_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'NonOrderableType',
+                   'message': 'Field cannot be ordered'}}), 400
+
+
+@profiles.errorhandler(BadQueryType)
+@cors()
+def bad_query_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'BadQueryType',
+                   'message': 'Field, operator, or query value '
+                              'not compatible together'}}), 400
+
+
+@profiles.errorhandler(ParsingError)
+@cors()
+def parsing(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'ParsingError',
+                   'message': 'Could not parse query value'}}), 400
+
+
+@profiles.errorhandler(QueryTooDeepException)
+@cors()
+def query_too_deep(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'QueryTooDeep',
+                   'message': 'Query parameter is too deep'}}), 400
+
+
 @profiles.errorhandler(401)
 @cors()
 def unauthenticated(error):
@@ -4,15 +4,21 @@ import json
 import time
 from pprint import pformat
 
-from flask import Blueprint, jsonify, abort, request, current_app
+from flask import Blueprint, abort, request, current_app
 from flask.views import MethodView
 from flask.ext.login import current_user
+from mongoengine import NotUniqueError
 from mongoengine.queryset import DoesNotExist
 
 from .cors import cors
-from .models import Profile, Result, DataValueError
+from .models import (Profile, Result, ResultJob, DataValueError,
+                     BulkAbortedError)
 from .helpers import (dget, jsonb64_load, MalformedSignatureError,
-                      BadSignatureError, is_jose_sig_valid, is_jws_sig_valid)
+                      BadSignatureError, is_jose_sig_valid, is_jws_sig_valid,
+                      are_jose_sigs_valid, parse_jose_sig, jsonify,
+                      jsonify_list, get_page_args, QueryTooDeepException,
+                      UnknownOperator, NonQueriableType, NonOrderableType,
+                      BadQueryType, ParsingError)
 
 
 # Maximum delay between signature timestamp and now, in seconds
@@ -52,7 +58,7 @@ class ProfileMismatchError(ProfileError):
 
 
 # TODO: test
-def validate_data_signature(sdata):
+def parse_data_signature(sdata):
     b64_jpayload = dget(sdata, 'payload', MalformedSignatureError)
     sigs = dget(sdata, 'signatures', MalformedSignatureError)
 
@@ -62,6 +68,12 @@ def validate_data_signature(sdata):
     elif len(sigs) > 1:
         raise TooManySignaturesError
 
+    # Report a malformed signature here rather than when verifying it,
+    # which can happen later and for several uploads at once
+    if not isinstance(sigs[0], dict):
+        raise MalformedSignatureError
+    parse_jose_sig(sigs[0])
+
     # Extract the list of posted results
     payload = jsonb64_load(b64_jpayload, MalformedSignatureError)
     if 'result' in payload:
@@ -75,6 +87,12 @@ def validate_data_signature(sdata):
     else:
         raise MissingRequirementError
 
+    # Retried uploads are recognized by their optional batch id
+    batch_id = payload.get('batch_id', None)
+    if batch_id is not None and (not isinstance(batch_id, basestring) or
+                                 not 0 < len(batch_id) <= 128):
+        raise RequestMalformedError
+
     # Check all the provided profile_ids are identical
     profile_ids = [dget(pr, 'profile_id', MissingRequirementError)
                    for pr in presults]
@@ -87,8 +105,15 @@ def validate_data_signature(sdata):
     except DoesNotExist:
         raise ProfileNotFoundError(presults)
 
-    return (presults, is_bulk, profile,
-            is_jose_sig_valid(b64_jpayload, sigs[0], profile_vk_pem))
+    return (presults, is_bulk, batch_id, profile,
+            (b64_jpayload, sigs[0], profile_vk_pem))
+
+
+def validate_data_signature(sdata):
+    (presults, is_bulk, batch_id,
+     profile, sig_check) = parse_data_signature(sdata)
+    return (presults, is_bulk, batch_id, profile,
+            is_jose_sig_valid(*sig_check))
 
 
 # TODO: test
@@ -120,41 +145,180 @@ def validate_auth_token(auth_token):
     return (profile, is_jws_sig_valid(auth_token, profile_vkpem))
 
 
+def get_private_authed():
+    """The user or profile a request for private results is authenticated
+    as, with user auth or an `auth_token` URL parameter; abort with a 401
+    if there is none."""
+
+    authed = None
+
+    # Differentiate user and profile auth. User has priority (set last)
+    auth_token = request.args.get('auth_token', None)
+    if auth_token is not None:
+        profile, valid_profile_sig = validate_auth_token(auth_token)
+        if valid_profile_sig:
+            authed = profile
+    if current_user.is_authenticated():
+        authed = current_user
+
+    if authed is None:
+        abort(401)
+    return authed
+
+
+def failure_to_jsonable(index, error):
+    if isinstance(error, NotUniqueError):
+        return {'index': index,
+                'status_code': 409,
+                'type': 'FieldConflict',
+                'message': 'The value is already taken'}
+    elif isinstance(error, BulkAbortedError):
+        return {'index': index,
+                'status_code': 409,
+                'type': 'NotProcessed',
+                'message': ('Item was not processed because '
+                            'of an earlier failure')}
+    else:
+        return {'index': index,
+                'status_code': 500,
+                'type': 'OperationError',
+                'message': 'Item could not be saved'}
+
+
+# Errors reported for a chunk of a streamed upload, the same way the error
+# handlers below report them for a whole request
+chunk_errors = [
+    (RequestMalformedError, 400, 'Malformed', 'Request body is malformed'),
+    (DataValueError, 400, 'Malformed', 'Request body is malformed'),
+    (MalformedSignatureError, 400, 'Malformed', 'Request body is malformed'),
+    (ProfileMismatchError, 400, 'ProfileMismatch',
+     'The provided profiles differ from one another'),
+    (MissingRequirementError, 400, 'MissingRequirement',
+     'One of the required fields is missing'),
+    (TooManySignaturesError, 400, 'TooManySignatures',
+     'Too many signatures provided'),
+    (ProfileNotFoundError, 400, 'ProfileNotFound',
+     'The requested profile was not found'),
+    (BadSignatureError, 403, 'BadSignature', 'The signature is invalid')]
+
+
+def chunk_error_to_jsonable(index, error):
+    for error_class, status_code, error_type, message in chunk_errors:
+        if isinstance(error, error_class):
+            return {'index': index,
+                    'status_code': status_code,
+                    'type': error_type,
+                    'message': message}
+    raise error
+
+
+def read_chunks(stream, max_length):
+    """Yield the non-empty lines of `stream`, or `None` for too long ones."""
+
+    while True:
+        line = stream.readline(max_length + 1)
+        if line == '':
+            return
+        if len(line) > max_length and not line.endswith('\n'):
+            # Skip the rest of the line without keeping it
+            while not line.endswith('\n') and line != '':
+                line = stream.readline(max_length)
+            yield None
+        elif line.strip() != '':
+            yield line
+
+
+def commit_chunks(chunks):
+    """Verify the signatures of parsed chunks together and create their
+    results."""
+
+    sig_valids = are_jose_sigs_valid([sig_check
+                                      for _, _, _, _, sig_check in chunks])
+
+    acks = []
+    for (index, profile, data_dicts, batch_id, _), sig_valid in zip(
+            chunks, sig_valids):
+        try:
+            if sig_valid is None:
+                raise MalformedSignatureError
+            if not sig_valid:
+                raise BadSignatureError
+            _, result_ids, failures = Result.create_bulk(
+                profile, data_dicts,
+                current_app.config['RESULTS_BULK_ORDERED'], batch_id)
+        except (MalformedSignatureError, BadSignatureError,
+                DataValueError), e:
+            acks.append(chunk_error_to_jsonable(index, e))
+            continue
+
+        ack = {'index': index,
+               'status_code': 201,
+               'result_ids': result_ids}
+        if len(failures) > 0:
+            ack['failures'] = [failure_to_jsonable(i, e)
+                               for i, e in failures]
+        acks.append(ack)
+
+    return acks
+
+
+def run_result_job(job):
+    """Create the results of a queued upload and record the outcome."""
+
+    try:
+        profile = Profile.objects.get(profile_id=job.profile_id)
+        # A job run again after being requeued gets the same result ids, so
+        # items stored (and counted) by an earlier run are not duplicated
+        _, result_ids, failures = Result.create_bulk(
+            profile, job.data_dicts(),
+            current_app.config['RESULTS_BULK_ORDERED'],
+            job.batch_id or job.job_id)
+    except DoesNotExist:
+        job.fail({'status_code': 400,
+                  'type': 'ProfileNotFound',
+                  'message': 'The requested profile was not found'})
+    except Exception:
+        current_app.logger.exception('Result job {} failed'.format(
+            job.job_id))
+        job.fail({'status_code': 500,
+                  'type': 'OperationError',
+                  'message': 'Items could not be saved'})
+    else:
+        job.finish(result_ids, [failure_to_jsonable(i, e)
+                                for i, e in failures])
+
+
 class ResultsView(MethodView):
 
     @cors()
     def get(self):
         # Private access
         if request.args.get('access', None) == 'private':
-            authed = None
-
-            # Differentiate user and profile auth. User has priority (set last)
-            auth_token = request.args.get('auth_token', None)
-            if auth_token is not None:
-                profile, valid_profile_sig = validate_auth_token(auth_token)
-                if valid_profile_sig:
-                    authed = profile
-            if current_user.is_authenticated():
-                authed = current_user
-
-            if authed is None:
-                abort(401)
+            authed = get_private_authed()
 
             if 'ids[]' in request.args:
                 ids = request.args.getlist('ids[]')
                 rresults = Result.objects(result_id__in=ids)
-                for r in rresults:
-                    if r.result_id not in authed.result_ids:
+                # Access only depends on the exp and profile of a result
+                for r in rresults.only('exp_id', 'profile_id'):
+                    if not authed.can_access_result(r):
                         abort(403)
             else:
-                rresults = Result.objects(
-                    result_id__in=authed.result_ids)
+                rresults = authed.accessible_results()
 
+            limit, after = get_page_args()
+            orders = Result.objects.translate_order_to_jsonable_private(
+                request.args)
             filtered_query = Result.objects.translate_to_jsonable_private(
                 request.args)
             rresults = rresults(**filtered_query)
+            if request.args.get('count', None) == 'only':
+                return jsonify({'count': rresults.count()})
+
+            rresults, after = rresults.order_by(*orders).paginate(limit, after)
 
-            return jsonify({'results': rresults.to_jsonable_private()})
+            return jsonify_list('results',
+                                rresults.iter_jsonable_private(), after)
 
         # Public access
         if 'ids[]' in request.args:
@@ -163,10 +327,16 @@ class ResultsView(MethodView):
         else:
             rresults = Result.objects()
 
+        limit, after = get_page_args()
+        orders = Result.objects.translate_order_to_jsonable(request.args)
         filtered_query = Result.objects.translate_to_jsonable(request.args)
         rresults = rresults(**filtered_query)
+        if request.args.get('count', None) == 'only':
+            return jsonify({'count': rresults.count()})
 
-        return jsonify({'results': rresults.to_jsonable()})
+        rresults, after = rresults.order_by(*orders).paginate(limit, after)
+
+        return jsonify_list('results', rresults.iter_jsonable(), after)
 
     @cors()
     def post(self):
@@ -176,8 +346,8 @@ class ResultsView(MethodView):
             raise RequestMalformedError
 
         try:
-            presults, is_bulk, profile, sig_valid = validate_data_signature(
-                rdata)
+            (presults, is_bulk, batch_id,
+             profile, sig_valid) = validate_data_signature(rdata)
             current_app.logger.debug('Results post received')
             current_app.logger.debug('Details:\n' + pformat(presults))
             profile_error = None
@@ -202,14 +372,37 @@ class ResultsView(MethodView):
         if not sig_valid:
             raise BadSignatureError
 
-        _, result_ids = Result.create_bulk(profile, data_dicts)
-        results = Result.objects(result_id__in=result_ids)
-
-        if is_bulk:
-            return jsonify({'results': results.to_jsonable_private()}), 201
+        # Queue the upload for the worker if the client accepts it
+        if (current_app.config['RESULTS_ASYNC'] and
+                request.args.get('async', None) == 'true'):
+            job = ResultJob.enqueue(profile, data_dicts, is_bulk, batch_id)
+            return jsonify({'job': job.to_jsonable()}), 202
+
+        results, result_ids, failures = Result.create_bulk(
+            profile, data_dicts, current_app.config['RESULTS_BULK_ORDERED'],
+            batch_id)
+        if not is_bulk and len(failures) > 0:
+            raise failures[0][1]
+
+        # Uploaders can skip getting their own data back
+        if request.args.get('return', None) == 'ids':
+            if not is_bulk:
+                return jsonify({'result_id': result_ids[0]}), 201
+            rdict = {'result_ids': result_ids,
+                     'n_results': len(result_ids),
+                     'n_failures': len(failures)}
+        elif is_bulk:
+            # The created results are in the order they were posted in
+            rdict = {'results': [r.to_jsonable_private() for r in results]}
         else:
             return jsonify({'result': results[0].to_jsonable_private()}), 201
 
+        # Failed items are reported without aborting the whole batch
+        if len(failures) > 0:
+            rdict['failures'] = [failure_to_jsonable(i, e)
+                                 for i, e in failures]
+        return jsonify(rdict), 201
+
     @cors()
     def options(self):
         pass
@@ -218,21 +411,76 @@ class ResultsView(MethodView):
 results.add_url_rule('', view_func=ResultsView.as_view('results'))
 
 
+class ResultsStreamView(MethodView):
+
+    @cors()
+    def post(self):
+        # Each line is a signed upload as for POST /results. Lines are read
+        # and committed a few at a time (as many as there are verifying
+        # processes), so the whole body is never held in memory.
+        window = max(1, current_app.config['SIGNATURE_VERIFY_PROCESSES'])
+        max_length = current_app.config['MAX_CONTENT_LENGTH']
+
+        acks = []
+        pending = []
+        for index, line in enumerate(read_chunks(request.stream,
+                                                 max_length)):
+            try:
+                if line is None:
+                    raise RequestMalformedError
+                try:
+                    sdata = json.loads(line)
+                except ValueError:
+                    raise RequestMalformedError
+
+                (presults, _, batch_id,
+                 profile, sig_check) = parse_data_signature(sdata)
+                data_dicts = [dget(presult, 'result_data',
+                                   MissingRequirementError)
+                              for presult in presults]
+                pending.append((index, profile, data_dicts, batch_id,
+                                sig_check))
+            except (RequestMalformedError, MalformedSignatureError,
+                    TooManySignaturesError, MissingRequirementError,
+                    ProfileError), e:
+                acks.append(chunk_error_to_jsonable(index, e))
+
+            if len(pending) >= window:
+                acks.extend(commit_chunks(pending))
+                pending = []
+
+        acks.extend(commit_chunks(pending))
+        acks.sort(key=lambda ack: ack['index'])
+        current_app.logger.debug('Results stream received ({} chunks)'.format(
+            len(acks)))
+
+        return jsonify({'chunks': acks})
+
+    @cors()
+    def options(self):
+        pass
+
+
+results.add_url_rule('/stream',
+                     view_func=ResultsStreamView.as_view('results_stream'))
+
+
 class ResultView(MethodView):
 
     @cors()
     def get(self, result_id):
-        r = Result.objects.get(result_id=result_id)
-
         if request.args.get('access', None) == 'private':
+            r = Result.objects.only_jsonable_private().get(result_id=result_id)
+
             if not current_user.is_authenticated():
                 abort(401)
 
-            if r.result_id in current_user.result_ids:
+            if current_user.can_access_result(r):
                 return jsonify({'result': r.to_jsonable_private()})
             else:
                 abort(403)
         else:
+            r = Result.objects.only_jsonable().get(result_id=result_id)
             return jsonify({'result': r.to_jsonable()})
 
 
@@ -240,6 +488,30 @@ results.add_url_rule('/<result_id>',
                      view_func=ResultView.as_view('result'))
 
 
+class ResultJobView(MethodView):
+
+    @cors()
+    def get(self, job_id):
+        # Jobs link results to their profile, so they need the same access
+        # as private results: the job's profile, or a user of its exp
+        authed = get_private_authed()
+        job = ResultJob.objects.only_jsonable().get(job_id=job_id)
+        if isinstance(authed, Profile):
+            if authed.profile_id != job.profile_id:
+                abort(403)
+        else:
+            profile = Profile.objects.only('exp_id').get(
+                profile_id=job.profile_id)
+            if profile.exp_id not in authed.exp_ids:
+                abort(403)
+
+        return jsonify({'job': job.to_jsonable()})
+
+
+results.add_url_rule('/jobs/<job_id>',
+                     view_func=ResultJobView.as_view('result_job'))
+
+
 @results.errorhandler(DoesNotExist)
 @cors()
 def does_not_exist(error):
@@ -315,6 +587,71 @@ def bad_signature(error):
                    'message': 'The signature is invalid'}}), 403
 
 
+@results.errorhandler(NotUniqueError)
+@cors()
+def not_unique_error(error):
+    return jsonify(
+        {'error': {'status_code': 409,
+                   'type': 'FieldConflict',
+                   'message': 'The value is already taken'}}), 409
+
+
+@results.errorhandler(UnknownOperator)
+@cors()
+def unknown_operator(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'UnknownOperator',
+                   'message': 'Found an unknown query '
+                              'operator on a valid field'}}), 400
+
+
+@results.errorhandler(NonQueriableType)
+@cors()
+def non_queriable_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'NonQueriableType',
+                   'message': 'Field cannot be queried'}}), 400
+
+
+@results.errorhandler(NonOrderableType)
+@cors()
+def non_orderable_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'NonOrderableType',
+                   'message': 'Field cannot be ordered'}}), 400
+
+
+@results.errorhandler(BadQueryType)
+@cors()
+def bad_query_type(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'BadQueryType',
+                   'message': 'Field, operator, or query value '
+                              'not compatible together'}}), 400
+
+
+@results.errorhandler(ParsingError)
+@cors()
+def parsing(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'ParsingError',
+                   'message': 'Could not parse query value'}}), 400
+
+
+@results.errorhandler(QueryTooDeepException)
+@cors()
+def query_too_deep(error):
+    return jsonify(
+        {'error': {'status_code': 400,
+                   'type': 'QueryTooDeep',
+                   'message': 'Query parameter is too deep'}}), 400
+
+
 @results.errorhandler(401)
 @cors()
 def unauthenticated(error):
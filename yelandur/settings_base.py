@@ -7,6 +7,33 @@ API_VERSION_URL = '/v1'
 
 # Upload options
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+# Whether bulk result uploads stop at the first failed item (ordered) or
+# insert all the other items anyway (unordered)
+RESULTS_BULK_ORDERED = False
+# Whether result uploads asking for it (`async=true`) are queued and answered
+# with a 202, leaving the inserts to the `process_results` worker
+RESULTS_ASYNC = False
+
+# Maximum (and default) number of items in a page of a list response
+MAX_PAGE_SIZE = 1000
+
+# Whether JSON responses are rendered compact (no indentation or spaces)
+# instead of pretty-printed for non-XHR requests
+JSONIFY_COMPACT = True
+# Python's C JSON encoder is only used when keys aren't sorted
+JSON_SORT_KEYS = False
+
+# Whether list responses (`GET /results` and the like) are streamed to the
+# client as the documents are read, instead of being rendered in memory first
+STREAM_JSON_LISTS = False
+
+# Number of results fetched at a time from the database when streaming
+# `/exps/<id>/results/export`
+EXPORT_BATCH_SIZE = 1000
+
+# Number of processes used to verify independent signatures in parallel
+# (0 or 1 verifies them in turn)
+SIGNATURE_VERIFY_PROCESSES = 0
 
 # IP to listen on if standalone server
 HOST = '0.0.0.0'
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
 import re
+import json
+import zlib
 from functools import partial
 from datetime import datetime
 from types import MethodType
 
 import ecdsa
 import jws
+from flask import Flask, jsonify as flask_jsonify
 from ecdsa.util import sigencode_der, sigdecode_string
-from jws.utils import base64url_decode
+from jws.utils import base64url_decode, base64url_encode
+from bson import ObjectId
 from mongoengine import (Document, ListField, StringField, IntField,
                          EmailField, FloatField, DictField,
                          ComplexDateTimeField)
@@ -148,6 +153,169 @@ class SigConversionTestCase(unittest.TestCase):
                          sig2_string, 'bad der_to_string signature')
 
 
+class VerifierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sk = ecdsa.SigningKey.generate(curve=ecdsa.curves.NIST256p)
+        self.vk_pem = self.sk.verifying_key.to_pem()
+        self.other_vk_pem = ecdsa.SigningKey.generate(
+            curve=ecdsa.curves.NIST256p).verifying_key.to_pem()
+        self.jheader = '{"alg": "ES256"}'
+        self.jpayload = '{"test": "test"}'
+
+        sig_string_b64 = jws.sign(self.jheader, self.jpayload, self.sk,
+                                  is_json=True)
+        order = self.sk.curve.order
+        r, s = sigdecode_string(base64url_decode(sig_string_b64), order)
+        self.sig_der = sigencode_der(r, s, order)
+
+    def tearDown(self):
+        helpers.set_verifier(helpers.available_verifiers()[0])
+        helpers.close_verify_pool()
+
+    def _test_verifier(self, verifier):
+        vk = verifier.load_key(self.vk_pem)
+        other_vk = verifier.load_key(self.other_vk_pem)
+
+        self.assertTrue(verifier.verify(vk, self.jheader, self.jpayload,
+                                        self.sig_der))
+        self.assertFalse(verifier.verify(other_vk, self.jheader,
+                                         self.jpayload, self.sig_der))
+        self.assertFalse(verifier.verify(vk, self.jheader,
+                                         '{"test": "tampered"}',
+                                         self.sig_der))
+
+        # Through the signature checking functions
+        helpers.set_verifier(verifier)
+        sdata = helpers.APITestCase._sign({'test': 'test'}, self.sk, True)
+        self.assertTrue(helpers.is_jose_sig_valid(
+            sdata['payload'], sdata['signatures'][0], self.vk_pem))
+        self.assertFalse(helpers.is_jose_sig_valid(
+            sdata['payload'], sdata['signatures'][0], self.other_vk_pem))
+        self.assertEqual(helpers.vk_cache.loader, verifier.load_key)
+
+    def test_ecdsa_verifier(self):
+        self._test_verifier(helpers.EcdsaVerifier())
+
+    @unittest.skipIf(helpers.load_pem_public_key is None,
+                     'cryptography is not installed')
+    def test_openssl_verifier(self):
+        self._test_verifier(helpers.OpenSSLVerifier())
+
+        # Unknown algorithms are refused like python-jws does
+        verifier = helpers.OpenSSLVerifier()
+        self.assertRaises(jws.AlgorithmNotImplemented, verifier.verify,
+                          verifier.load_key(self.vk_pem), '{"alg": "XX"}',
+                          self.jpayload, self.sig_der)
+
+    def _malformed_sigs(self, sig):
+        return [dict(sig, protected=base64url_encode('not json')),
+                dict(sig, protected=base64url_encode('["ES256"]')),
+                dict(sig, protected=base64url_encode('{"alg": "XX"}')),
+                dict(sig, signature=base64url_encode('\x30\x01junk')),
+                dict(sig, signature=base64url_encode('x' * 70))]
+
+    def test_parse_jose_sig(self):
+        sdata = helpers.APITestCase._sign({'test': 'test'}, self.sk, True)
+        sig = sdata['signatures'][0]
+        self.assertEqual(helpers.parse_jose_sig(sig),
+                         (base64url_decode(str(sig['protected'])),
+                          base64url_decode(str(sig['signature']))))
+
+        # Headers must be JSON with a known alg, and signatures DER
+        for bad_sig in ([{'protected': 'abc'}] +
+                        self._malformed_sigs(sig)):
+            self.assertRaises(helpers.MalformedSignatureError,
+                              helpers.parse_jose_sig, bad_sig)
+
+    def test_are_jose_sigs_valid(self):
+        sdata = helpers.APITestCase._sign({'test': 'test'}, self.sk, True)
+        sig_checks = [(sdata['payload'], sdata['signatures'][0], self.vk_pem),
+                      (sdata['payload'], sdata['signatures'][0],
+                       self.other_vk_pem)] * 2
+        # Malformed signatures don't fail the other verifications
+        malformed_checks = [
+            (sdata['payload'], sig, self.vk_pem)
+            for sig in self._malformed_sigs(sdata['signatures'][0])]
+
+        # In turn, then on a pool of processes, with each verifier
+        app = Flask(__name__)
+        for verifier in helpers.available_verifiers():
+            # Pool workers are forked with the verifier of the time
+            helpers.close_verify_pool()
+            helpers.set_verifier(verifier)
+            for processes in [0, 2]:
+                app.config['SIGNATURE_VERIFY_PROCESSES'] = processes
+                with app.app_context():
+                    self.assertEqual(
+                        helpers.are_jose_sigs_valid(sig_checks),
+                        [True, False, True, False])
+                    self.assertEqual(
+                        helpers.are_jose_sigs_valid(sig_checks[:1] +
+                                                    malformed_checks),
+                        [True] + [None] * len(malformed_checks))
+
+        # The pool's workers are stopped and the pool forgotten when closed
+        workers = helpers._verify_pools[os.getpid()]._pool
+        helpers.close_verify_pool()
+        self.assertEqual(helpers._verify_pools, {})
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+    def test_available_verifiers(self):
+        verifiers = helpers.available_verifiers()
+        self.assertIsInstance(verifiers[-1], helpers.EcdsaVerifier)
+        if helpers.load_pem_public_key is not None:
+            self.assertIsInstance(verifiers[0], helpers.OpenSSLVerifier)
+
+
+class VerifyingKeyCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vk_pems = [ecdsa.SigningKey.generate(
+            curve=ecdsa.curves.NIST256p).verifying_key.to_pem()
+            for i in range(3)]
+
+    def test_get(self):
+        cache = helpers.VerifyingKeyCache(2)
+
+        # Keys are parsed once, then served from the cache
+        vk = cache.get(self.vk_pems[0])
+        self.assertIsInstance(vk, ecdsa.VerifyingKey)
+        self.assertEqual(vk.to_pem(), self.vk_pems[0])
+        self.assertIs(cache.get(self.vk_pems[0]), vk)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_get_evicts_least_recently_used(self):
+        cache = helpers.VerifyingKeyCache(2)
+        vk0 = cache.get(self.vk_pems[0])
+        cache.get(self.vk_pems[1])
+        # Using the first key makes the second one the oldest
+        cache.get(self.vk_pems[0])
+        cache.get(self.vk_pems[2])
+
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertIs(cache.get(self.vk_pems[0]), vk0)
+        self.assertEqual(cache.misses, 3)
+        cache.get(self.vk_pems[1])
+        self.assertEqual(cache.misses, 4)
+
+    def test_stats(self):
+        cache = helpers.VerifyingKeyCache(2)
+        self.assertEqual(cache.stats(), {'size': 0, 'maxsize': 2, 'hits': 0,
+                                         'misses': 0, 'hit_rate': 0.0})
+
+        for i in range(3):
+            cache.get(self.vk_pems[0])
+        cache.get(self.vk_pems[1])
+        self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 2,
+                                         'misses': 2, 'hit_rate': 0.5})
+
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+
 class WipeDatabaseTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -580,6 +748,310 @@ class TypeStringParserMixinTestCase(TypeStringTester):
                          '_absent_ext_ext_ext')
 
 
+class RawJSONQuerySetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        data = models.Data(**helpers.mongo_encode(
+            {'trials.1': 'worked', 'a&b': [1, {'b.c': 2}, [3]],
+             'x': {'y.z': [1]}, 'n': None}))
+        self.r = models.Result(result_id='ab', profile_id='cd',
+                               exp_id='ef', created_at=datetime.utcnow(),
+                               data=data)
+        self.p = models.Profile(profile_id='ab', vk_pem='pem', exp_id='ef',
+                                data=models.Data(age=3))
+        self.u = models.User(user_id='seb', gravatar_id='ff',
+                             persona_email='seb@example.com',
+                             exp_ids=['ab'], n_exps=1, n_profiles=0,
+                             n_devices=0)
+        self.e = models.Exp(exp_id='ab', name='test', owner_id='seb',
+                            collaborator_ids=['toad'], n_collaborators=1,
+                            n_devices=0, n_profiles=0)
+        self.d = models.Device(device_id='ab', vk_pem='pem')
+
+    def _raw_and_hydrated(self, doc, type_string):
+        son = doc.to_mongo()
+        qs = helpers.JSONQuerySet(doc.__class__, None)
+        steps, field_names = qs._compile_raw_plan(type_string)
+        return (qs._raw_to_jsonable(steps, son),
+                doc.__class__._from_son(son)._to_jsonable(type_string))
+
+    def test__raw_to_jsonable(self):
+        # Raw documents serialize exactly like hydrated ones
+        for doc in [self.r, self.p, self.u, self.e, self.d]:
+            for type_string in ['_jsonable', '_jsonable_private']:
+                raw, hydrated = self._raw_and_hydrated(doc, type_string)
+                self.assertEqual(json.dumps(raw, sort_keys=True),
+                                 json.dumps(hydrated, sort_keys=True))
+
+        # Including the defaults of missing fields
+        del self.u.n_results
+        raw, hydrated = self._raw_and_hydrated(self.u, '_jsonable')
+        self.assertEqual(raw['n_results'], 0)
+        self.assertEqual(raw, hydrated)
+
+    def test__raw_to_jsonable_fallback(self):
+        # Data that hydration would interpret differently is left to it
+        qs = helpers.JSONQuerySet(models.Result, None)
+        steps, field_names = qs._compile_raw_plan('_jsonable_private')
+        for data in [{'a__b': 1}, {'a': [{'_cls': 'Data'}]}, {'validate': 1}]:
+            son = self.r.to_mongo()
+            son['data'] = data
+            self.assertRaises(helpers.RawFallback, qs._raw_to_jsonable,
+                              steps, son)
+
+    def test__compile_raw_plan(self):
+        qs = helpers.JSONQuerySet(models.Result, None)
+        steps, field_names = qs._compile_raw_plan('_jsonable_private')
+        self.assertEqual(field_names,
+                         ['result_id', 'profile_id', 'exp_id', 'created_at',
+                          'data'])
+
+        # Regexes, deep attributes and non-field attributes need hydration
+        self.assertIsNone(helpers.JSONQuerySet(
+            models.Data, None)._compile_raw_plan('_jsonable_private'))
+        self.assertIsNone(helpers.JSONQuerySet(
+            models.ResultJob, None)._compile_raw_plan('_jsonable'))
+
+    def test__compile_projection(self):
+        qs = helpers.JSONQuerySet(models.User, None)
+        self.assertEqual(qs._compile_projection('_jsonable'),
+                         ['user_id', 'user_id_is_set', 'exp_ids', 'n_exps',
+                          'n_profiles', 'n_devices', 'n_results',
+                          'gravatar_id'])
+        self.assertEqual(qs._compile_projection('_jsonable_private')[-1],
+                         'persona_email')
+
+        # Regexes need all the fields
+        self.assertIsNone(helpers.JSONQuerySet(
+            models.Data, None)._compile_projection('_jsonable_private'))
+
+    def test_only_jsonable(self):
+        qs = helpers.JSONQuerySet(models.Result, None)
+        self.assertEqual(qs.only_jsonable()._loaded_fields.as_dict(),
+                         {'result_id': True})
+        self.assertEqual(
+            sorted(qs.only_jsonable_private()._loaded_fields.as_dict()),
+            ['created_at', 'data', 'exp_id', 'profile_id', 'result_id'])
+
+        # Querysets already restricted are left as they are
+        restricted = qs.only('exp_id')
+        self.assertIs(restricted.only_jsonable(), restricted)
+
+    def test_batch_size(self):
+        qs = helpers.JSONQuerySet(models.Result, None)
+        self.assertIsNone(qs._batch_size)
+        batched = qs.batch_size(500)
+        self.assertEqual(batched._batch_size, 500)
+        self.assertIsNone(qs._batch_size)
+
+        # Kept through further refinements
+        self.assertEqual(batched.only('exp_id')(exp_id='ab')
+                         .order_by('id')._batch_size, 500)
+
+
+class PaginationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['MAX_PAGE_SIZE'] = 10
+        self.sort = [('created_at', -1), ('n', 1), ('_id', 1)]
+
+    def test_get_page_args(self):
+        for query_string, args in [('', (10, None)),
+                                   ('limit=3&after=abc', (3, 'abc')),
+                                   ('limit=20', (10, None))]:
+            with self.app.test_request_context(query_string=query_string):
+                self.assertEqual(helpers.get_page_args(), args)
+
+        for query_string in ['limit=0', 'limit=-1', 'limit=1.0']:
+            with self.app.test_request_context(query_string=query_string):
+                self.assertRaises(helpers.ParsingError,
+                                  helpers.get_page_args)
+
+    def test_cursor(self):
+        son = {'_id': ObjectId(), 'n': None, 'created_at': '2014,10,04'}
+        after = helpers.JSONQuerySet._encode_cursor(self.sort, son)
+        self.assertEqual(helpers.JSONQuerySet._decode_cursor(self.sort,
+                                                             after),
+                         [son['created_at'], None, son['_id']])
+
+        # Cursors don't work with another order, or when tampered with
+        self.assertRaises(helpers.ParsingError,
+                          helpers.JSONQuerySet._decode_cursor,
+                          self.sort[1:], after)
+        injected = base64url_encode(json.dumps(
+            [['created_at', {'$ne': None}], ['n', 1], ['_id', 1]]))
+        for bad in [after[:-3], 'abc', u'é', injected]:
+            self.assertRaises(helpers.ParsingError,
+                              helpers.JSONQuerySet._decode_cursor,
+                              self.sort, bad)
+
+    def test__keyset_query(self):
+        _id = ObjectId()
+        self.assertEqual(
+            helpers.JSONQuerySet._keyset_query(self.sort, ['b', 3, _id]),
+            {'$or': [{'$or': [{'created_at': {'$lt': 'b'}},
+                              {'created_at': None}]},
+                     {'created_at': 'b', 'n': {'$gt': 3}},
+                     {'created_at': 'b', 'n': 3, '_id': {'$gt': _id}}]})
+
+        # Nulls come first in ascending order, last in descending order
+        self.assertEqual(
+            helpers.JSONQuerySet._keyset_query(self.sort, [None, None, _id]),
+            {'$or': [{'created_at': None, 'n': {'$ne': None}},
+                     {'created_at': None, 'n': None, '_id': {'$gt': _id}}]})
+
+
+class JSONifyListTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['STREAM_JSON_LISTS'] = True
+        self.app.config['JSONIFY_COMPACT'] = False
+        self.items = [{'id': str(i), 'data': {'a': [i, 'x\ny']}}
+                      for i in range(2 * helpers.STREAM_FRAGMENT_SIZE + 1)]
+
+    def _jsonify_list(self, jsonables, headers=None):
+        with self.app.test_request_context(headers=headers):
+            resp = helpers.jsonify_list('items', jsonables)
+            return resp.is_streamed, ''.join(resp.response)
+
+    def _jsonify(self, d, headers=None):
+        with self.app.test_request_context(headers=headers):
+            return helpers.jsonify(d).data
+
+    def test_jsonify(self):
+        # Pretty-printed like flask.jsonify() unless compact
+        d = {'items': self.items[:2]}
+        with self.app.test_request_context():
+            self.assertEqual(helpers.jsonify(d).data, flask_jsonify(d).data)
+        self.app.config['JSONIFY_COMPACT'] = True
+        with self.app.test_request_context():
+            self.assertEqual(helpers.jsonify(d).data,
+                             json.dumps(d, separators=(',', ':'),
+                                        sort_keys=True))
+
+    def test_jsonify_list(self):
+        # Streamed lists render exactly like jsonify(), in any format
+        for compact in [False, True]:
+            self.app.config['JSONIFY_COMPACT'] = compact
+            for headers in [None, {'X-Requested-With': 'XMLHttpRequest'}]:
+                for items in [self.items, self.items[:1]]:
+                    streamed, data = self._jsonify_list(iter(items),
+                                                        headers)
+                    self.assertTrue(streamed)
+                    self.assertEqual(data, self._jsonify({'items': items},
+                                                         headers))
+        self.app.config['JSONIFY_COMPACT'] = False
+
+        # Empty lists and empty type strings are answered at once
+        self.assertEqual(self._jsonify_list(iter([])),
+                         (False, self._jsonify({'items': []})))
+
+        def empty():
+            raise helpers.EmptyJsonableException
+            yield
+        self.assertEqual(self._jsonify_list(empty()),
+                         (False, self._jsonify({'items': None})))
+
+        # Errors on the first item are raised before answering
+        def failing():
+            raise ValueError
+            yield
+        self.assertRaises(ValueError, self._jsonify_list, failing())
+
+        # Without streaming, the list is rendered in memory
+        self.app.config['STREAM_JSON_LISTS'] = False
+        self.assertEqual(self._jsonify_list(iter(self.items)),
+                         (False, self._jsonify({'items': self.items})))
+        self.assertEqual(self._jsonify_list(empty()),
+                         (False, self._jsonify({'items': None})))
+
+    def test_stream_ndjson(self):
+        with self.app.test_request_context():
+            fragments = list(helpers.stream_ndjson(iter(self.items)))
+            gzipped = list(helpers.stream_ndjson(iter(self.items), True))
+            empty = list(helpers.stream_ndjson(iter([]), True))
+
+        # One compact item per line, newlines in strings being escaped
+        self.assertEqual(len(fragments), 3)
+        lines = ''.join(fragments).split('\n')
+        self.assertEqual(lines[-1], '')
+        self.assertEqual([json.loads(line) for line in lines[:-1]],
+                         self.items)
+
+        # Every compressed fragment can be decompressed as it arrives
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for fragment, gzipped_fragment in zip(fragments, gzipped):
+            self.assertEqual(decompressor.decompress(gzipped_fragment),
+                             fragment)
+        self.assertEqual(zlib.decompress(''.join(empty),
+                                         16 + zlib.MAX_WBITS), '')
+
+
+class TranslationCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.qs = helpers.JSONQuerySet(models.Result, None)
+
+    def test__parse_query_value(self):
+        parse = helpers.JSONIterableMixin._parse_query_value
+        self.assertEqual(parse('12', int), 12)
+        self.assertEqual(parse('1.5', list, float), 1.5)
+        self.assertEqual(parse('abc', str), 'abc')
+
+        # Dates are parsed once, from timestamps or ISO-8601 strings
+        date = datetime(2014, 10, 4, 14, 5, 52)
+        self.assertEqual(parse('1412431552', datetime), date)
+        self.assertEqual(parse('2014-10-04T14:05:52Z', datetime), date)
+        self.assertEqual(parse('2014-10-04T14:05:52.000001Z', list,
+                               datetime),
+                         date.replace(microsecond=1))
+
+        for value, attr_type in [('1.0', int), ('a', float),
+                                 ('2014-10-04', datetime), ('inf', datetime)]:
+            self.assertRaises(helpers.ParsingError, parse, value, attr_type)
+
+    def test__translate_query(self):
+        query = MultiDict([('exp_id', 'ab'),
+                           ('created_at__gte', '1412431552'),
+                           ('order', 'created_at')])
+        self.assertEqual(
+            self.qs.translate_to_jsonable_private(query),
+            {'exp_id': 'ab',
+             'created_at__gte': datetime(2014, 10, 4, 14, 5, 52)})
+
+        # The query shape is cached, not its values
+        key = (models.Result, 'query', '_jsonable_private',
+               ('created_at__gte', 'exp_id', 'order'))
+        self.assertIn(key, self.qs._translations)
+        query['exp_id'] = 'cd'
+        self.assertEqual(
+            self.qs.translate_to_jsonable_private(query)['exp_id'], 'cd')
+
+        # And errors are raised each time
+        query = {'exp_id__bad': 'ab'}
+        for i in range(2):
+            self.assertRaises(helpers.UnknownOperator,
+                              self.qs.translate_to_jsonable_private, query)
+        query = {'created_at__gte': 'yesterday'}
+        for i in range(2):
+            self.assertRaises(helpers.ParsingError,
+                              self.qs.translate_to_jsonable_private, query)
+
+        # Private fields are left out of public queries
+        self.assertEqual(self.qs.translate_to_jsonable(
+            {'exp_id': 'ab', 'id': 'cd'}), {'result_id': 'cd'})
+
+    def test__translate_order(self):
+        query = MultiDict([('order', '-created_at'), ('order', 'bla')])
+        for i in range(2):
+            self.assertEqual(
+                self.qs.translate_order_to_jsonable_private(query),
+                ['-created_at'])
+        self.assertEqual(self.qs.translate_order_to_jsonable(query), [])
+
+
 class JSONIteratableTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -1553,6 +2025,30 @@ class JSONDocumentMixinTestCase(TypeStringTester):
         self.assertRaises(AttributeError, self.jm.__getattribute__,
                           'to_mongo')
 
+    def test__get_serialization_plan(self):
+        class PlannedDoc(helpers.JSONDocumentMixin):
+            _planned = ['a', ('b__c', 'c', 'c_def')]
+            _planned_regex = [(r'/^x([0-9])$/', r'y\1')]
+
+        doc = PlannedDoc()
+        doc.a = '1'
+        doc.x1 = 'x'
+        plan = doc._get_serialization_plan('_planned_regex')
+        self.assertEqual(plan[0], '_planned_regex')
+        self.assertEqual([step[2] for step in plan[1]], ['a', 'c', r'y\1'])
+        self.assertEqual(doc._to_jsonable('_planned_regex'),
+                         {'a': '1', 'c': 'c_def', 'y1': 'x'})
+
+        # Plans are compiled once per class
+        self.assertIs(PlannedDoc()._get_serialization_plan('_planned_regex'),
+                      plan)
+
+        # Except when includes are set on the instance
+        self.assertIsNot(self.jm._get_serialization_plan('_basic'),
+                         self.jm._get_serialization_plan('_basic'))
+        self.assertNotIn((helpers.JSONDocumentMixin, '_basic'),
+                         helpers.JSONDocumentMixin._serialization_plans)
+
     def test__build_to_jsonable(self):
         # ### Without attribute name, behaves like _to_jsonable except for the
         # ### `EmptyJsonableException`
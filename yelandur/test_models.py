@@ -184,27 +184,13 @@ class UserTestCase(unittest.TestCase):
         u.save()
         self.assertIsInstance(u.id, ObjectId)
 
-    def test_contraints_result_ids(self):
-        # `result_ids` must be hexadecimal
-        u = models.User()
-        u.user_id = 'seb'
-        u.persona_email = 'seb@example.com'
-        u.gravatar_id = 'fff'
-        u.result_ids = ['ffg']
-        self.assertRaises(ValidationError, u.save)
-
-        u.result_ids = ['fff']
-        u.save()
-        self.assertIsInstance(u.id, ObjectId)
-
     def test_update_computed_lengths(self):
         u = models.User()
         u.user_id = 'seb'
         u.persona_email = 'seb@example.com'
         u.gravatar_id = 'fff'
-        u.result_ids = ['eee']
         u.save()
-        self.assertEqual(u.n_results, 1)
+        self.assertEqual(u.n_results, 0)
         self.assertEqual(u.n_devices, 0)
         self.assertEqual(u.n_profiles, 0)
         self.assertEqual(u.n_exps, 0)
@@ -213,7 +199,7 @@ class UserTestCase(unittest.TestCase):
         u.profile_ids = ['aaa', 'bbb']
         u.exp_ids = ['ccc', 'ddd', 'eee']
         u.save()
-        self.assertEqual(u.n_results, 1)
+        self.assertEqual(u.n_results, 0)
         self.assertEqual(u.n_devices, 1)
         self.assertEqual(u.n_profiles, 2)
         self.assertEqual(u.n_exps, 3)
@@ -510,12 +496,11 @@ class ExpTestCase(unittest.TestCase):
         self.assertEqual(e.n_collaborators, 0)
 
         e.device_ids = ['aaa', 'bbb']
-        e.result_ids = ['ccc', 'ddd', 'eee']
         e.collaborator_ids = ['vincent']
         e.save()
         self.assertEqual(e.n_profiles, 1)
         self.assertEqual(e.n_devices, 2)
-        self.assertEqual(e.n_results, 3)
+        self.assertEqual(e.n_results, 0)
         self.assertEqual(e.n_collaborators, 1)
 
     def test_build_exp_id(self):
@@ -741,31 +726,13 @@ class ProfileTestCase(unittest.TestCase):
         p.save()
         self.assertIsInstance(p.id, ObjectId)
 
-    def test_constraints_result_ids(self):
-        # `result_ids` must be hexadecimal
+    def test_default_n_results(self):
         p = models.Profile()
         p.profile_id = 'fff'
         p.vk_pem = 'profile key'
         p.exp_id = 'fff'
-        p.result_ids = ['ffg']
-        self.assertRaises(ValidationError, p.save)
-
-        p.result_ids = ['fff']
         p.save()
-        self.assertIsInstance(p.id, ObjectId)
-
-    def test_update_computed_lengths(self):
-        p = models.Profile()
-        p.profile_id = 'fff'
-        p.vk_pem = 'profile key'
-        p.exp_id = 'fff'
-        p.result_ids = ['aaa']
-        p.save()
-        self.assertEqual(p.n_results, 1)
-
-        p.result_ids.extend(['bbb', 'ccc'])
-        p.save()
-        self.assertEqual(p.n_results, 3)
+        self.assertEqual(p.n_results, 0)
 
     def test_set_device(self):
         # set_device works, and it can only be set once
@@ -830,6 +797,48 @@ class ProfileTestCase(unittest.TestCase):
         self.assertRaises(models.DataValueError, p.set_data, [1, 2, 3])
         self.assertRaises(models.DataValueError, p.set_data, 123)
 
+    def test_updated_at(self):
+        # Set on creation, and on any change to the profile
+        before = datetime.utcnow()
+        p = models.Profile.create('profile key', self.e)
+        p.reload()
+        self.assertGreaterEqual(p.updated_at, before.replace(microsecond=0))
+
+        updates = [lambda: p.set_data({'new_data': 'bla'}),
+                   lambda: p.set_device(self.d1),
+                   lambda: models.Result.create(p, {'my_result': 5})]
+        for update in updates:
+            previous = p.updated_at
+            update()
+            p.reload()
+            self.assertGreaterEqual(p.updated_at, previous)
+
+    def test_updated_between(self):
+        p1 = models.Profile.create('profile key 1', self.e)
+        p2 = models.Profile.create('profile key 2', self.e)
+        p3 = models.Profile.create('profile key 3', self.e)
+        models.Profile.objects(profile_id=p1.profile_id).update_one(
+            set__updated_at=datetime(2014, 10, 1))
+        # Profiles from before updated_at have none
+        models.Profile.objects(profile_id=p2.profile_id).update_one(
+            unset__updated_at=True)
+        models.Profile.objects(profile_id=p3.profile_id).update_one(
+            set__updated_at=datetime(2014, 10, 3))
+
+        def profile_ids(since, until):
+            return sorted(p.profile_id for p in
+                          models.Profile.updated_between(since, until))
+
+        # The first window has the profiles without updated_at, and later
+        # windows only the updated profiles
+        self.assertEquals(profile_ids(None, datetime(2014, 10, 2)),
+                          sorted([p1.profile_id, p2.profile_id]))
+        self.assertEquals(profile_ids(datetime(2014, 10, 2),
+                                      datetime(2014, 10, 4)),
+                          [p3.profile_id])
+        self.assertEquals(profile_ids(datetime(2014, 10, 4),
+                                      datetime(2014, 10, 5)), [])
+
     def test_build_profile_id(self):
         # An example test
         vk_pem = 'profile key'
@@ -900,6 +909,22 @@ class ProfileTestCase(unittest.TestCase):
         self.assertIn(p.profile_id, self.u1.profile_ids)
         self.assertIn(p.profile_id, self.u2.profile_ids)
 
+    def test_accessible_profiles(self):
+        p = models.Profile.create('profile key', self.e)
+        u3 = models.User(user_id='bill-tmp',
+                         persona_email='bill@example.com',
+                         gravatar_id='ddd')
+        u3.set_user_id('bill')
+        self.u1.reload()
+        self.u2.reload()
+
+        # Owner and collaborator have access, others don't
+        for u in [self.u1, self.u2]:
+            self.assertTrue(u.can_access_profile(p))
+            self.assertEquals(list(u.accessible_profiles()), [p])
+        self.assertFalse(u3.can_access_profile(p))
+        self.assertEquals(list(u3.accessible_profiles()), [])
+
     def test_create_non_dict(self):
         # Anything else than a dict is refused
         self.assertRaises(models.DataValueError, models.Profile.create,
@@ -1058,10 +1083,15 @@ class ResultTestCase(unittest.TestCase):
         self.assertEquals(r.data, models.Data(my_result=5))
 
         # The models involved were updated
-        self.assertIn(r.result_id, self.e.result_ids)
-        self.assertIn(r.result_id, self.p1.result_ids)
-        self.assertIn(r.result_id, self.u1.result_ids)
-        self.assertIn(r.result_id, self.u2.result_ids)
+        for m in [self.e, self.p1, self.u1, self.u2]:
+            self.assertEquals(m.n_results, 1)
+
+        # And give access to the result
+        for m in [self.p1, self.u1, self.u2]:
+            self.assertTrue(m.can_access_result(r))
+            self.assertEquals(list(m.accessible_results()), [r])
+        self.assertFalse(self.p2.can_access_result(r))
+        self.assertEquals(list(self.p2.accessible_results()), [])
 
     def test_create_without_device(self):
         # Now the same without a device attached
@@ -1079,10 +1109,13 @@ class ResultTestCase(unittest.TestCase):
         self.assertEquals(r.data, models.Data(my_result=5))
 
         # The models involved were updated
-        self.assertIn(r.result_id, self.e.result_ids)
-        self.assertIn(r.result_id, self.p2.result_ids)
-        self.assertIn(r.result_id, self.u1.result_ids)
-        self.assertIn(r.result_id, self.u2.result_ids)
+        for m in [self.e, self.p2, self.u1, self.u2]:
+            self.assertEquals(m.n_results, 1)
+
+        # And give access to the result
+        for m in [self.p2, self.u1, self.u2]:
+            self.assertTrue(m.can_access_result(r))
+            self.assertEquals(list(m.accessible_results()), [r])
 
     def test_create_non_dict(self):
         # Anything else than a dict is refused
@@ -1092,3 +1125,304 @@ class ResultTestCase(unittest.TestCase):
                           self.p1, [1, 2, 3])
         self.assertRaises(models.DataValueError, models.Result.create,
                           self.p1, 123)
+
+    def test_create_bulk(self):
+        results, result_ids, failures = models.Result.create_bulk(
+            self.p1, [{'my_result': 5}, {'my_result': 6}])
+        self.u1.reload()
+        self.u2.reload()
+        self.e.reload()
+        self.p1.reload()
+
+        # The proper data was set, in the requested order
+        self.assertEquals(failures, [])
+        self.assertEquals(len(results), 2)
+        self.assertEquals([r.result_id for r in results], result_ids)
+        self.assertEquals(results[0].data, models.Data(my_result=5))
+        self.assertEquals(results[1].data, models.Data(my_result=6))
+        for r in results:
+            self.assertIsInstance(r.id, ObjectId)
+            self.assertEquals(r.profile_id, self.p1.profile_id)
+            self.assertEquals(r.exp_id, self.e.exp_id)
+        self.assertEquals(
+            models.Result.objects(result_id__in=result_ids).count(), 2)
+
+        # The models involved were updated
+        for m in [self.e, self.p1, self.u1, self.u2]:
+            self.assertEquals(m.n_results, 2)
+        for m in [self.p1, self.u1, self.u2]:
+            self.assertEquals(
+                sorted(r.result_id for r in m.accessible_results()),
+                sorted(result_ids))
+
+    def test_create_bulk_batch_id(self):
+        data_dicts = [{'my_result': 5}, {'my_result': 6}, {'my_result': 7}]
+        results, result_ids, failures = models.Result.create_bulk(
+            self.p1, data_dicts, batch_id='batch-1')
+
+        # Ids only depend on the profile, the batch and the position
+        self.assertEquals(failures, [])
+        self.assertEquals(result_ids, [
+            models.Result.build_batch_result_id(self.p1, 'batch-1', i)
+            for i in range(3)])
+        self.assertEquals([r.batch_index for r in results], [0, 1, 2])
+
+        # Replaying is answered with the stored results
+        replayed, replayed_ids, failures = models.Result.create_bulk(
+            self.p1, data_dicts, batch_id='batch-1')
+        self.e.reload()
+        self.assertEquals(failures, [])
+        self.assertEquals(replayed_ids, result_ids)
+        self.assertEquals([r.data for r in replayed],
+                          [r.data for r in results])
+        self.assertEquals(models.Result.objects.count(), 3)
+        self.assertEquals(self.e.n_results, 3)
+
+        # An interrupted upload only gets its missing items created
+        models.Result.objects(result_id=result_ids[1]).delete()
+        replayed, replayed_ids, failures = models.Result.create_bulk(
+            self.p1, data_dicts, batch_id='batch-1')
+        self.e.reload()
+        self.assertEquals(failures, [])
+        self.assertEquals(replayed_ids, result_ids)
+        self.assertEquals(replayed[1].data, models.Data(my_result=6))
+        self.assertEquals(models.Result.objects.count(), 3)
+        self.assertEquals(self.e.n_results, 4)
+
+        # Other batches and other profiles are independent
+        results, other_ids, failures = models.Result.create_bulk(
+            self.p2, data_dicts, batch_id='batch-1')
+        self.assertEquals(failures, [])
+        self.assertEquals(len(set(other_ids) & set(result_ids)), 0)
+        self.assertEquals(models.Result.objects.count(), 6)
+
+    def test_create_bulk_batch_id_replay_counts(self):
+        # An upload dies after storing its items but before counting them
+        data_dicts = [{'my_result': 5}, {'my_result': 6}]
+        count_batch = models.Result._count_batch
+        models.Result._count_batch = classmethod(lambda cls, p, b, e=None:
+                                                 None)
+        try:
+            models.Result.create_bulk(self.p1, data_dicts, batch_id='batch-1')
+        finally:
+            models.Result._count_batch = count_batch
+        self.e.reload()
+        self.assertEquals(self.e.n_results, 0)
+
+        # The replay counts the stored items, once
+        for i in range(2):
+            results, result_ids, failures = models.Result.create_bulk(
+                self.p1, data_dicts, batch_id='batch-1')
+            self.assertEquals(failures, [])
+            for m in [self.u1, self.u2, self.e, self.p1]:
+                m.reload()
+                self.assertEquals(m.n_results, 2)
+        self.assertEquals(models.Result.objects.count(), 2)
+
+        # Same when the replay also has new items to create
+        data_dicts.append({'my_result': 7})
+        models.Result.objects(result_id=result_ids[1]).update(
+            set__counted=False)
+        models.Result.create_bulk(self.p1, data_dicts, batch_id='batch-1')
+        for m in [self.u1, self.u2, self.e, self.p1]:
+            m.reload()
+            self.assertEquals(m.n_results, 4)
+        self.assertEquals(models.Result.objects.count(), 3)
+
+    def test_build_batch_result_id_non_ascii(self):
+        # Batch ids come from JSON and can hold any unicode character
+        result_id = models.Result.build_batch_result_id(self.p1, u'caf\xe9',
+                                                        0)
+        self.assertEquals(
+            result_id,
+            helpers.sha256hex((self.p1.profile_id +
+                               u'#caf\xe9/0').encode('utf-8')))
+        self.assertNotEquals(
+            result_id,
+            models.Result.build_batch_result_id(self.p1, u'cafe', 0))
+
+        results, result_ids, failures = models.Result.create_bulk(
+            self.p1, [{'my_result': 5}], batch_id=u'caf\xe9')
+        self.assertEquals(failures, [])
+        self.assertEquals(result_ids, [result_id])
+
+    def test_create_and_create_bulk_counts(self):
+        # Counts add up over several creations
+        models.Result.create(self.p1, {'my_result': 5})
+        models.Result.create_bulk(self.p1, [{'my_result': 6},
+                                            {'my_result': 7}])
+        self.u1.reload()
+        self.u2.reload()
+        self.e.reload()
+        self.p1.reload()
+
+        for m in [self.u1, self.u2, self.e, self.p1]:
+            self.assertEquals(m.n_results, 3)
+
+    def _create_bulk_with_collisions(self, ordered):
+        # Make result_ids depend only on data so we can provoke collisions
+        build_result_id = models.Result.build_result_id
+        models.Result.build_result_id = classmethod(
+            lambda cls, p, c, d: helpers.sha256hex(str(d)))
+        try:
+            return models.Result.create_bulk(
+                self.p1, [{'my_result': 5}, {'my_result': 5},
+                          {'my_result': 6}], ordered)
+        finally:
+            models.Result.build_result_id = build_result_id
+
+    def test_create_bulk_unordered_failures(self):
+        results, result_ids, failures = self._create_bulk_with_collisions(
+            False)
+        self.e.reload()
+
+        # The duplicate is reported, the rest of the batch is inserted
+        self.assertEquals(len(failures), 1)
+        self.assertEquals(failures[0][0], 1)
+        self.assertIsInstance(failures[0][1], NotUniqueError)
+        self.assertEquals(len(results), 2)
+        self.assertEquals(models.Result.objects.count(), 2)
+        self.assertEquals(self.e.n_results, 2)
+
+    def test_create_bulk_ordered_failures(self):
+        results, result_ids, failures = self._create_bulk_with_collisions(
+            True)
+        self.e.reload()
+
+        # The batch stops at the duplicate
+        self.assertEquals(len(failures), 2)
+        self.assertEquals(failures[0][0], 1)
+        self.assertIsInstance(failures[0][1], NotUniqueError)
+        self.assertEquals(failures[1][0], 2)
+        self.assertIsInstance(failures[1][1], models.BulkAbortedError)
+        self.assertEquals(len(results), 1)
+        self.assertEquals(models.Result.objects.count(), 1)
+        self.assertEquals(self.e.n_results, 1)
+
+    def test_create_bulk_non_list(self):
+        # Anything else than a list of dicts is refused
+        self.assertRaises(models.DataValueError, models.Result.create_bulk,
+                          self.p1, {'my_result': 5})
+        self.assertRaises(models.DataValueError, models.Result.create_bulk,
+                          self.p1, [{'my_result': 5}, 'non-dict'])
+        self.assertEquals(models.Result.objects.count(), 0)
+
+
+class ResultJobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(mode='test')
+
+        self.u = models.User(user_id='seb-tmp',
+                             persona_email='seb@example.com',
+                             gravatar_id='fff')
+        self.u.set_user_id('seb')
+        self.e = models.Exp.create('after-motion-effect', self.u,
+                                   'Study of the after-motion effect')
+        self.p = models.Profile.create('profile key', self.e)
+
+    def tearDown(self):
+        with self.app.test_request_context():
+            helpers.wipe_test_database()
+
+    def test_enqueue(self):
+        job = models.ResultJob.enqueue(self.p, [{'trials.1': 5}, {'a': 1}])
+        job.reload()
+        self.assertEquals(job.status, 'queued')
+        self.assertEquals(job.profile_id, self.p.profile_id)
+        self.assertEquals(job.n_items, 2)
+        self.assertEquals(job.data_dicts(), [{'trials.1': 5}, {'a': 1}])
+        self.assertEquals(models.Result.objects.count(), 0)
+
+        # Only lists of dicts can be queued
+        self.assertRaises(models.DataValueError, models.ResultJob.enqueue,
+                          self.p, [{'a': 1}, 'non-dict'])
+        self.assertRaises(models.DataValueError, models.ResultJob.enqueue,
+                          self.p, {'a': 1})
+        self.assertEquals(models.ResultJob.objects.count(), 1)
+
+    def test_enqueue_batch_id(self):
+        job = models.ResultJob.enqueue(self.p, [{'a': 1}], batch_id='b1')
+
+        # A replayed batch gets the first job back
+        self.assertEquals(models.ResultJob.enqueue(
+            self.p, [{'a': 1}], batch_id='b1').job_id, job.job_id)
+        self.assertNotEquals(models.ResultJob.enqueue(
+            self.p, [{'a': 1}], batch_id='b2').job_id, job.job_id)
+        self.assertEquals(models.ResultJob.objects.count(), 2)
+
+    def test_claim_next(self):
+        job1 = models.ResultJob.enqueue(self.p, [{'a': 1}])
+        job2 = models.ResultJob.enqueue(self.p, [{'a': 2}])
+
+        # Jobs are claimed once, oldest first
+        claimed = models.ResultJob.claim_next()
+        self.assertEquals(claimed.job_id, job1.job_id)
+        self.assertEquals(claimed.status, 'running')
+        self.assertIsNotNone(claimed.started_at)
+        self.assertEquals(models.ResultJob.claim_next().job_id, job2.job_id)
+        self.assertIsNone(models.ResultJob.claim_next())
+
+    def test_requeue_stale(self):
+        job = models.ResultJob.enqueue(self.p, [{'a': 1}])
+        models.ResultJob.claim_next()
+
+        # Recently started jobs are left alone
+        self.assertEquals(models.ResultJob.requeue_stale(datetime(2000, 1, 1)),
+                          0)
+        self.assertIsNone(models.ResultJob.claim_next())
+
+        self.assertEquals(models.ResultJob.requeue_stale(datetime.utcnow()),
+                          1)
+        self.assertEquals(models.ResultJob.claim_next().job_id, job.job_id)
+
+
+class PaginationIndexesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(mode='test')
+
+        self.u = models.User(user_id='seb-tmp',
+                             persona_email='seb@example.com',
+                             gravatar_id='fff')
+        self.u.set_user_id('seb')
+        self.e = models.Exp.create('after-motion-effect', self.u,
+                                   'Study of the after-motion effect')
+        self.d = models.Device.create('device key')
+        self.p = models.Profile.create('profile key', self.e)
+        models.Result.create_bulk(self.p, [{'a': 1}, {'a': 2}])
+
+    def tearDown(self):
+        with self.app.test_request_context():
+            helpers.wipe_test_database()
+
+    def assertNoSortStage(self, queryset):
+        plan = queryset._collection.find(queryset._query).sort(
+            queryset._page_sort()).explain()
+
+        # MongoDB 2.x flags in-memory sorts, later versions have a SORT
+        # stage in the winning plan
+        if 'queryPlanner' not in plan:
+            self.assertFalse(plan['scanAndOrder'])
+            return
+
+        stages = [plan['queryPlanner']['winningPlan']]
+        while len(stages) > 0:
+            stage = stages.pop()
+            self.assertNotEquals(stage['stage'], 'SORT')
+            if 'inputStage' in stage:
+                stages.append(stage['inputStage'])
+            stages.extend(stage.get('inputStages', []))
+
+    def test_default_orderings(self):
+        for queryset in [models.User.objects(),
+                         models.Exp.objects(),
+                         models.Device.objects(),
+                         models.Profile.objects(),
+                         models.Profile.objects(exp_id=self.e.exp_id),
+                         self.u.accessible_profiles(),
+                         models.Result.objects(),
+                         models.Result.objects(exp_id=self.e.exp_id),
+                         self.u.accessible_results(),
+                         self.p.accessible_results()]:
+            self.assertNoSortStage(queryset)
@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import json
+import unittest
+import zlib
+from datetime import datetime
+
 import ecdsa
 
-from .models import User, Exp, Device, Profile, Result
-from .helpers import APITestCase, sha256hex, iso8601
+from .models import User, Exp, Device, Profile, Result, ResultJob
+from . import analysis
+from .results import run_result_job
+from .analysis import percentile, ResultStats, ResultTable, numpy
+from .helpers import (APITestCase, sha256hex, iso8601, ParsingError,
+                      available_verifiers, set_verifier, close_verify_pool,
+                      base64url_encode)
 
 
 # TODO: add CORS test
@@ -248,6 +258,229 @@ class ResultsTestCase(APITestCase):
         self.assertIn(self.r22_dict_private, data['results'])
         self.assertEqual(len(data['results']), 2)
 
+    def _get_pages(self, url, user):
+        # Follow the next page links until the last page
+        pages = []
+        while url is not None:
+            resp, status_code = self.get(url, user, load_json_resp=False)
+            self.assertEqual(status_code, 200)
+            pages.append(json.loads(resp.data)['results'])
+            link = resp.headers.get('Link')
+            if link is None:
+                url = None
+            else:
+                url = '/results?' + link[link.index('?') + 1:
+                                         link.index('>; rel="next"')]
+        return pages
+
+    def test_root_get_paginated(self):
+        self.create_results()
+        data, status_code = self.get('/results', self.jane)
+        self.assertEqual(len(data['results']), 4)
+
+        # Pages follow the order of the whole list
+        pages = self._get_pages('/results?limit=3', self.jane)
+        self.assertEqual(map(len, pages), [3, 1])
+        self.assertEqual(sum(pages, []), data['results'])
+
+        pages = self._get_pages('/results?limit=1&order=created_at'
+                                '&access=private', self.jane)
+        self.assertEqual(pages, [[self.r11_dict_private],
+                                 [self.r12_dict_private]])
+
+        # No link when the last page is full
+        pages = self._get_pages('/results?limit=2&access=private',
+                                self.jane)
+        self.assertEqual(pages, [[self.r12_dict_private,
+                                  self.r11_dict_private]])
+
+        # Page size is capped by the server
+        self.app.config['MAX_PAGE_SIZE'] = 2
+        pages = self._get_pages('/results?limit=3', self.jane)
+        self.assertEqual(map(len, pages), [2, 2])
+
+        # Cursors are checked
+        data, status_code = self.get('/results?after=abc', self.jane)
+        self.assertEqual(status_code, 400)
+        self.assertEqual(data['error']['type'], 'ParsingError')
+
+    def test_root_get_count(self):
+        data, status_code = self.get('/results?count=only', self.jane)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(data, {'count': 0})
+
+        self.create_results()
+        data, status_code = self.get('/results?count=only')
+        self.assertEqual(status_code, 200)
+        self.assertEqual(data, {'count': 4})
+
+        # Counts follow access, filters and ids, not pages
+        data, status_code = self.get('/results?count=only&access=private'
+                                     '&limit=1', self.jane)
+        self.assertEqual(data, {'count': 2})
+        data, status_code = self.get(
+            '/results?count=only&access=private&created_at__gt={}'.format(
+                self.r11_dict_private['created_at']), self.jane)
+        self.assertEqual(data, {'count': 1})
+        data, status_code = self.get(
+            '/results?count=only&ids[]={}&ids[]={}'.format(
+                self.r11_dict_public['id'], self.r21_dict_public['id']))
+        self.assertEqual(data, {'count': 2})
+
+        # Access is still checked
+        data, status_code = self.get(
+            '/results?count=only&access=private&ids[]={}'.format(
+                self.r21_dict_public['id']), self.jane)
+        self.assertEqual(status_code, 403)
+
+    def test_exp_results_stats(self):
+        for rt in [300, 500, 'slow', 400]:
+            Result.create(self.p1, {'rt': rt, 'trial.n': 1})
+        Result.create(self.p2, {'rt': 1000})
+
+        url = '/exps/{}/results/stats?fields[]=rt&fields[]=trial.n'.format(
+            self.exp_nd.exp_id)
+        data, status_code = self.get(url, self.bill)
+        self.assertEqual(status_code, 200)
+        stats = data['stats']
+        self.assertEqual(stats['n_results'], 4)
+        self.assertEqual(stats['fields']['rt']['count'], 3)
+        self.assertEqual(stats['fields']['rt']['min'], 300)
+        self.assertEqual(stats['fields']['rt']['max'], 500)
+        self.assertEqual(stats['fields']['rt']['mean'], 400)
+        self.assertEqual(stats['fields']['rt']['percentiles']['50'], 400)
+        self.assertEqual(stats['fields']['trial.n']['count'], 4)
+        self.assertEqual(len(stats['histogram']), 1)
+        self.assertEqual(stats['histogram'][0]['n_results'], 4)
+        self.assertEqual(stats['histogram'][0]['fields']['rt'],
+                         {'count': 3, 'mean': 400})
+
+        # Results can be filtered like with `/results?access=private`
+        data, status_code = self.get(url + '&profile_id=' + 'a' * 64,
+                                     self.jane)
+        self.assertEqual(data['stats']['n_results'], 0)
+
+        # Profiles get the stats of their own results
+        stats_url = '/exps/{}/results/stats'.format(self.exp_nd.exp_id)
+        data, status_code = self.sget(stats_url, self.p1_sk, self.p1,
+                                      query_string={'fields[]': ['rt']})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(data['stats']['n_results'], 4)
+        self.assertEqual(data['stats']['fields']['rt']['count'], 3)
+
+        # Access is checked
+        data, status_code = self.get(url)
+        self.assertEqual(status_code, 401)
+        data, status_code = self.get(url, self.sophia)
+        self.assertEqual(status_code, 403)
+        data, status_code = self.sget(stats_url, self.p2_sk, self.p2)
+        self.assertEqual(status_code, 403)
+        data, status_code = self.get('/exps/abc/results/stats', self.jane)
+        self.assertEqual(status_code, 404)
+        data, status_code = self.get('/exps/abc/results/stats')
+        self.assertEqual(status_code, 401)
+        data, status_code = self.get(url + '&bucket=year', self.jane)
+        self.assertEqual(status_code, 400)
+
+    def _get_export_lines(self, url, user=None, sk=None, profile=None):
+        if sk is None:
+            resp, status_code = self.get(url, user, load_json_resp=False)
+        else:
+            resp, status_code = self.sget(url, sk, profile,
+                                          load_json_resp=False)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in resp.data.splitlines()]
+
+    def test_exp_results_export(self):
+        self.create_results()
+        r13 = Result.create(self.p1, {'trials': [7]})
+        url = '/exps/{}/results/export'.format(self.exp_nd.exp_id)
+
+        # Owner and collaborators get all the results of the exp, oldest
+        # first, and profiles their own
+        r11_dict, r12_dict = self.r11_dict_private, self.r12_dict_private
+        r13_dict = self.r12_dict_private.copy()
+        r13_dict.update({'id': r13.result_id,
+                         'created_at': r13.created_at.strftime(iso8601),
+                         'result_data': {'trials': [7]}})
+        for user in [self.jane, self.bill]:
+            self.assertEqual(self._get_export_lines(url, user),
+                             [r11_dict, r12_dict, r13_dict])
+        self.assertEqual(
+            self._get_export_lines(url, sk=self.p1_sk, profile=self.p1),
+            [r11_dict, r12_dict, r13_dict])
+
+        # Results can be filtered like with `/results?access=private`, and
+        # the export resumed after a result
+        self.assertEqual(
+            self._get_export_lines(url + '?profile_id=' + self.p2.profile_id,
+                                   self.jane), [])
+        self.assertEqual(
+            self._get_export_lines(url + '?after_id=' + self.r11.result_id,
+                                   self.jane), [r12_dict, r13_dict])
+        self.assertEqual(
+            self._get_export_lines(url + '?after_id=' + r13.result_id,
+                                   self.jane), [])
+
+        # Compressed if the client accepts it
+        with self.app.test_client_as_user(self.jane) as c:
+            resp = c.get(self.apize(url),
+                         headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            lines = zlib.decompress(resp.data,
+                                    16 + zlib.MAX_WBITS).splitlines()
+            self.assertEqual([json.loads(line) for line in lines],
+                             [r11_dict, r12_dict, r13_dict])
+
+            # Unless it refuses it
+            for accept_encoding in ['gzip;q=0, deflate', 'identity']:
+                resp = c.get(self.apize(url),
+                             headers={'Accept-Encoding': accept_encoding})
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertEqual([json.loads(line)
+                                  for line in resp.data.splitlines()],
+                                 [r11_dict, r12_dict, r13_dict])
+
+        # Access is checked
+        data, status_code = self.get(url)
+        self.assertEqual(status_code, 401)
+        data, status_code = self.get(url, self.sophia)
+        self.assertEqual(status_code, 403)
+        data, status_code = self.sget(url, self.p2_sk, self.p2)
+        self.assertEqual(status_code, 403)
+        data, status_code = self.sget(url, self.p3_sk, self.p1)
+        self.assertEqual(status_code, 401)
+        data, status_code = self.get('/exps/abc/results/export', self.jane)
+        self.assertEqual(status_code, 404)
+        data, status_code = self.get('/exps/abc/results/export')
+        self.assertEqual(status_code, 401)
+
+        # A result from elsewhere can't be resumed after
+        data, status_code = self.get(
+            url + '?after_id=' + self.r21.result_id, self.jane)
+        self.assertEqual(status_code, 400)
+
+    def test_root_get_streamed(self):
+        self.create_results()
+        unstreamed, _ = self.get('/results?access=private', self.jane,
+                                 load_json_resp=False)
+
+        # Streamed lists come out the same
+        self.app.config['STREAM_JSON_LISTS'] = True
+        resp, status_code = self.get('/results?access=private', self.jane,
+                                     load_json_resp=False)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(resp.data, unstreamed.data)
+        data, status_code = self.get('/results', self.jane)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(len(data['results']), 4)
+
+        # And errors are still answered as errors
+        data, status_code = self.get('/results?access=private')
+        self.assertEqual(status_code, 401)
+        self.assertEqual(data, self.error_401_dict)
+
     def test_root_get_with_auth_user_by_id(self):
         # Empty array
         data, status_code = self.get('/results?ids[]={}'.format(
@@ -531,11 +764,9 @@ class ResultsTestCase(APITestCase):
         self.complete_result_dict(self.p1, r11, self.rp11_dict_private)
         self.complete_result_dict(self.p1, r12, self.rp12_dict_private)
         self.assertEqual(status_code, 201)
-        # FIXME: adapt once ordering works
-        self.assertEqual(data.keys(), ['results'])
-        self.assertIn(self.rp11_dict_private, data['results'])
-        self.assertIn(self.rp12_dict_private, data['results'])
-        self.assertEqual(len(data['results']), 2)
+        # Results come back in the order they were posted in
+        self.assertEqual(data, {'results': [self.rp11_dict_private,
+                                            self.rp12_dict_private]})
 
         # A second batch, but with only one result
         data, status_code = self.spost(
@@ -551,6 +782,271 @@ class ResultsTestCase(APITestCase):
         self.assertEqual(status_code, 201)
         self.assertEqual(data, {'results': [self.rp21_dict_private]})
 
+    def test_root_post_return_ids(self):
+        data, status_code = self.spost(
+            '/results?return=ids',
+            {'results':
+             [{'profile_id': self.p1.profile_id,
+               'result_data': {'trials.1': 'worked'}},
+              {'profile_id': self.p1.profile_id,
+               'result_data': {'trials.2': 'failed'}}]},
+            self.p1_sk)
+        results = Result.objects(profile_id=self.p1.profile_id)
+        if 'trials&dot;1' in results[0].data:
+            r11, r12 = results
+        else:
+            r12, r11 = results
+        self.assertEqual(status_code, 201)
+        self.assertEqual(data, {'result_ids': [r11.result_id, r12.result_id],
+                                'n_results': 2,
+                                'n_failures': 0})
+
+        # And for a single result
+        data, status_code = self.spost(
+            '/results?return=ids',
+            {'result': {'profile_id': self.p2.profile_id,
+                        'result_data': {'trials.3': 'skipped'}}},
+            self.p2_sk)
+        r21 = Result.objects.get(profile_id=self.p2.profile_id)
+        self.assertEqual(status_code, 201)
+        self.assertEqual(data, {'result_id': r21.result_id})
+
+    def test_root_post_async(self):
+        batch = {'results':
+                 [{'profile_id': self.p1.profile_id,
+                   'result_data': {'trials.1': 'worked'}},
+                  {'profile_id': self.p1.profile_id,
+                   'result_data': {'trials.2': 'failed'}}]}
+
+        # Ignored unless the server queues uploads
+        data, status_code = self.spost(
+            '/results?async=true',
+            {'result': {'profile_id': self.p2.profile_id,
+                        'result_data': {'trials.3': 'skipped'}}},
+            self.p2_sk)
+        self.assertEqual(status_code, 201)
+        self.assertEqual(data.keys(), ['result'])
+
+        self.app.config['RESULTS_ASYNC'] = True
+        data, status_code = self.spost('/results?async=true', batch,
+                                       self.p1_sk)
+        self.assertEqual(status_code, 202)
+        job_id = data['job']['id']
+        self.assertEqual(data['job']['status'], 'queued')
+        self.assertEqual(data['job']['profile_id'], self.p1.profile_id)
+        self.assertEqual(data['job']['n_items'], 2)
+        self.assertEqual(data['job']['result_ids'], [])
+        self.assertEqual(
+            Result.objects(profile_id=self.p1.profile_id).count(), 0)
+
+        # Still queued until a worker gets to it
+        data, status_code = self.sget('/results/jobs/{}'.format(job_id),
+                                      self.p1_sk, self.p1)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(data['job']['status'], 'queued')
+
+        # Only the job's profile and the users of its exp can see it
+        data, status_code = self.get('/results/jobs/{}'.format(job_id),
+                                     self.jane)
+        self.assertEqual(status_code, 200)
+        data, status_code = self.get('/results/jobs/{}'.format(job_id))
+        self.assertEqual(status_code, 401)
+        data, status_code = self.sget('/results/jobs/{}'.format(job_id),
+                                      self.p2_sk, self.p2)
+        self.assertEqual(status_code, 403)
+        data, status_code = self.get('/results/jobs/{}'.format(job_id),
+                                     self.sophia)
+        self.assertEqual(status_code, 403)
+
+        with self.app.test_request_context():
+            job = ResultJob.claim_next()
+            self.assertEqual(job.job_id, job_id)
+            self.assertEqual(job.status, 'running')
+            self.assertIsNone(ResultJob.claim_next())
+            run_result_job(job)
+
+        data, status_code = self.sget('/results/jobs/{}'.format(job_id),
+                                      self.p1_sk, self.p1)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(data['job']['status'], 'done')
+        self.assertEqual(data['job']['failures'], [])
+        results = Result.objects(profile_id=self.p1.profile_id)
+        self.assertEqual(sorted(data['job']['result_ids']),
+                         sorted(r.result_id for r in results))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(Profile.objects.get(
+            profile_id=self.p1.profile_id).n_results, 2)
+
+        # Unknown jobs
+        data, status_code = self.get('/results/jobs/{}'.format('a' * 24),
+                                     self.jane)
+        self.assertEqual(status_code, 404)
+
+    def test_result_job_run_twice(self):
+        self.app.config['RESULTS_ASYNC'] = True
+        data, status_code = self.spost(
+            '/results?async=true',
+            {'results': [{'profile_id': self.p1.profile_id,
+                          'result_data': {'trials.1': 'worked'}},
+                         {'profile_id': self.p1.profile_id,
+                          'result_data': {'trials.2': 'failed'}}]},
+            self.p1_sk)
+        self.assertEqual(status_code, 202)
+
+        # A job requeued after its results were stored (e.g. its worker
+        # died, or took too long) doesn't store or count them again
+        with self.app.test_request_context():
+            run_result_job(ResultJob.claim_next())
+            self.assertEqual(ResultJob.requeue_stale(datetime.utcnow()), 0)
+            job = ResultJob.objects.get(job_id=data['job']['id'])
+            result_ids = job.result_ids
+            job.update(set__status='running',
+                       set__started_at=datetime(2000, 1, 1))
+            self.assertEqual(ResultJob.requeue_stale(datetime.utcnow()), 1)
+            run_result_job(ResultJob.claim_next())
+
+        job.reload()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.result_ids, result_ids)
+        self.assertEqual(
+            Result.objects(profile_id=self.p1.profile_id).count(), 2)
+        for m in [Profile.objects.get(profile_id=self.p1.profile_id),
+                  Exp.objects.get(exp_id=self.exp_nd.exp_id),
+                  User.objects.get(user_id='jane')]:
+            self.assertEqual(m.n_results, 2)
+
+    def test_root_post_in_bulk_batch_id_replay(self):
+        batch = {'batch_id': 'upload-1',
+                 'results':
+                 [{'profile_id': self.p1.profile_id,
+                   'result_data': {'trials.1': 'worked'}},
+                  {'profile_id': self.p1.profile_id,
+                   'result_data': {'trials.2': 'failed'}}]}
+        data, status_code = self.spost('/results', batch, self.p1_sk)
+        self.assertEqual(status_code, 201)
+        self.assertEqual(len(data['results']), 2)
+
+        # Retrying returns the same results without creating new ones
+        replay_data, status_code = self.spost('/results', batch, self.p1_sk)
+        self.assertEqual(status_code, 201)
+        self.assertEqual(sorted(replay_data['results']),
+                         sorted(data['results']))
+        self.assertEqual(
+            Result.objects(profile_id=self.p1.profile_id).count(), 2)
+        self.assertEqual(Profile.objects.get(
+            profile_id=self.p1.profile_id).n_results, 2)
+
+        # Non-ASCII batch ids are fine
+        batch['batch_id'] = u'envoi-\xe9t\xe9'
+        data, status_code = self.spost('/results', batch, self.p1_sk)
+        self.assertEqual(status_code, 201)
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(
+            Result.objects(profile_id=self.p1.profile_id).count(), 4)
+
+        # Batch ids must be non-empty strings
+        batch['batch_id'] = ''
+        data, status_code = self.spost('/results', batch, self.p1_sk)
+        self.assertEqual(status_code, 400)
+        self.assertEqual(data, self.error_400_malformed_dict)
+
+    def test_stream_post(self):
+        lines = [
+            self._sign({'results':
+                        [{'profile_id': self.p1.profile_id,
+                          'result_data': {'trials.1': 'worked'}},
+                         {'profile_id': self.p1.profile_id,
+                          'result_data': {'trials.2': 'failed'}}]},
+                       self.p1_sk, True),
+            # Signed by the wrong profile
+            self._sign({'result': {'profile_id': self.p2.profile_id,
+                                   'result_data': {'trials.3': 'skipped'}}},
+                       self.p1_sk, True),
+            'not json',
+            self._sign({'result': {'profile_id': self.p2.profile_id,
+                                   'result_data': {'trials.3': 'skipped'}}},
+                       self.p2_sk, True)]
+        body = '\n'.join(line if isinstance(line, str) else json.dumps(line)
+                         for line in lines) + '\n'
+
+        data, status_code = self.post('/results/stream', body,
+                                      mime='application/x-ndjson',
+                                      dump_json_data=False)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(len(data['chunks']), 4)
+
+        # Each chunk is acknowledged on its own
+        results = Result.objects(profile_id=self.p1.profile_id)
+        if 'trials&dot;1' in results[0].data:
+            r11, r12 = results
+        else:
+            r12, r11 = results
+        r21 = Result.objects.get(profile_id=self.p2.profile_id)
+        self.assertEqual(data['chunks'][0],
+                         {'index': 0, 'status_code': 201,
+                          'result_ids': [r11.result_id, r12.result_id]})
+        self.assertEqual(data['chunks'][1],
+                         dict(self.error_403_invalid_signature_dict['error'],
+                              index=1))
+        self.assertEqual(data['chunks'][2],
+                         dict(self.error_400_malformed_dict['error'],
+                              index=2))
+        self.assertEqual(data['chunks'][3],
+                         {'index': 3, 'status_code': 201,
+                          'result_ids': [r21.result_id]})
+
+    def test_stream_post_malformed_signature(self):
+        def sign(i):
+            return self._sign(
+                {'result': {'profile_id': self.p1.profile_id,
+                            'result_data': {'trials.{}'.format(i): i}}},
+                self.p1_sk, True)
+
+        def malform(i, **fields):
+            sdata = sign(i)
+            sdata['signatures'][0].update(fields)
+            return sdata
+
+        no_signature = sign(1)
+        del no_signature['signatures'][0]['signature']
+        string_signature = sign(2)
+        string_signature['signatures'] = ['not a signature']
+        lines = [sign(0), no_signature, string_signature,
+                 malform(3, protected=base64url_encode('not json')),
+                 malform(4, protected=base64url_encode('{"alg": "XX"}')),
+                 malform(5, signature=base64url_encode('\x30\x01junk')),
+                 malform(6, signature=base64url_encode('x' * 70))]
+
+        # Malformed signatures only fail their own chunk, with each verifier
+        # (python-ecdsa raises on bad DER) and whether or not they are
+        # verified in the same window as good ones
+        n_results = 0
+        for verifier in available_verifiers():
+            for processes in [0, 4]:
+                set_verifier(verifier)
+                self.app.config['SIGNATURE_VERIFY_PROCESSES'] = processes
+                try:
+                    data, status_code = self.post(
+                        '/results/stream',
+                        '\n'.join(json.dumps(line)
+                                   for line in lines + [sign(7)]) + '\n',
+                        mime='application/x-ndjson', dump_json_data=False)
+                finally:
+                    close_verify_pool()
+                    set_verifier(available_verifiers()[0])
+                self.assertEqual(status_code, 200)
+                self.assertEqual(data['chunks'][1:-1], [
+                    dict(self.error_400_malformed_dict['error'], index=i)
+                    for i in range(1, len(lines))])
+                for i in [0, len(lines)]:
+                    self.assertEqual(data['chunks'][i]['status_code'], 201)
+
+                # The good chunks are stored
+                n_results += 2
+                self.assertEqual(
+                    Result.objects(profile_id=self.p1.profile_id).count(),
+                    n_results)
+
     def test_root_post_successful_ignore_additional_data(self):
         data, status_code = self.spost(
             '/results',
@@ -1128,3 +1624,152 @@ class ResultsTestCase(APITestCase):
 
     # No error-priority test since having malformed data is the
     # last possible error
+
+
+class ResultStatsTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(percentile([1], 50), 1)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(percentile([1, 2, 3, 4], 0), 1)
+        self.assertEqual(percentile([1, 2, 3, 4], 100), 4)
+        self.assertAlmostEqual(percentile(range(11), 95), 9.5)
+
+    def test_pipelines(self):
+        stats = ResultStats(['a.b'], 'hour')
+        bucket_key = {'$substr': ['$created_at', 0, 13]}
+        self.assertEqual(stats.pipeline({'exp_id': 'ab'}), [
+            {'$match': {'exp_id': 'ab'}},
+            {'$group': {'_id': bucket_key, 'count': {'$sum': 1}}}])
+
+        # Only single numbers are grouped, under their encoded key
+        field_query = stats.field_query({'exp_id': 'ab'}, 'a&dot;b')
+        number_query = field_query['$and'][1]
+        self.assertEqual(field_query['$and'][0], {'exp_id': 'ab'})
+        self.assertEqual(number_query['$or'],
+                         [{'data.a&dot;b': {'$type': t}} for t in [1, 16, 18]])
+        self.assertEqual(number_query['data.a&dot;b.0'], {'$exists': False})
+        self.assertIs(number_query['data.a&dot;b']['$ne'], stats.nan)
+        self.assertEqual(stats.field_pipeline({'exp_id': 'ab'}, 'a&dot;b'), [
+            {'$match': field_query},
+            {'$group': {'_id': bucket_key,
+                        'count': {'$sum': 1},
+                        'total': {'$sum': '$data.a&dot;b'},
+                        'min': {'$min': '$data.a&dot;b'},
+                        'max': {'$max': '$data.a&dot;b'}}}])
+
+    def test_to_jsonable(self):
+        stats = ResultStats(['rt', 'a.b', 'word'], 'hour')
+        stats.add_buckets([{'_id': '2014,10,04,16', 'count': 3},
+                           {'_id': '2014,10,04,14', 'count': 2}])
+        stats.add_field('rt', [{'_id': '2014,10,04,14', 'count': 2,
+                                'total': 6.0, 'min': 2, 'max': 4.0}],
+                        iter([4.0, 2]))
+        stats.add_field('a.b', [{'_id': '2014,10,04,14', 'count': 1,
+                                 'total': 1, 'min': 1, 'max': 1}],
+                        iter([1]))
+        stats.add_field('word', [], iter([]))
+
+        self.assertEqual(stats.to_jsonable(), {
+            'n_results': 5,
+            'fields': {
+                'rt': {'count': 2, 'min': 2, 'max': 4.0, 'mean': 3.0,
+                       'percentiles': {'5': 2.1, '25': 2.5, '50': 3.0,
+                                       '75': 3.5, '95': 3.9}},
+                'a.b': {'count': 1, 'min': 1, 'max': 1, 'mean': 1.0,
+                        'percentiles': {'5': 1, '25': 1, '50': 1, '75': 1,
+                                        '95': 1}},
+                'word': {'count': 0, 'min': None, 'max': None,
+                         'mean': None, 'percentiles': None}},
+            'histogram': [
+                {'start': '2014-10-04T14:00:00Z', 'n_results': 2,
+                 'fields': {'rt': {'count': 2, 'mean': 3.0},
+                            'a.b': {'count': 1, 'mean': 1.0},
+                            'word': {'count': 0, 'mean': None}}},
+                {'start': '2014-10-04T16:00:00Z', 'n_results': 3,
+                 'fields': {'rt': {'count': 0, 'mean': None},
+                            'a.b': {'count': 0, 'mean': None},
+                            'word': {'count': 0, 'mean': None}}}]})
+
+        self.assertRaises(ParsingError, ResultStats, ['rt'], 'year')
+
+    def test_field_percentiles(self):
+        stats = ResultStats(['rt'])
+        expected = {'5': 1.5, '25': 3.5, '50': 6.0, '75': 8.5, '95': 10.5}
+
+        # With numpy if it is installed, and without
+        for numpy in set([analysis.numpy, None]):
+            saved_numpy, analysis.numpy = analysis.numpy, numpy
+            try:
+                percentiles = stats.field_percentiles(iter([11, 1, 6]))
+            finally:
+                analysis.numpy = saved_numpy
+            self.assertEqual(sorted(percentiles), sorted(expected))
+            for p, value in expected.iteritems():
+                self.assertAlmostEqual(percentiles[p], value)
+
+
+class ResultTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.jsonables = [
+            {'id': str(i), 'profile_id': 'ab', 'exp_id': 'cd',
+             'created_at': '2014-10-04T14:05:52.000100Z',
+             'result_data': data}
+            for i, data in enumerate([
+                {'rt': 1, 'ok': True, 'word': u'caf\xe9',
+                 'trial': {'n': 1}, 'choices': [1, 2]},
+                {'rt': 2.5, 'ok': False, 'trial': {'n': 'two'}, 'none': None},
+                {}])]
+        self.table = ResultTable()
+        for jsonable in self.jsonables:
+            self.table.add(jsonable)
+
+    def test_schema(self):
+        self.assertEqual(self.table.n_rows, 3)
+        self.assertEqual(self.table.schema(), [
+            ('id', 'str'), ('profile_id', 'str'), ('exp_id', 'str'),
+            ('created_at', 'datetime'),
+            ('result_data.choices', 'json'),
+            ('result_data.none', 'str'),
+            ('result_data.ok', 'bool'),
+            ('result_data.rt', 'float'),
+            ('result_data.trial.n', 'json'),
+            ('result_data.word', 'str')])
+
+    def test_flatten(self):
+        # Dotted keys don't share a column with nested dicts
+        self.assertEqual(
+            sorted(ResultTable.flatten({'a.b': 1, 'a': {'b': 2, 'c&d': 3}},
+                                       'result_data.')),
+            [('result_data.a&dot;b', 1), ('result_data.a.b', 2),
+             ('result_data.a.c&and;d', 3)])
+
+    def test_iter_csv_rows(self):
+        # Rows are made from a second pass over the results
+        rows = list(self.table.iter_csv_rows(iter(self.jsonables)))
+        self.assertEqual(rows[0][4:], ['result_data.choices',
+                                       'result_data.none', 'result_data.ok',
+                                       'result_data.rt',
+                                       'result_data.trial.n',
+                                       'result_data.word'])
+        self.assertEqual(rows[1], ['0', 'ab', 'cd',
+                                   '2014-10-04T14:05:52.000100Z', '[1,2]',
+                                   '', 'true', '1.0', '1', 'caf\xc3\xa9'])
+        self.assertEqual(rows[2][4:], ['', '', 'false', '2.5', '"two"', ''])
+        self.assertEqual(rows[3][4:], [''] * 6)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_to_arrays(self):
+        arrays = self.table.to_arrays(iter(self.jsonables))
+        self.assertEqual(arrays['created_at'].dtype,
+                         numpy.dtype('datetime64[us]'))
+        self.assertEqual(arrays['result_data.ok'].tolist(),
+                         [True, False, False])
+        self.assertEqual(arrays['result_data.ok:missing'].tolist(),
+                         [False, False, True])
+        self.assertEqual(arrays['result_data.rt'][:2].tolist(), [1.0, 2.5])
+        self.assertTrue(numpy.isnan(arrays['result_data.rt'][2]))
+        self.assertEqual(arrays['result_data.trial.n'].tolist(),
+                         [u'1', u'"two"', u''])
+        self.assertNotIn('id:missing', arrays)
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, jsonify, abort, request
+from flask import Blueprint, abort, request
 from flask.views import MethodView
 from flask.ext.login import current_user, logout_user, login_user
 from mongoengine import NotUniqueError, ValidationError
@@ -8,7 +8,8 @@ from mongoengine.queryset import DoesNotExist
 
 from .cors import cors
 from .helpers import (QueryTooDeepException, UnknownOperator, NonQueriableType,
-                      NonOrderableType, BadQueryType, ParsingError)
+                      NonOrderableType, BadQueryType, ParsingError,
+                      jsonify, jsonify_list, get_page_args)
 from .models import User, UserIdSetError, UserIdReservedError
 
 
@@ -43,19 +44,18 @@ def root():
                 # Override with an empty result set
                 rusers = User.objects(user_id=None)
 
-        limit = request.args.get('limit')
-        try:
-            limit = int(limit) if limit is not None else None
-        except ValueError:
-            raise ParsingError
+        limit, after = get_page_args()
         orders = User.objects.translate_order_to_jsonable_private(
             request.args)
         filtered_query = User.objects.translate_to_jsonable_private(
             request.args)
-        rusers = rusers(**filtered_query).order_by(*orders)
-        rusers = rusers.limit(limit) if limit is not None else rusers
+        rusers = rusers(**filtered_query)
+        if request.args.get('count', None) == 'only':
+            return jsonify({'count': rusers.count()})
 
-        return jsonify({'users': rusers.to_jsonable_private()})
+        rusers, after = rusers.order_by(*orders).paginate(limit, after)
+
+        return jsonify_list('users', rusers.iter_jsonable_private(), after)
 
     # Public access
     if 'ids[]' in request.args:
@@ -64,17 +64,16 @@ def root():
     else:
         rusers = User.objects()
 
-    limit = request.args.get('limit')
-    try:
-        limit = int(limit) if limit is not None else None
-    except ValueError:
-        raise ParsingError
+    limit, after = get_page_args()
     orders = User.objects.translate_order_to_jsonable(request.args)
     filtered_query = User.objects.translate_to_jsonable(request.args)
-    rusers = rusers(**filtered_query).order_by(*orders)
-    rusers = rusers.limit(limit) if limit is not None else rusers
+    rusers = rusers(**filtered_query)
+    if request.args.get('count', None) == 'only':
+        return jsonify({'count': rusers.count()})
+
+    rusers, after = rusers.order_by(*orders).paginate(limit, after)
 
-    return jsonify({'users': rusers.to_jsonable()})
+    return jsonify_list('users', rusers.iter_jsonable(), after)
 
 
 @users.route('/me')
@@ -89,9 +88,9 @@ class UserView(MethodView):
 
     @cors()
     def get(self, user_id):
-        u = User.objects.get(user_id=user_id)
-
         if request.args.get('access', None) == 'private':
+            u = User.objects.only_jsonable_private().get(user_id=user_id)
+
             if not current_user.is_authenticated():
                 abort(401)
 
@@ -100,6 +99,7 @@ class UserView(MethodView):
             else:
                 abort(403)
         else:
+            u = User.objects.only_jsonable().get(user_id=user_id)
             return jsonify({'user': u.to_jsonable()})
 
     @cors()